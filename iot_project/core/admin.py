@@ -2,6 +2,7 @@ from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin # Import UserAdmin for custom user models
 from .models import CustomUser, Device # Import both CustomUser and Device
 from django.utils import timezone # Import timezone for custom admin actions
+from device_api.device_cache import invalidate_devices
 
 # Register CustomUser with the admin site
 # We use UserAdmin as a base to ensure all default user management features are present
@@ -34,19 +35,25 @@ class DeviceAdmin(admin.ModelAdmin):
     raw_id_fields = ('owner',) # Use a raw ID input for owner to improve performance with many users
     actions = ['mark_online', 'mark_offline', 'mark_registered', 'mark_unregistered']
 
+    def _update_devices(self, queryset, **fields):
+        # Pinned to the selected rows: the changelist filters may no longer match them after the update
+        queryset = Device.objects.filter(pk__in=list(queryset.values_list('pk', flat=True)))
+        queryset.update(**fields)
+        invalidate_devices(queryset) # queryset.update() skips the post_save cache invalidation
+
     def mark_online(self, request, queryset):
-        queryset.update(is_online=True, last_seen=timezone.now())
+        self._update_devices(queryset, is_online=True, last_seen=timezone.now())
     mark_online.short_description = "Mark selected devices as online"
 
     def mark_offline(self, request, queryset):
-        queryset.update(is_online=False)
+        self._update_devices(queryset, is_online=False)
     mark_offline.short_description = "Mark selected devices as offline"
     
     def mark_registered(self, request, queryset):
-        queryset.update(is_registered=True)
+        self._update_devices(queryset, is_registered=True)
     mark_registered.short_description = "Mark selected devices as registered"
 
     def mark_unregistered(self, request, queryset):
-        queryset.update(is_registered=False, owner=None)
+        self._update_devices(queryset, is_registered=False, owner=None)
     mark_unregistered.short_description = "Mark selected devices as unregistered and remove owner"
 
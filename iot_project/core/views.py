@@ -8,6 +8,7 @@ from django.http import JsonResponse
 from django.views.decorators.http import require_GET, require_POST
 from django.views.decorators.csrf import csrf_exempt
 from .models import Device
+from device_api.heartbeat import heartbeat
 from django.utils import timezone
 from django.contrib import messages
 from .forms import CustomUserChangeForm
@@ -194,7 +195,7 @@ def add_device_to_user(request):
             return JsonResponse({'status': 'error', 'message': 'Device API Key is required.'}, status=400)
 
         try:
-            device = Device.objects.get(device_api_key=device_api_key)
+            device = heartbeat.apply(Device.objects.get(device_api_key=device_api_key))
             if device.is_registered:
                 messages.warning(request, 'This device is already registered to a user.')
                 return JsonResponse({'status': 'error', 'message': 'This device is already registered to a user.'}, status=409)
@@ -4,23 +4,23 @@ import traceback
 from django.contrib.auth.decorators import login_required
 from django.db.models import Max, Q, OuterRef, Subquery
 # ... other existing imports
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
 from django.shortcuts import get_object_or_404, redirect, render
+from django.conf import settings
 from django.utils import timezone
 from django.views.decorators.http import require_POST
 from core.models import Device
-from device_api.models import DeviceCommandQueue, SensorData
-from device_api.views import  DeviceAnalysisAPIView
+from device_api.heartbeat import heartbeat
+from device_api.pubsub import device_topic, get_broker
+from device_api.models import DeviceCommandQueue, DeviceLatestReading, SensorData
 
 # REQUIRED IMPORT FOR APIView
 from rest_framework.views import APIView 
 from rest_framework.response import Response # Also ensure Response is imported if used
 from rest_framework import status # Also ensure status is imported if used
 
-# For ML models and data manipulation
-import pandas as pd
-from sklearn.ensemble import IsolationForest
-from prophet import Prophet
 import logging
 
 logger = logging.getLogger(__name__)
@@ -32,14 +32,8 @@ def user_dashboard(request):
     """
     user_devices = Device.objects.filter(owner=request.user, is_registered=True).order_by('last_seen')
 
-    latest_data_ids = SensorData.objects.values('device_id').annotate(
-        max_timestamp=Max('timestamp')
-    ).values_list('id', flat=True)
-
-    latest_data_entries = SensorData.objects.filter(
-        id__in=latest_data_ids,
-        device__in=user_devices
-    ).select_related('device')
+    # One row per device, kept current by the ingest path (no aggregate over SensorData history)
+    latest_data_entries = DeviceLatestReading.objects.filter(device__in=user_devices)
 
     latest_data_dict = {entry.device_id: entry for entry in latest_data_entries}
 
@@ -47,6 +41,7 @@ def user_dashboard(request):
     current_time = timezone.now()
 
     for device in user_devices:
+        heartbeat.apply(device) # Merge in liveness recorded by polls but not yet flushed
         latest_data_entry = latest_data_dict.get(device.id)
         latest_data = latest_data_entry.data if latest_data_entry else {} 
         is_online = False
@@ -67,6 +62,43 @@ def user_dashboard(request):
     return render(request, 'dashboard/dashboard.html', context)
 
 
+@login_required
+async def device_stream(request):
+    """
+    Server-Sent Events stream of new readings and heartbeats for the user's devices,
+    published by the device_api ingest and poll endpoints.
+    Streaming needs the ASGI server (asgi.py). Under WSGI it answers 204 so the
+    dashboard falls back to polling /api/v1/device/latest/.
+    """
+    if not isinstance(request, ASGIRequest):
+        return HttpResponse(status=204)
+
+    user = await request.auser()
+    device_ids = [
+        device_id async for device_id in
+        Device.objects.filter(owner=user, is_registered=True).values_list('id', flat=True)
+    ]
+    keepalive = getattr(settings, 'DASHBOARD_STREAM_KEEPALIVE', 15)
+    subscription = get_broker().subscribe(device_topic(device_id) for device_id in device_ids)
+
+    async def event_stream():
+        try:
+            yield 'retry: 5000\n\n'
+            while True:
+                message = await subscription.get(timeout=keepalive)
+                if message is None:
+                    yield ': keep-alive\n\n' # Also lets the server notice a closed connection
+                    continue
+                yield f"event: {message['event']}\ndata: {json.dumps(message['payload'], cls=DjangoJSONEncoder)}\n\n"
+        finally:
+            subscription.close()
+
+    response = StreamingHttpResponse(event_stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no' # Stop nginx from buffering the stream
+    return response
+
+
 @login_required
 @require_POST
 def control_device(request, device_id):
@@ -105,7 +137,7 @@ def device_analysis_page(request, device_id):
     """
     device = get_object_or_404(Device, pk=device_id, owner=request.user)    
 
-    sensor_data_entries_raw = SensorData.objects.filter(device=device).order_by('-timestamp')[:50]
+    sensor_data_entries_raw = SensorData.objects.recent_for_device(device, 50)
     sensor_data_entries = list(reversed(sensor_data_entries_raw))
 
     context = {
@@ -120,11 +152,11 @@ def device_detail(request, device_id):
     Renders the device details page, fetching and parsing sensor data for charts and table.
     Ensures data is correctly prepared as numbers for charting.
     """
-    device = get_object_or_404(Device, id=device_id, owner=request.user)
+    device = heartbeat.apply(get_object_or_404(Device, id=device_id, owner=request.user))
 
     # FIX 1: Fetch the latest 50 sensor data entries, then reverse them for chronological order.
     # Chart.js time axis generally expects data in ascending time order.
-    sensor_data_entries_raw = SensorData.objects.filter(device=device).order_by('-timestamp')[:50]
+    sensor_data_entries_raw = SensorData.objects.recent_for_device(device, 50)
     sensor_data_entries = list(reversed(sensor_data_entries_raw))
     
     chart_labels = []
@@ -138,33 +170,19 @@ def device_detail(request, device_id):
         'water_level': []
     }
 
+    # Only the metrics of this device type are charted; the others stay None for consistency
+    charted_metrics = {
+        'power_monitor': ('power', 'voltage', 'current', 'energy', 'frequency', 'power_factor'),
+        'water_level': ('water_level',),
+    }.get(device.device_type, ())
+
     for entry in sensor_data_entries:
-        # FIX 2: Access the 'data' JSONField content directly for each entry in the loop.
-        # Assuming entry.data is a JSONField and already deserialized into a Python dictionary.
-        entry_sensor_data = entry.data 
-        
         # Use strftime for chart labels to match the Chart.js 'yyyy-MM-dd HH:mm:ss' parser
         chart_labels.append(entry.timestamp.strftime('%Y-%m-%d %H:%M:%S'))
 
-        # IMPORTANT: Explicitly convert to float, and handle None if key is missing.
-        # Ensure that non-relevant fields for a device type are appended as None.
-        if device.device_type == 'power_monitor':
-            chart_data['power'].append(float(entry_sensor_data.get('power')) if entry_sensor_data.get('power') is not None else None)
-            chart_data['voltage'].append(float(entry_sensor_data.get('voltage')) if entry_sensor_data.get('voltage') is not None else None)
-            chart_data['current'].append(float(entry_sensor_data.get('current')) if entry_sensor_data.get('current') is not None else None)
-            chart_data['energy'].append(float(entry_sensor_data.get('energy')) if entry_sensor_data.get('energy') is not None else None)
-            chart_data['frequency'].append(float(entry_sensor_data.get('frequency')) if entry_sensor_data.get('frequency') is not None else None)
-            chart_data['power_factor'].append(float(entry_sensor_data.get('power_factor')) if entry_sensor_data.get('power_factor') is not None else None)
-            chart_data['water_level'].append(None) # Add None for non-existent fields for consistency
-        elif device.device_type == 'water_level':
-            chart_data['water_level'].append(float(entry_sensor_data.get('water_level')) if entry_sensor_data.get('water_level') is not None else None)
-            # Add None for power_monitor fields if this is a water_level device for consistency
-            chart_data['power'].append(None)
-            chart_data['voltage'].append(None)
-            chart_data['current'].append(None)
-            chart_data['energy'].append(None)
-            chart_data['frequency'].append(None)
-            chart_data['power_factor'].append(None)
+        # Typed float columns: already numbers (or None when the device didn't send the field)
+        for metric in chart_data:
+            chart_data[metric].append(getattr(entry, metric) if metric in charted_metrics else None)
     
     # Debug prints (keep these for your own testing, remove in production)
     # print(f"Chart labels: {chart_labels}")
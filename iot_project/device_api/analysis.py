@@ -0,0 +1,416 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+import numpy as np
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection
+from django.utils import timezone
+
+from core.models import Device
+import ml_models # pandas, scikit-learn and Prophet load on first use of the analysis functions, not here
+from ml_models import get_metric_config, lttb_indices
+from .analysis_queue import enqueue_analysis, latest_finished_job, result_from_json
+from .archive import hot_cutoff, sensor_archive
+from .models import TYPED_METRICS, DeviceForecast, DeviceLatestReading, SensorData
+from .rollups import choose_resolution, rollup_summary, rollup_window
+
+logger = logging.getLogger(__name__)
+
+_model_store = None
+
+
+def get_model_store():
+    """Trained models are kept per device/metric/window and reused until the data drifts (None disables)."""
+    global _model_store
+    store_dir = getattr(settings, 'ML_MODEL_STORE_DIR', None)
+    if _model_store is None and store_dir:
+        _model_store = ml_models.ModelStore(
+            store_dir,
+            drift_threshold=getattr(settings, 'ML_MODEL_DRIFT_THRESHOLD', 1.0),
+            refit_ratio=getattr(settings, 'ML_MODEL_REFIT_RATIO', 0.2),
+            max_age=getattr(settings, 'ML_MODEL_MAX_AGE', 86400),
+        )
+    return _model_store
+
+
+DURATIONS = ('24h', '7d', '30d')
+
+
+def normalize_duration(duration_param):
+    """The analysis window for a ?duration= value; anything unknown means the default 24 hours."""
+    return duration_param if duration_param in DURATIONS else '24h'
+
+
+def duration_start(duration_param, end_time):
+    if duration_param == '7d':
+        return end_time - timezone.timedelta(days=7)
+    elif duration_param == '30d':
+        return end_time - timezone.timedelta(days=30)
+    else: # Default to 24 hours
+        return end_time - timezone.timedelta(hours=24)
+
+
+def load_window(device, duration_param, end_time=None):
+    """
+    A device's readings in the analysis window as columns, oldest first, and the
+    resolution they are at. The models are fitted on it, so it is as fine as the
+    ANALYSIS_MAX_FIT_POINTS budget allows (see rollups.choose_resolution): raw
+    readings, including archived ones (see archive.py), or else rollup buckets (see
+    rollups.rollup_window). Raw windows have 'timestamp' (microseconds since the
+    epoch), 'data' (typed metric -> float array, NaN where missing) and 'extras',
+    each row's remaining payload keys.
+    """
+    end_time = end_time or timezone.now()
+    start_time = duration_start(duration_param, end_time)
+    max_points = getattr(settings, 'ANALYSIS_MAX_FIT_POINTS', 50000)
+    # Past the retention period raw readings live in the archive (rollups still cover it)
+    cutoff = hot_cutoff(timezone.now())
+    from_archive = cutoff is not None and start_time < cutoff
+    archived_points = sensor_archive.count(device.id, start_time, end_time) if from_archive else 0
+
+    config = get_metric_config(device.device_type)
+    min_points = max(config.min_anomaly_points, config.min_forecast_points) if config is not None else 0
+    resolution = choose_resolution(device, start_time, end_time, max_points, archived_points, min_points)
+    if resolution != 'raw':
+        return rollup_window(device, resolution, start_time, end_time), resolution
+
+    # Newest first, so a window that couldn't go to a rollup is cut to its newest readings
+    hot = (SensorData.objects.window_for_device(device, start_time, end_time)
+           .order_by('-timestamp')[:max_points].payload_columns('id', 'timestamp'))
+    columns = {
+        'id': np.asarray(hot['id'], dtype=np.int64)[::-1],
+        'timestamp': ml_models.timestamp_micros(hot['timestamp'])[::-1],
+        **{metric: np.asarray(hot[metric], dtype=float)[::-1] for metric in TYPED_METRICS}, # None -> NaN
+    }
+    extras = list(hot['data'])[::-1]
+    if archived_points and len(columns['id']) < max_points:
+        # A row is in both places only while the archiver is between writing a file and deleting its rows
+        archived = sensor_archive.read_columns(device.id, start_time, end_time)
+        keep = ~np.isin(archived['id'], columns['id'])
+        columns = {name: np.concatenate([archived[name][keep], values]) for name, values in columns.items()}
+        extras = [extra for extra, kept in zip(archived['data'], keep) if kept] + extras
+        order = np.argsort(columns['timestamp'], kind='stable')[-max_points:]
+        columns = {name: values[order] for name, values in columns.items()}
+        extras = [extras[i] for i in order]
+
+    return {
+        'timestamp': columns['timestamp'],
+        'data': {metric: columns[metric] for metric in TYPED_METRICS if not np.isnan(columns[metric]).all()},
+        'extras': extras,
+    }, resolution
+
+
+def window_frame(window, metric=None):
+    """
+    The DataFrame the models are fitted on (see ml_models.columns_to_frame) for a
+    load_window() result. A numeric typed metric is never left in the JSON extras
+    (see SensorPayloadField), so they are only expanded when `metric` is another key.
+    """
+    extras = None if metric in TYPED_METRICS else window.get('extras')
+    return ml_models.columns_to_frame(window['timestamp'], window['data'], extras)
+
+
+def window_summary(device, duration_param, resolution, end_time):
+    """Per-metric count/min/max/mean for the window, aggregated in SQL over raw typed columns or rollups."""
+    start_time = duration_start(duration_param, end_time)
+    if resolution == 'raw':
+        return SensorData.objects.window_for_device(device, start_time, end_time).metric_summary()
+    return rollup_summary(device, resolution, start_time, end_time)
+
+
+def model_key(device_id, metric, duration_param):
+    """Where a device's trained models for one metric and window live in the model store."""
+    return f"device-{device_id}/{metric}-{duration_param}"
+
+
+def stored_forecast(device_id, metric, duration_param):
+    """The batch forecast from `manage.py forecast_devices`, if one is recent enough to serve."""
+    max_age = getattr(settings, 'FORECAST_MAX_AGE', 7200)
+    return DeviceForecast.objects.filter(
+        device_id=device_id, metric=metric, duration=duration_param,
+        generated_at__gte=timezone.now() - timezone.timedelta(seconds=max_age),
+    ).values('predictions', 'suggestions').first()
+
+
+def compute_analysis(device, duration_param):
+    """
+    Fits the anomaly detector and forecast for a device's window (see ml_models). Slow:
+    Prophet dominates. The window itself is kept as columns under 'window'; the API
+    encodes it per request (see encode_window).
+    """
+    device_id = device.id
+    end_time = timezone.now()
+    window, resolution = load_window(device, duration_param, end_time)
+
+    if not len(window['timestamp']):
+        return {
+            'device_id': device.id,
+            'device_name': device.name,
+            'device_type': device.device_type,
+            'message': f'No data available for analysis for the last {duration_param}.',
+            'window': window,
+            'anomalies': [],
+            'predictions': [],
+            'suggestions': [f"No sensor data available for the last {duration_param}. Please ensure your device is sending data."]
+        }
+
+    config = get_metric_config(device.device_type)
+
+    if config is not None:
+        series = ml_models.metric_series(window_frame(window, config.metric), config.metric)
+        result = ml_models.analyze_series(series, config, context=f" on device {device_id}",
+                                          store=get_model_store(), key=model_key(device_id, config.metric, duration_param),
+                                          stored_forecast=stored_forecast(device_id, config.metric, duration_param))
+    else:
+        # Default suggestions for unconfigured device types
+        result = {'anomalies': [], 'predictions': [], 'suggestions': [
+            "ℹ️ Analysis not yet configured for this device type.",
+            "ℹ️ Ensure the device is sending 'power' or 'water_level' data for analysis.",
+        ]}
+
+    return {
+        'device_id': device.id,
+        'device_name': device.name,
+        'device_type': device.device_type,
+        'resolution': resolution,
+        'summary': window_summary(device, duration_param, resolution, end_time),
+        # The models saw the whole window; the chart only needs ANALYSIS_MAX_POINTS of it
+        'window': downsample_window(window, getattr(settings, 'ANALYSIS_MAX_POINTS', 1000)),
+        **result,
+    }
+
+
+ENCODINGS = ('points', 'columnar')
+
+
+def parse_max_points(value):
+    """Parses ?max_points=N for the chart data, clamped to ANALYSIS_MAX_POINTS (also the default)."""
+    budget = getattr(settings, 'ANALYSIS_MAX_POINTS', 1000)
+    if value in (None, ''):
+        return budget
+    max_points = int(value)
+    if max_points < 3:
+        raise ValueError('max_points must be an integer of at least 3.')
+    return min(max_points, budget)
+
+
+def _row_dicts(columns, keep):
+    """Rows `keep` of a {metric: float array} mapping as one dict per row, leaving out NaN values."""
+    dense, sparse = {}, {}
+    for metric, values in columns.items():
+        values = values[keep]
+        (sparse if np.isnan(values).any() else dense)[metric] = values.tolist()
+    names = list(dense)
+    rows = [dict(zip(names, row)) for row in zip(*dense.values())] if dense else [{} for _ in range(len(keep))]
+    for metric, values in sparse.items():
+        for row, value in zip(rows, values):
+            if value == value: # Not NaN
+                row[metric] = value
+    return rows
+
+
+def _chart_positions(window, max_points):
+    """
+    Per metric, the positions LTTB keeps of its non-NaN values, and the union of
+    them: the rows a chart of at most `max_points` points per metric needs.
+    """
+    timestamps = window['timestamp']
+    seconds = timestamps / 1_000_000
+    picked = {}
+    for metric, values in window['data'].items():
+        positions = np.flatnonzero(~np.isnan(values))
+        picked[metric] = positions[lttb_indices(seconds[positions], values[positions], max_points)]
+    if len(timestamps) <= max_points:
+        keep = np.arange(len(timestamps))
+    elif not picked: # Only non-numeric readings; spread the budget evenly
+        keep = np.unique(np.linspace(0, len(timestamps) - 1, max_points).astype(int))
+    else:
+        keep = np.unique(np.concatenate(list(picked.values())))
+    return picked, keep
+
+
+def downsample_window(window, max_points):
+    """A load_window() window cut to the rows encode_window() can pick from for `max_points` points per metric."""
+    if len(window['timestamp']) <= max_points:
+        return window
+    _, keep = _chart_positions(window, max_points)
+    reduced = {'timestamp': window['timestamp'][keep]}
+    for key in ('data', 'min', 'max'):
+        if key in window:
+            reduced[key] = {metric: values[keep] for metric, values in window[key].items()}
+    if 'count' in window:
+        reduced['count'] = window['count'][keep]
+    if 'extras' in window:
+        reduced['extras'] = [window['extras'][i] for i in keep.tolist()]
+    return reduced
+
+
+def encode_window(window, max_points, encoding='points'):
+    """
+    Encodes a compute_analysis() window for the API, reduced to at most `max_points`
+    per metric with LTTB (see ml_models.downsampling) so chart payloads stay bounded
+    whatever the window.
+
+    'points' is the list of {'timestamp', 'data'} dicts (plus 'min', 'max' and
+    'count' for rollup windows), holding the union of the points picked for each
+    metric. 'columnar' returns {metric: {'timestamps': [...], 'values': [...]}}
+    instead, plus 'min'/'max' arrays for rollup windows.
+    """
+    timestamps = window['timestamp']
+    if not len(timestamps):
+        return [] if encoding == 'points' else {}
+    picked, keep = _chart_positions(window, max_points)
+
+    if encoding == 'columnar':
+        series = {}
+        for metric, positions in picked.items():
+            series[metric] = {
+                'timestamps': ml_models.isoformat_micros(timestamps[positions]),
+                'values': window['data'][metric][positions].tolist(),
+            }
+            if 'min' in window:
+                series[metric]['min'] = window['min'][metric][positions].tolist()
+                series[metric]['max'] = window['max'][metric][positions].tolist()
+        return series
+
+    points = [
+        {'timestamp': timestamp, 'data': data}
+        for timestamp, data in zip(ml_models.isoformat_micros(timestamps[keep]), _row_dicts(window['data'], keep))
+    ]
+    extras = window.get('extras')
+    if extras and any(extras):
+        for point, position in zip(points, keep.tolist()):
+            point['data'].update(extras[position])
+    if 'min' in window:
+        counts = window['count'][keep].tolist()
+        for point, low, high, count in zip(points, _row_dicts(window['min'], keep), _row_dicts(window['max'], keep), counts):
+            point.update(min=low, max=high, count=count)
+    return points
+
+
+class AnalysisCache:
+    """
+    Caches compute_analysis() results per (device, duration, metric).
+
+    A result is fresh while it was computed from the device's current latest reading
+    and is younger than `ttl` seconds. Otherwise get() returns the last good result
+    straight away (marked stale) and has it refitted. Concurrent requests for the same
+    key share one fit.
+
+    With the 'worker' runner the fit is an AnalysisJob picked up by `manage.py
+    run_analysis_worker` in its own processes, and finished results are read back from
+    the job table; requests never wait for a fit. The 'thread' runner fits in a
+    background thread pool of the web process instead, and only a cold cache makes
+    the caller wait (up to `cold_wait` seconds).
+    """
+
+    def __init__(self, cache_alias='default', ttl=300, stale_ttl=86400, max_workers=2, cold_wait=60, runner='worker'):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.max_workers = max_workers
+        self.cold_wait = cold_wait
+        self.runner = runner
+        self._executor = None
+        self._in_flight = {} # cache key -> Future
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    def _key(self, device_id, duration_param, metric):
+        # Versioned: bump it whenever the layout of the cached result changes
+        return f"device-analysis:v2:{device_id}:{duration_param}:{metric}"
+
+    def _fresh(self, entry, latest_reading_id):
+        return (entry is not None and entry['latest_reading_id'] == latest_reading_id
+                and (timezone.now() - entry['computed_at']).total_seconds() < self.ttl)
+
+    def get(self, device, duration_param):
+        """
+        Returns (result, stale, job). result is None while there is nothing to serve yet;
+        job is the AnalysisJob refreshing a stale or missing result ('worker' runner only).
+        """
+        config = get_metric_config(device.device_type)
+        metric = config.metric if config is not None else None
+        key = self._key(device.id, duration_param, metric)
+        latest_reading_id = DeviceLatestReading.objects.filter(device_id=device.id).values_list('sensor_data_id', flat=True).first()
+
+        entry = self.cache.get(key) # {'latest_reading_id', 'computed_at', 'result'}
+        if self.runner == 'worker':
+            return self._get_from_worker(key, device.id, duration_param, metric, latest_reading_id, entry)
+
+        if entry is not None:
+            fresh = self._fresh(entry, latest_reading_id)
+            if not fresh:
+                self._refresh(key, device.id, duration_param, latest_reading_id)
+            return entry['result'], not fresh, None
+
+        future = self._refresh(key, device.id, duration_param, latest_reading_id)
+        try:
+            return future.result(timeout=self.cold_wait), False, None
+        except FutureTimeoutError:
+            return None, True, None
+
+    def _get_from_worker(self, key, device_id, duration_param, metric, latest_reading_id, entry):
+        if not self._fresh(entry, latest_reading_id):
+            # A worker may have finished a newer result since this process cached one
+            job = latest_finished_job(device_id, duration_param, metric)
+            if job is not None and (entry is None or job.finished_at > entry['computed_at']):
+                entry = {
+                    'latest_reading_id': job.latest_reading_id,
+                    'computed_at': job.finished_at,
+                    'result': result_from_json(job.result),
+                }
+                self.cache.set(key, entry, self.stale_ttl)
+        if self._fresh(entry, latest_reading_id):
+            return entry['result'], False, None
+        job = enqueue_analysis(device_id, duration_param, metric, latest_reading_id, retry_after=self.ttl)
+        return (entry['result'] if entry is not None else None), True, job
+
+    def _refresh(self, key, device_id, duration_param, latest_reading_id):
+        with self._lock:
+            future = self._in_flight.get(key)
+            if future is None:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='device-analysis')
+                future = self._executor.submit(self._compute, key, device_id, duration_param, latest_reading_id)
+                self._in_flight[key] = future
+                future.add_done_callback(lambda f: self._done(key, f))
+            return future
+
+    def _done(self, key, future):
+        with self._lock:
+            if self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+    def _compute(self, key, device_id, duration_param, latest_reading_id):
+        try:
+            device = Device.objects.get(pk=device_id)
+            result = compute_analysis(device, duration_param)
+            # Kept past the TTL so there is always a last good result to serve while refitting
+            self.cache.set(key, {
+                'latest_reading_id': latest_reading_id,
+                'computed_at': timezone.now(),
+                'result': result,
+            }, self.stale_ttl)
+            return result
+        except Exception as e:
+            # Leave the last good result in place; the next request retries
+            logger.error(f"Error computing analysis for device {device_id} ({duration_param}): {e}", exc_info=True)
+            raise
+        finally:
+            connection.close() # Worker thread's own connection
+
+
+analysis_cache = AnalysisCache(
+    cache_alias=getattr(settings, 'DEVICE_ANALYSIS_CACHE_ALIAS', 'default'),
+    ttl=getattr(settings, 'DEVICE_ANALYSIS_CACHE_TTL', 300),
+    stale_ttl=getattr(settings, 'DEVICE_ANALYSIS_STALE_TTL', 86400),
+    max_workers=getattr(settings, 'DEVICE_ANALYSIS_WORKERS', 2),
+    cold_wait=getattr(settings, 'DEVICE_ANALYSIS_COLD_WAIT', 60),
+    runner=getattr(settings, 'DEVICE_ANALYSIS_RUNNER', 'worker'),
+)
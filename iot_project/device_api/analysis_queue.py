@@ -0,0 +1,139 @@
+import numpy as np
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+
+from core.models import Device
+from .models import AnalysisJob
+
+# Columns of a compute_analysis() window and the dtype they are restored with
+WINDOW_ARRAYS = {'timestamp': np.int64, 'count': np.int64}
+WINDOW_METRIC_ARRAYS = ('data', 'min', 'max')
+
+
+def result_to_json(result):
+    """A compute_analysis() result as JSON-safe values: window arrays become lists, with None for NaN."""
+    window = dict(result['window'])
+    for key in WINDOW_ARRAYS:
+        if key in window:
+            window[key] = window[key].tolist()
+    for key in WINDOW_METRIC_ARRAYS:
+        if key in window:
+            window[key] = {metric: np.where(np.isnan(values), None, values).tolist() for metric, values in window[key].items()}
+    return dict(result, window=window)
+
+
+def result_from_json(data):
+    """Reverses result_to_json()."""
+    window = dict(data['window'])
+    for key, dtype in WINDOW_ARRAYS.items():
+        if key in window:
+            window[key] = np.asarray(window[key], dtype=dtype)
+    for key in WINDOW_METRIC_ARRAYS:
+        if key in window:
+            window[key] = {metric: np.asarray(values, dtype=float) for metric, values in window[key].items()} # None -> NaN
+    return dict(data, window=window)
+
+
+def latest_finished_job(device_id, duration_param, metric):
+    """The newest successful job for a device/window, whose result the API serves. The result is loaded on access."""
+    return AnalysisJob.objects.filter(
+        device_id=device_id, duration=duration_param, metric=metric, status='done',
+    ).defer('result').order_by('-finished_at').first()
+
+
+def enqueue_analysis(device_id, duration_param, metric, latest_reading_id, retry_after=300):
+    """
+    Queues an analysis of a device's window unless one is already queued or running,
+    and returns the job that will produce the result. A job that failed on the same
+    data within `retry_after` seconds is returned instead of queueing it again.
+    """
+    active = AnalysisJob.objects.filter(device_id=device_id, duration=duration_param, status__in=AnalysisJob.ACTIVE_STATUSES).first()
+    if active is not None:
+        return active
+    failed = AnalysisJob.objects.filter(
+        device_id=device_id, duration=duration_param, metric=metric, status='failed',
+        latest_reading_id=latest_reading_id, finished_at__gte=timezone.now() - timezone.timedelta(seconds=retry_after),
+    ).first()
+    if failed is not None:
+        return failed
+    try:
+        with transaction.atomic():
+            return AnalysisJob.objects.create(device_id=device_id, duration=duration_param, metric=metric,
+                                              latest_reading_id=latest_reading_id)
+    except IntegrityError:
+        # Another request queued it between our check and insert (unique_active_analysis_job)
+        return AnalysisJob.objects.filter(device_id=device_id, duration=duration_param, status__in=AnalysisJob.ACTIVE_STATUSES).first()
+
+
+def claim_analysis_jobs(limit):
+    """
+    Claims up to `limit` of the oldest queued jobs for this worker and marks them running.
+    Each job is claimed by one worker only: the conditional UPDATE is serialized by the
+    database, as in commands.claim_commands.
+    """
+    claimed = []
+    now = timezone.now()
+    for job in AnalysisJob.objects.filter(status='queued').order_by('created_at')[:limit]:
+        if AnalysisJob.objects.filter(pk=job.pk, status='queued').update(status='running', started_at=now, attempts=job.attempts + 1):
+            job.status, job.started_at, job.attempts = 'running', now, job.attempts + 1
+            claimed.append(job)
+    return claimed
+
+
+def finish_analysis_job(job, result=None, error=''):
+    """Stores a job's outcome and drops the older finished jobs it supersedes."""
+    job.status = 'done' if result is not None else 'failed'
+    job.finished_at = timezone.now()
+    job.result = result
+    job.error = error or ''
+    with transaction.atomic():
+        job.save(update_fields=['status', 'finished_at', 'result', 'error'])
+        # Keep the table at one finished job per outcome per device/window
+        AnalysisJob.objects.filter(device_id=job.device_id, duration=job.duration, status=job.status).exclude(pk=job.pk).delete()
+    return job
+
+
+def requeue_stalled_jobs(stalled_after, max_attempts=3):
+    """
+    Jobs left 'running' for longer than `stalled_after` seconds belonged to a worker that
+    died. They are queued again, or failed once they have used up `max_attempts`.
+    """
+    stalled = AnalysisJob.objects.filter(status='running', started_at__lt=timezone.now() - timezone.timedelta(seconds=stalled_after))
+    failed = stalled.filter(attempts__gte=max_attempts).update(
+        status='failed', finished_at=timezone.now(), error='Worker stopped before the job finished.')
+    requeued = stalled.filter(attempts__lt=max_attempts).update(status='queued', started_at=None)
+    return requeued, failed
+
+
+def release_analysis_jobs(jobs, max_attempts=None, error=''):
+    """
+    Puts claimed jobs that won't be finished back in the queue. With `max_attempts`,
+    those that have used them up are failed with `error` instead. Returns (requeued, failed).
+    """
+    claimed = AnalysisJob.objects.filter(pk__in=[job.pk for job in jobs], status='running')
+    failed = 0
+    if max_attempts is not None:
+        failed = claimed.filter(attempts__gte=max_attempts).update(status='failed', finished_at=timezone.now(), error=error)
+        claimed = claimed.filter(attempts__lt=max_attempts)
+    return claimed.update(status='queued', started_at=None), failed
+
+
+def run_analysis_job(device_id, duration_param, seconds=None):
+    """
+    Process pool task: computes one analysis under a time budget. Returns
+    (JSON-encoded result, None) or (None, error message); the parent process writes it.
+    """
+    # Imported here: analysis.py imports this module, and forecasts.py loads the ML stack
+    from .analysis import compute_analysis
+    from .forecasts import TimeBudgetExceeded, time_budget
+
+    try:
+        with time_budget(seconds):
+            result = compute_analysis(Device.objects.get(pk=device_id), duration_param)
+        return result_to_json(result), None
+    except TimeBudgetExceeded as e:
+        return None, str(e)
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    finally:
+        close_old_connections()
@@ -0,0 +1,117 @@
+import threading
+
+from django.conf import settings
+
+from ml_models import StreamState, get_metric_config
+from .models import SensorAnomaly, SensorData
+
+
+def _metric_value(data, metric):
+    value = data.get(metric) if isinstance(data, dict) else None
+    if isinstance(value, bool) or value is None:
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def serialize_anomaly(anomaly):
+    return {
+        'timestamp': anomaly.timestamp.isoformat(),
+        'metric': anomaly.metric,
+        'value': anomaly.value,
+        'expected': anomaly.expected,
+        'score': anomaly.score,
+    }
+
+
+def recent_anomalies(device_id, start_time, limit=100):
+    """Newest-first streaming anomalies for a device since start_time, serialized for the API."""
+    anomalies = SensorAnomaly.objects.filter(device_id=device_id, timestamp__gte=start_time).order_by('-timestamp')[:limit]
+    return [serialize_anomaly(anomaly) for anomaly in anomalies]
+
+
+class StreamingAnomalyMonitor:
+    """
+    Runs each device's streaming detector (ml_models.StreamingDetector) over readings
+    as they are ingested and records the flagged ones as SensorAnomaly rows.
+
+    Detector state lives in this process, per (device, metric). The first time a
+    device is seen its state is seeded from its last `seed_readings` stored readings,
+    so a restart or another worker process doesn't start from zero.
+    """
+
+    def __init__(self, seed_readings=200):
+        self.seed_readings = seed_readings
+        self._states = {} # (device id, metric) -> [StreamState, timestamp of the newest reading seen]
+        self._lock = threading.Lock()
+
+    def _seed(self, device_id, metric, detector, before):
+        state = StreamState()
+        history = (SensorData.objects.filter(device_id=device_id, timestamp__lt=before)
+                   .order_by('-timestamp')[:self.seed_readings].payload_values('timestamp'))
+        last_timestamp = None
+        for row in reversed(list(history)):
+            value = _metric_value(row['data'], metric)
+            if value is not None:
+                detector.update(state, value)
+                last_timestamp = row['timestamp']
+        return [state, last_timestamp]
+
+    def observe(self, device, sensor_data):
+        """
+        Feeds newly stored SensorData rows of a Device or CachedDevice to its detector.
+        Bulk-inserts and returns the SensorAnomaly rows for flagged readings. Readings
+        older than the newest one already seen (late uploads) are skipped.
+        """
+        config = get_metric_config(device.device_type)
+        if config is None:
+            return []
+        metric = config.metric
+        readings = sorted(
+            ((reading, value) for reading in sensor_data if (value := _metric_value(reading.data, metric)) is not None),
+            key=lambda item: item[0].timestamp,
+        )
+        if not readings:
+            return []
+
+        detector = config.streaming_detector()
+        key = (device.id, metric)
+        with self._lock:
+            entry = self._states.get(key)
+        if entry is None:
+            seeded = self._seed(device.id, metric, detector, before=readings[0][0].timestamp)
+            with self._lock:
+                entry = self._states.setdefault(key, seeded)
+
+        anomalies = []
+        with self._lock:
+            state, last_timestamp = entry
+            for reading, value in readings:
+                if last_timestamp is not None and reading.timestamp < last_timestamp:
+                    continue
+                score, expected, is_anomaly = detector.update(state, value)
+                last_timestamp = reading.timestamp
+                if is_anomaly:
+                    anomalies.append(SensorAnomaly(
+                        device_id=device.id, sensor_data_id=reading.pk, timestamp=reading.timestamp,
+                        metric=metric, value=value, expected=expected, score=score,
+                    ))
+            entry[1] = last_timestamp
+
+        if anomalies:
+            SensorAnomaly.objects.bulk_create(anomalies)
+        return anomalies
+
+    def forget(self, device_id=None):
+        """Drops detector state for one device, or for all devices."""
+        with self._lock:
+            if device_id is None:
+                self._states.clear()
+            else:
+                for key in [key for key in self._states if key[0] == device_id]:
+                    del self._states[key]
+
+
+anomaly_monitor = StreamingAnomalyMonitor(seed_readings=getattr(settings, 'STREAMING_ANOMALY_SEED_READINGS', 200))
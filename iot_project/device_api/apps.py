@@ -4,3 +4,6 @@ from django.apps import AppConfig
 class DeviceApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'device_api'
+
+    def ready(self):
+        from . import signals  # noqa: F401 (connects the cache invalidation and command wake-up receivers)
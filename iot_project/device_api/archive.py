@@ -0,0 +1,212 @@
+import json
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from itertools import islice
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Max
+
+from .models import TYPED_METRICS, RollupCursor, SensorData
+from .rollups import CURSOR_NAME
+
+
+def month_start(timestamp):
+    timestamp = timestamp.astimezone(dt_timezone.utc)
+    return datetime(timestamp.year, timestamp.month, 1, tzinfo=dt_timezone.utc)
+
+
+def next_month(start):
+    return start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+
+
+def _micros(timestamp):
+    return int(round(timestamp.timestamp() * 1_000_000))
+
+
+class SensorArchive:
+    """
+    Raw SensorData moved out of the database, one compressed NPZ file per device and
+    month (device-<id>/<YYYY-MM>.npz under `root`). Each file is columnar: 'id',
+    'timestamp' (UTC epoch microseconds), one float64 array per typed metric (NaN
+    when absent) and 'extra', the JSON-encoded list of the remaining payload keys.
+    NPZ members are decompressed one at a time, so count() only reads timestamps.
+    """
+
+    COLUMNS = ('id', 'timestamp', *TYPED_METRICS)
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, device_id, month):
+        return os.path.join(self.root, f'device-{device_id}', f'{month:%Y-%m}.npz')
+
+    def _month_paths(self, device_id, start_time, end_time):
+        month = month_start(start_time)
+        while month <= end_time:
+            path = self.path(device_id, month)
+            if os.path.exists(path):
+                yield path
+            month = next_month(month)
+
+    def _load(self, path, columns):
+        with np.load(path, allow_pickle=False) as npz:
+            return {column: npz[column] for column in columns}
+
+    def write(self, device_id, month, columns):
+        """
+        Adds readings to a month file, merging with what is already archived there.
+        `columns` is laid out as read_columns() returns it: 'id', 'timestamp'
+        (microseconds since the epoch), the typed metrics (NaN where missing) and
+        'data', a list of each row's JSON extras. The file is replaced atomically.
+        """
+        extras = columns['data']
+        columns = {column: columns[column] for column in self.COLUMNS}
+
+        path = self.path(device_id, month)
+        if os.path.exists(path):
+            existing = self._load(path, (*self.COLUMNS, 'extra'))
+            keep = ~np.isin(existing['id'], columns['id'])
+            for column in self.COLUMNS:
+                columns[column] = np.concatenate([existing[column][keep], columns[column]])
+            extras = [extra for extra, kept in zip(json.loads(str(existing['extra'])), keep) if kept] + extras
+
+        order = np.argsort(columns['timestamp'], kind='stable')
+        columns = {column: values[order] for column, values in columns.items()}
+        columns['extra'] = np.array(json.dumps([extras[i] for i in order]))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.npz')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **columns)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return path
+
+    def count(self, device_id, start_time, end_time):
+        """Archived readings for a device in [start_time, end_time]."""
+        start, end = _micros(start_time), _micros(end_time)
+        total = 0
+        for path in self._month_paths(device_id, start_time, end_time):
+            timestamps = self._load(path, ('timestamp',))['timestamp']
+            total += int(np.count_nonzero((timestamps >= start) & (timestamps <= end)))
+        return total
+
+    def read_columns(self, device_id, start_time, end_time):
+        """
+        Archived readings for a device in [start_time, end_time], oldest first, as
+        column arrays: 'id', 'timestamp' (microseconds since the epoch), the typed
+        metrics (NaN where missing) and 'data', a list of each row's JSON extras.
+        """
+        start, end = _micros(start_time), _micros(end_time)
+        parts = []
+        for path in self._month_paths(device_id, start_time, end_time):
+            columns = self._load(path, (*self.COLUMNS, 'extra'))
+            extras = json.loads(str(columns['extra']))
+            rows = np.flatnonzero((columns['timestamp'] >= start) & (columns['timestamp'] <= end))
+            part = {column: columns[column][rows] for column in self.COLUMNS}
+            part['data'] = [extras[i] for i in rows]
+            parts.append(part)
+        if not parts:
+            return {'id': np.empty(0, dtype=np.int64), 'timestamp': np.empty(0, dtype=np.int64),
+                    **{metric: np.empty(0) for metric in TYPED_METRICS}, 'data': []}
+        return {
+            **{column: np.concatenate([part[column] for part in parts]) for column in self.COLUMNS},
+            'data': [extra for part in parts for extra in part['data']],
+        }
+
+
+def _stream_columns(readings, chunk_size):
+    """
+    `readings` in the column layout of SensorArchive.read_columns(), fetched
+    `chunk_size` rows at a time into preallocated arrays rather than as a dict per row.
+    """
+    # Rows inserted while this runs are left for the next run
+    last_id = readings.aggregate(last_id=Max('pk'))['last_id'] or 0
+    readings = readings.filter(pk__lte=last_id)
+    count = readings.count()
+    columns = {'id': np.empty(count, dtype=np.int64), 'timestamp': np.empty(count, dtype=np.int64),
+               **{metric: np.empty(count) for metric in TYPED_METRICS}}
+    no_extras = {}
+    extras = [no_extras] * count # Most readings keep everything in typed columns; share one empty dict
+    rows = readings.order_by('timestamp').values_list('id', 'timestamp', *TYPED_METRICS, 'data').iterator(chunk_size=chunk_size)
+    filled = 0
+    while filled < count:
+        chunk = list(islice(rows, min(chunk_size, count - filled)))
+        if not chunk:
+            break # Rows deleted meanwhile (e.g. with their device)
+        end = filled + len(chunk)
+        ids, timestamps, *metrics, data = zip(*chunk)
+        columns['id'][filled:end] = ids
+        columns['timestamp'][filled:end] = [_micros(timestamp) for timestamp in timestamps]
+        for metric, values in zip(TYPED_METRICS, metrics):
+            columns[metric][filled:end] = np.array(values, dtype=np.float64) # None -> NaN
+        for i, extra in enumerate(data, filled):
+            if extra:
+                extras[i] = extra
+        filled = end
+    columns = {column: values[:filled] for column, values in columns.items()}
+    columns['data'] = extras[:filled]
+    return columns
+
+
+def archive_old_readings(archive, cutoff, delete_chunk_size=1000, require_rolled_up=True, log=None, read_chunk_size=10000):
+    """
+    Moves raw SensorData older than `cutoff` into the archive, per device and month:
+    each month file is written and synced before its rows are deleted, in chunks of
+    `delete_chunk_size` per transaction so the database is never locked for long.
+    A month is read `read_chunk_size` rows at a time into column arrays, so a month
+    of per-second readings takes tens of MB rather than a dict per row.
+    With require_rolled_up, only rows the rollup compactor has already folded in
+    are moved, so rollups keep covering the archived history.
+    Returns (rows archived, files written).
+    """
+    readings = SensorData.objects.filter(timestamp__lt=cutoff)
+    if require_rolled_up:
+        cursor = RollupCursor.objects.filter(name=CURSOR_NAME).first()
+        readings = readings.filter(pk__lte=cursor.last_id if cursor else 0)
+
+    archived = files = 0
+    for device_id in readings.order_by().values_list('device_id', flat=True).distinct():
+        device_readings = readings.filter(device_id=device_id)
+        oldest = device_readings.order_by('timestamp').values_list('timestamp', flat=True).first()
+        if oldest is None:
+            continue
+        month = month_start(oldest)
+        while month < cutoff:
+            columns = _stream_columns(device_readings.filter(timestamp__gte=month, timestamp__lt=next_month(month)), read_chunk_size)
+            if len(columns['id']):
+                path = archive.write(device_id, month, columns)
+                ids = columns['id'].tolist()
+                for i in range(0, len(ids), delete_chunk_size):
+                    with transaction.atomic():
+                        SensorData.objects.filter(pk__in=ids[i:i + delete_chunk_size]).delete()
+                archived += len(ids)
+                files += 1
+                if log:
+                    log(f"Device {device_id}: archived {len(ids)} readings to {path}")
+            month = next_month(month)
+    return archived, files
+
+
+def vacuum():
+    """Gives the space freed by deleted rows back to the filesystem (SQLite only)."""
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            cursor.execute('VACUUM')
+
+
+sensor_archive = SensorArchive(getattr(settings, 'SENSOR_ARCHIVE_DIR', None) or os.path.join(settings.BASE_DIR, 'archive'))
+
+
+def hot_cutoff(now):
+    """Readings older than this may have been moved to the archive, or None without a retention policy."""
+    retention_days = getattr(settings, 'SENSOR_DATA_RETENTION_DAYS', None)
+    return now - timedelta(days=retention_days) if retention_days else None
@@ -0,0 +1,58 @@
+import atexit
+import logging
+import threading
+import time
+import weakref
+
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+_buffers = weakref.WeakSet()
+
+
+class BackgroundFlusher:
+    """
+    Base class for the in-memory write buffers in this app. Subclasses implement
+    flush(); it is called every `flush_interval` seconds by a daemon thread that is
+    started on first use, and once more at interpreter exit.
+    """
+
+    name = 'buffer'
+
+    def __init__(self, flush_interval=30):
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._flusher = None
+        _buffers.add(self)
+
+    def flush(self):
+        raise NotImplementedError
+
+    def _ensure_flusher(self):
+        if self._flusher is not None and self._flusher.is_alive():
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher.is_alive():
+                return
+            self._flusher = threading.Thread(target=self._run, name=f'{self.name}-flusher', daemon=True)
+            self._flusher.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing {self.name}: {e}", exc_info=True)
+            finally:
+                connection.close() # This thread's own connection; don't hold it (or a lock) between flushes
+
+
+@atexit.register
+def _flush_all_on_exit():
+    for buffer in list(_buffers):
+        try:
+            buffer.flush()
+        except Exception as e:
+            logger.error(f"Error flushing {buffer.name} on shutdown: {e}", exc_info=True)
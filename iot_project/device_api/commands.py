@@ -0,0 +1,344 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+from django.utils import timezone
+
+from .buffers import BackgroundFlusher
+from .ingest import IngestError, parse_reading_timestamp
+from .models import CommandLog, DeviceCommandQueue
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncWakeup:
+    """An asyncio.Event that notify() can set from any thread, e.g. a sync view's on_commit hook."""
+
+    def __init__(self):
+        self._loop = asyncio.get_running_loop()
+        self._event = asyncio.Event()
+
+    def set(self):
+        try:
+            self._loop.call_soon_threadsafe(self._event.set)
+        except RuntimeError:
+            pass # The waiter's event loop is already closed
+
+    def clear(self):
+        self._event.clear()
+
+    async def wait(self, timeout):
+        """Returns True if woken within `timeout` seconds."""
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+
+class CommandNotifier:
+    """
+    Wakes long-polling DeviceCommandPoll requests in this process when a command is
+    queued for their device. Commands queued by another process are picked up by
+    the waiter's periodic re-check instead (COMMAND_LONG_POLL_RECHECK).
+    """
+
+    def __init__(self):
+        self._waiters = {} # device id -> set of threading.Event or AsyncWakeup
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def listen(self, device_id, event=None):
+        """Registers a waiter for the device: a threading.Event, or `event` (an AsyncWakeup for async views)."""
+        event = event or threading.Event()
+        with self._lock:
+            self._waiters.setdefault(device_id, set()).add(event)
+        try:
+            yield event
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(device_id)
+                if waiters is not None:
+                    waiters.discard(event)
+                    if not waiters:
+                        del self._waiters[device_id]
+
+    def notify(self, device_id):
+        with self._lock:
+            waiters = list(self._waiters.get(device_id, ()))
+        for event in waiters:
+            event.set()
+
+
+command_notifier = CommandNotifier()
+
+
+def parse_wait(value):
+    """Parses the ?wait= long-poll timeout, clamped to COMMAND_LONG_POLL_MAX_WAIT seconds."""
+    if value in (None, ''):
+        return 0
+    wait = float(value)
+    if wait != wait: # NaN
+        raise ValueError('wait must be a number of seconds.')
+    return max(0.0, min(wait, getattr(settings, 'COMMAND_LONG_POLL_MAX_WAIT', 30)))
+
+
+def parse_max_commands(value):
+    """Parses ?max_commands=N, clamped to COMMAND_POLL_MAX_BATCH. None means the single-command response."""
+    if value in (None, ''):
+        return None
+    max_commands = int(value)
+    if max_commands < 1:
+        raise ValueError('max_commands must be a positive integer.')
+    return min(max_commands, getattr(settings, 'COMMAND_POLL_MAX_BATCH', 10))
+
+
+def claim_commands(device_id, limit=1):
+    """
+    Atomically claims up to `limit` of the oldest pending commands for a device and
+    marks them as delivered. Each command is handed to exactly one caller, even when
+    the same device polls concurrently (e.g. a retried request).
+    """
+    pending = DeviceCommandQueue.objects.filter(device_id=device_id, is_pending=True).order_by('created_at')
+    delivered_at = timezone.now()
+
+    if connection.features.has_select_for_update_skip_locked:
+        # Postgres/MySQL: lock the rows we take; concurrent pollers skip them instead of waiting
+        with transaction.atomic():
+            commands = list(pending.select_for_update(skip_locked=True)[:limit])
+            if commands:
+                DeviceCommandQueue.objects.filter(pk__in=[command.pk for command in commands]).update(is_pending=False, delivered_at=delivered_at)
+    else:
+        # SQLite has no row locks. Read the candidates outside the transaction, then claim each
+        # with a conditional UPDATE: writers are serialized, so only one poll can flip a row.
+        # Keeping the SELECT out of the write transaction also avoids SQLite's read-to-write
+        # lock upgrade deadlock, which fails with "database is locked" without waiting.
+        candidates = list(pending[:limit])
+        commands = []
+        if candidates:
+            with transaction.atomic():
+                for command in candidates:
+                    if DeviceCommandQueue.objects.filter(pk=command.pk, is_pending=True).update(is_pending=False, delivered_at=delivered_at):
+                        commands.append(command)
+
+    for command in commands:
+        command.is_pending = False
+        command.delivered_at = delivered_at
+    return commands
+
+
+def next_commands(device_id, limit=1, wait=0):
+    """
+    Claims up to `limit` pending commands. With wait > 0 the call blocks for up to
+    `wait` seconds until one is queued. No transaction is held open while waiting.
+    """
+    commands = claim_commands(device_id, limit)
+    if commands or wait <= 0:
+        return commands
+
+    deadline = time.monotonic() + wait
+    recheck = getattr(settings, 'COMMAND_LONG_POLL_RECHECK', 2)
+    # Register before re-checking so a command queued in between can't be missed
+    with command_notifier.listen(device_id) as wakeup:
+        while True:
+            commands = claim_commands(device_id, limit)
+            if commands:
+                return commands
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            wakeup.wait(min(remaining, recheck))
+            wakeup.clear()
+
+
+def _claim_commands_pooled(device_id, limit):
+    # Runs on the event loop's shared executor: each of its threads keeps its own
+    # connection, so drop it the way the end of a request would (CONN_MAX_AGE)
+    close_old_connections()
+    return claim_commands(device_id, limit)
+
+
+async def anext_commands(device_id, limit=1, wait=0):
+    """
+    next_commands() for async views: a waiting poll parks on the event loop instead of
+    blocking a thread, so one ASGI process can keep thousands of long-polls open.
+    The claims don't go through the async ORM, which runs a request's queries on
+    that request's own thread and connection, keeping a database connection open
+    per waiting device; they share the loop's small default executor instead.
+    """
+    claim = sync_to_async(_claim_commands_pooled, thread_sensitive=False)
+    commands = await claim(device_id, limit)
+    if commands or wait <= 0:
+        return commands
+
+    deadline = time.monotonic() + wait
+    recheck = getattr(settings, 'COMMAND_LONG_POLL_RECHECK', 2)
+    with command_notifier.listen(device_id, AsyncWakeup()) as wakeup:
+        while True:
+            commands = await claim(device_id, limit)
+            if commands:
+                return commands
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            await wakeup.wait(min(remaining, recheck))
+            wakeup.clear()
+
+
+def parse_acks(acks_payload, now=None):
+    """
+    Validates command acknowledgements sent by a device, either to the ack endpoint
+    or piggy-backed on a data upload as 'command_acks'. Each ack is an object with
+    'command_id' and optional 'executed' (default true), 'executed_at' (ISO-8601 or
+    Unix epoch seconds, default now) and 'response'.
+    """
+    if isinstance(acks_payload, dict):
+        acks_payload = [acks_payload]
+    if not isinstance(acks_payload, list):
+        raise IngestError('command acknowledgements must be a JSON object or list.')
+
+    max_acks = getattr(settings, 'DEVICE_API_MAX_BATCH_SIZE', 500)
+    if len(acks_payload) > max_acks:
+        raise IngestError(f'Too many command acknowledgements in one request (max {max_acks}).')
+
+    now = now or timezone.now()
+    acks = []
+    for index, ack in enumerate(acks_payload):
+        try:
+            if not isinstance(ack, dict):
+                raise IngestError('each acknowledgement must be a JSON object.')
+            command_id = ack.get('command_id')
+            if isinstance(command_id, bool) or not isinstance(command_id, int):
+                raise IngestError('command_id must be an integer.')
+            executed = ack.get('executed', True)
+            if not isinstance(executed, bool):
+                raise IngestError('executed must be true or false.')
+            response = ack.get('response')
+            if response is not None and not isinstance(response, str):
+                raise IngestError('response must be a string.')
+            acks.append({
+                'command_id': command_id,
+                'executed': executed,
+                'executed_at': parse_reading_timestamp({'timestamp': ack.get('executed_at')}, now),
+                'response': response,
+            })
+        except IngestError as e:
+            raise IngestError(f'acks[{index}]: {e}')
+    return acks
+
+
+class CommandLogBuffer(BackgroundFlusher):
+    """
+    Collects command acknowledgements and writes them as CommandLog rows with one
+    bulk insert every `flush_interval` seconds, or as soon as `max_size` are pending.
+    """
+
+    name = 'command logs'
+
+    def __init__(self, flush_interval=5, max_size=200):
+        super().__init__(flush_interval)
+        self.max_size = max_size
+        self._pending = [] # (device id, ack dict)
+
+    def add(self, device_id, acks):
+        with self._lock:
+            self._pending.extend((device_id, ack) for ack in acks)
+            full = len(self._pending) >= self.max_size
+        if full or self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return 0
+        try:
+            return self._store(pending)
+        except Exception:
+            # Put the acks back ahead of any added meanwhile and retry next interval
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+
+    def _store(self, pending):
+        command_ids = {ack['command_id'] for _, ack in pending}
+        commands = DeviceCommandQueue.objects.in_bulk(command_ids)
+        # Devices retry acks they didn't get a response for; log each command once
+        already_logged = set(CommandLog.objects.filter(command_id__in=command_ids).values_list('command_id', flat=True))
+
+        logs = {}
+        for device_id, ack in pending:
+            command = commands.get(ack['command_id'])
+            if command is None or command.device_id != device_id:
+                logger.warning(f"Ignoring acknowledgement from device {device_id} for unknown command {ack['command_id']}")
+                continue
+            if command.pk in already_logged:
+                continue
+            logs[command.pk] = CommandLog(
+                device_id=device_id,
+                command=command,
+                command_type=command.command_type,
+                parameters=command.parameters,
+                executed=ack['executed'],
+                executed_at=ack['executed_at'] if ack['executed'] else None,
+                response=ack['response'],
+                queued_at=command.created_at,
+                delivered_at=command.delivered_at,
+            )
+        CommandLog.objects.bulk_create(logs.values())
+        return len(logs)
+
+
+command_log_buffer = CommandLogBuffer(
+    flush_interval=getattr(settings, 'COMMAND_LOG_FLUSH_INTERVAL', 5),
+    max_size=getattr(settings, 'COMMAND_LOG_BUFFER_SIZE', 200),
+)
+
+
+def _percentiles(values):
+    """Linear-interpolated p50/p90/p99 plus max of a list of seconds, or None when empty."""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def percentile(q):
+        position = (len(values) - 1) * q
+        lower = int(position)
+        upper = min(lower + 1, len(values) - 1)
+        return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+    return {'p50': percentile(0.5), 'p90': percentile(0.9), 'p99': percentile(0.99), 'max': values[-1], 'count': len(values)}
+
+
+def command_latency_stats(device_id, start_time, end_time=None):
+    """
+    Actuation latency percentiles, in seconds, for commands acknowledged in a window:
+    delivery (queued -> picked up by a poll), execution (picked up -> executed on the
+    device) and round_trip (queued -> executed). Acknowledgements reach CommandLog
+    through CommandLogBuffer, so the stats trail them by up to COMMAND_LOG_FLUSH_INTERVAL.
+    """
+    logs = CommandLog.objects.filter(
+        device_id=device_id, timestamp__gte=start_time, timestamp__lte=end_time or timezone.now(), executed=True,
+    ).exclude(queued_at=None).values_list('queued_at', 'delivered_at', 'executed_at')
+
+    delivery, execution, round_trip = [], [], []
+    for queued_at, delivered_at, executed_at in logs:
+        if delivered_at is not None:
+            delivery.append((delivered_at - queued_at).total_seconds())
+            if executed_at is not None:
+                execution.append((executed_at - delivered_at).total_seconds())
+        if executed_at is not None:
+            round_trip.append((executed_at - queued_at).total_seconds())
+
+    return {
+        'delivery': _percentiles(delivery),
+        'execution': _percentiles(execution),
+        'round_trip': _percentiles(round_trip),
+    }
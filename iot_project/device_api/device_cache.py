@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+
+# The only Device fields the hot device endpoints need. Anything else must come from the database.
+CachedDevice = namedtuple('CachedDevice', ['id', 'device_type'])
+
+
+class DeviceLookupCache:
+    """
+    Bounded, thread-safe LRU cache mapping device_api_key -> CachedDevice.
+
+    Entries expire after `ttl` seconds so that changes made by other worker
+    processes (which cannot reach this process's signal handlers) are picked up.
+    """
+
+    def __init__(self, max_size=1024, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() # device_api_key -> (CachedDevice, expires_at)
+        self._keys_by_id = {}         # device id -> device_api_key, for invalidation by pk
+        self._lock = threading.Lock()
+
+    def get(self, device_api_key):
+        with self._lock:
+            entry = self._entries.get(device_api_key)
+            if entry is None:
+                return None
+            device, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._remove(device_api_key)
+                return None
+            self._entries.move_to_end(device_api_key)
+            return device
+
+    def set(self, device_api_key, device):
+        if self.max_size <= 0:
+            return
+        cached = CachedDevice(device.id, device.device_type)
+        with self._lock:
+            self._remove(device_api_key)
+            self._remove_id(cached.id)
+            self._entries[device_api_key] = (cached, time.monotonic() + self.ttl)
+            self._keys_by_id[cached.id] = device_api_key
+            while len(self._entries) > self.max_size:
+                oldest_key, (oldest, _) = self._entries.popitem(last=False)
+                self._keys_by_id.pop(oldest.id, None)
+
+    def invalidate(self, device_api_key=None, device_id=None):
+        with self._lock:
+            if device_api_key is not None:
+                self._remove(device_api_key)
+            if device_id is not None:
+                self._remove_id(device_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_id.clear()
+
+    def _remove(self, device_api_key):
+        entry = self._entries.pop(device_api_key, None)
+        if entry is not None:
+            self._keys_by_id.pop(entry[0].id, None)
+
+    def _remove_id(self, device_id):
+        device_api_key = self._keys_by_id.pop(device_id, None)
+        if device_api_key is not None:
+            self._entries.pop(device_api_key, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+device_cache = DeviceLookupCache(
+    max_size=getattr(settings, 'DEVICE_LOOKUP_CACHE_SIZE', 1024),
+    ttl=getattr(settings, 'DEVICE_LOOKUP_CACHE_TTL', 300),
+)
+
+
+def invalidate_devices(queryset):
+    """For bulk queryset.update() calls, which bypass the Device save signals."""
+    for device_id in queryset.values_list('pk', flat=True):
+        device_cache.invalidate(device_id=device_id)
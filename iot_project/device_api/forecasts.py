@@ -0,0 +1,101 @@
+import signal
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import close_old_connections
+from django.utils import timezone
+
+from core.models import Device
+from ml_models import forecast_series, get_metric_config, metric_series
+from .analysis import get_model_store, load_window, model_key, window_frame
+from .models import DeviceForecast
+
+
+class TimeBudgetExceeded(BaseException):
+    """
+    Raised inside a device's forecast when it runs over its time budget. A
+    BaseException, like KeyboardInterrupt, so the engine's per-model error
+    handling doesn't turn it into a 'could not generate forecast' suggestion.
+    """
+
+
+@contextmanager
+def time_budget(seconds):
+    """Interrupts the block after `seconds` with TimeBudgetExceeded. Only enforced on Unix, in the main thread."""
+    if not seconds or not hasattr(signal, 'SIGALRM') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def interrupt(signum, frame):
+        raise TimeBudgetExceeded(f"exceeded its {seconds}s time budget")
+
+    previous = signal.signal(signal.SIGALRM, interrupt)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+def forecast_device(device_id, duration_param):
+    """
+    Forecasts one device's metric over the analysis window. Returns a result dict
+    with 'status' ('ok', 'skipped' or 'error') and, when ok, what save_forecast() stores.
+    """
+    device = Device.objects.get(pk=device_id)
+    config = get_metric_config(device.device_type)
+    if config is None:
+        return {'device_id': device_id, 'status': 'skipped', 'reason': 'analysis not configured for this device type'}
+
+    window, _ = load_window(device, duration_param)
+    series = metric_series(window_frame(window, config.metric), config.metric)
+    if series is None or series.empty:
+        return {'device_id': device_id, 'status': 'skipped', 'reason': f'no {config.metric} readings in the last {duration_param}'}
+
+    result = forecast_series(series, config, context=f" on device {device_id}",
+                             store=get_model_store(), key=model_key(device_id, config.metric, duration_param))
+    return {
+        'device_id': device_id,
+        'status': 'ok',
+        'metric': config.metric,
+        'duration': duration_param,
+        'watermark': series.index.max().to_pydatetime(),
+        'predictions': result['predictions'],
+        'suggestions': result['suggestions'],
+    }
+
+
+def forecast_chunk(device_ids, duration_param, seconds_per_device=None):
+    """
+    Process pool task: forecasts a chunk of devices one after another, each under its
+    own time budget. One device failing or timing out doesn't affect the others.
+    Results are returned rather than saved so only the parent process writes.
+    """
+    results = []
+    for device_id in device_ids:
+        started = time.monotonic()
+        try:
+            with time_budget(seconds_per_device):
+                result = forecast_device(device_id, duration_param)
+        except TimeBudgetExceeded as e:
+            result = {'device_id': device_id, 'status': 'error', 'reason': str(e)}
+        except Exception as e:
+            result = {'device_id': device_id, 'status': 'error', 'reason': f"{type(e).__name__}: {e}"}
+        result['elapsed'] = time.monotonic() - started
+        results.append(result)
+    close_old_connections()
+    return results
+
+
+def save_forecast(result):
+    DeviceForecast.objects.update_or_create(
+        device_id=result['device_id'], metric=result['metric'], duration=result['duration'],
+        defaults={
+            'generated_at': timezone.now(),
+            'watermark': result['watermark'],
+            'predictions': result['predictions'],
+            'suggestions': result['suggestions'],
+        },
+    )
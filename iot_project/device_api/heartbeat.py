@@ -0,0 +1,79 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.utils import timezone
+
+from core.models import Device
+from .buffers import BackgroundFlusher
+
+
+class HeartbeatRecorder(BackgroundFlusher):
+    """
+    Coalesces device liveness updates in memory.
+
+    record() only remembers the newest last_seen per device. The pending values are
+    written with one bulk UPDATE every `flush_interval` seconds by a background
+    thread (and on interpreter exit), instead of one UPDATE per poll. With an
+    interval of 0 every record() is written through immediately.
+
+    Pending values are per process, so readers should go through apply() to see
+    the merged view of pending and stored liveness.
+    """
+
+    name = 'device heartbeats'
+
+    def __init__(self, flush_interval=30):
+        super().__init__(flush_interval)
+        self._pending = {} # device id -> newest last_seen not yet written
+
+    def record(self, device_id, seen_at=None):
+        seen_at = seen_at or timezone.now()
+        with self._lock:
+            previous = self._pending.get(device_id)
+            if previous is None or seen_at > previous:
+                self._pending[device_id] = seen_at
+        if self.flush_interval <= 0:
+            self.flush()
+        else:
+            self._ensure_flusher()
+
+    async def arecord(self, device_id, seen_at=None):
+        """record() for async views; with an interval of 0 the write-through runs in a worker thread."""
+        if self.flush_interval <= 0:
+            await sync_to_async(self.record)(device_id, seen_at)
+        else:
+            self.record(device_id, seen_at)
+
+    def pending_last_seen(self, device_id):
+        with self._lock:
+            return self._pending.get(device_id)
+
+    def apply(self, device):
+        """Overlays a pending heartbeat on a Device instance loaded from the database."""
+        seen_at = self.pending_last_seen(device.pk)
+        if seen_at is not None and (device.last_seen is None or seen_at > device.last_seen):
+            device.last_seen = seen_at
+            device.is_online = True
+        return device
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            Device.objects.bulk_update(
+                [Device(pk=device_id, is_online=True, last_seen=seen_at) for device_id, seen_at in pending.items()],
+                ['is_online', 'last_seen'],
+            )
+        except Exception:
+            # Put the heartbeats back (keeping any newer ones recorded meanwhile) and retry next interval
+            with self._lock:
+                for device_id, seen_at in pending.items():
+                    newer = self._pending.get(device_id)
+                    if newer is None or seen_at > newer:
+                        self._pending[device_id] = seen_at
+            raise
+        return len(pending)
+
+
+heartbeat = HeartbeatRecorder(flush_interval=getattr(settings, 'DEVICE_HEARTBEAT_FLUSH_INTERVAL', 30))
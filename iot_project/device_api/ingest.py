@@ -0,0 +1,242 @@
+import json
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from core.models import Device
+from .anomalies import anomaly_monitor, serialize_anomaly
+from .device_cache import device_cache
+from .ingest_buffer import reading_buffer
+from .models import DeviceLatestReading, SensorData
+from .pubsub import device_topic, get_broker
+
+
+class IngestError(ValueError):
+    """Raised when a device payload fails validation. The message is safe to return to the device."""
+
+
+def default_device_name(device_type, device_api_key):
+    return f"{device_type.replace('_', ' ').title()} Device ({device_api_key[:4]})"
+
+
+def resolve_device(device_api_key, device_type):
+    """
+    Returns the Device for device_api_key, creating it on first contact and
+    filling in the type/name for devices that were first seen by the command poll.
+    Must be called inside a transaction.
+    """
+    device, created = Device.objects.get_or_create(
+        device_api_key=device_api_key,
+        defaults={
+            'device_type': device_type,
+            'name': default_device_name(device_type, device_api_key),
+            'is_online': True, # Mark as online on data receive
+            'last_seen': timezone.now() # Update last_seen on data receive
+        }
+    )
+
+    if not created:
+        # If device already existed, update its properties
+        if not device.device_type or device.device_type == 'UNSET_TYPE':
+            device.device_type = device_type
+            device.name = default_device_name(device_type, device_api_key)
+            # Ensure is_online and last_seen are updated for existing devices
+            device.is_online = True
+            device.last_seen = timezone.now()
+            device.save() # CRITICAL: Save the device object after updating fields
+    return device
+
+
+def lookup_device(device_api_key, device_type):
+    """
+    Cached variant of resolve_device() for the ingest hot path. Returns a
+    CachedDevice (id and device_type only) without a SELECT when the key is cached.
+    """
+    device = device_cache.get(device_api_key)
+    if device is not None and device.device_type and device.device_type != 'UNSET_TYPE':
+        return device
+    with transaction.atomic():
+        device = resolve_device(device_api_key, device_type)
+        # Only cache once committed, so a rolled back get_or_create never leaves a dangling id behind
+        transaction.on_commit(lambda: device_cache.set(device_api_key, device))
+    return device
+
+
+def ingest_readings(device_api_key, device_type, readings):
+    """
+    Resolves the device and stores its (timestamp, sensor_data) readings in one
+    transaction, or hands them to the write-behind buffer with INGEST_BUFFER_ENABLED.
+    Returns the device.
+    """
+    if reading_buffer.enabled:
+        device = lookup_device(device_api_key, device_type)
+        reading_buffer.add(device, readings)
+        return device
+    with transaction.atomic():
+        device = lookup_device(device_api_key, device_type)
+        store_readings(device, readings)
+    return device
+
+
+def parse_sensor_payload(sensor_data_payload):
+    """Accepts sensor_data as a dict or a JSON-encoded object string and returns a dict."""
+    if not isinstance(sensor_data_payload, dict):
+        try:
+            sensor_data_payload = json.loads(sensor_data_payload)
+        except (TypeError, json.JSONDecodeError):
+            raise IngestError('sensor_data must be a valid JSON object or dict.')
+        if not isinstance(sensor_data_payload, dict):
+            raise IngestError('sensor_data must be a valid JSON object or dict.')
+    return sensor_data_payload
+
+
+def parse_reading_timestamp(reading, now):
+    """
+    Resolves the device-side time of a buffered reading.
+
+    A reading may carry either 'timestamp' (ISO-8601 string or Unix epoch seconds)
+    or 'age_ms' (milliseconds elapsed between the reading and the upload, for
+    devices without a synced clock). Readings with neither are stamped with `now`.
+    """
+    value = reading.get('timestamp')
+    age_ms = reading.get('age_ms')
+
+    if value is None and age_ms is None:
+        return now
+
+    if value is None:
+        if isinstance(age_ms, bool) or not isinstance(age_ms, (int, float)) or age_ms < 0:
+            raise IngestError('age_ms must be a non-negative number.')
+        return now - timedelta(milliseconds=age_ms)
+
+    if isinstance(value, bool):
+        raise IngestError('timestamp must be an ISO-8601 string or Unix epoch seconds.')
+    if isinstance(value, (int, float)):
+        try:
+            timestamp = datetime.fromtimestamp(value, tz=dt_timezone.utc)
+        except (OverflowError, OSError, ValueError):
+            raise IngestError('timestamp is out of range.')
+    elif isinstance(value, str):
+        try:
+            timestamp = parse_datetime(value)
+        except ValueError:
+            timestamp = None
+        if timestamp is None:
+            raise IngestError('timestamp must be an ISO-8601 string or Unix epoch seconds.')
+        if timezone.is_naive(timestamp):
+            timestamp = timezone.make_aware(timestamp, dt_timezone.utc)
+    else:
+        raise IngestError('timestamp must be an ISO-8601 string or Unix epoch seconds.')
+
+    max_skew = getattr(settings, 'DEVICE_API_MAX_CLOCK_SKEW', 300)
+    if timestamp > now + timedelta(seconds=max_skew):
+        raise IngestError('timestamp is in the future.')
+    return timestamp
+
+
+def parse_readings(readings_payload, now=None):
+    """
+    Validates a batch upload and returns a list of (timestamp, sensor_data) tuples.
+    The whole batch is rejected if any reading is invalid so devices can simply retry it.
+    """
+    if isinstance(readings_payload, str):
+        try:
+            readings_payload = json.loads(readings_payload)
+        except json.JSONDecodeError:
+            raise IngestError('readings must be a JSON list.')
+    if not isinstance(readings_payload, list):
+        raise IngestError('readings must be a JSON list.')
+    if not readings_payload:
+        raise IngestError('readings must contain at least one reading.')
+
+    max_batch_size = getattr(settings, 'DEVICE_API_MAX_BATCH_SIZE', 500)
+    if len(readings_payload) > max_batch_size:
+        raise IngestError(f'Too many readings in one batch (max {max_batch_size}).')
+
+    now = now or timezone.now()
+    readings = []
+    for index, reading in enumerate(readings_payload):
+        try:
+            if not isinstance(reading, dict):
+                raise IngestError('each reading must be a JSON object.')
+            if reading.get('sensor_data') is None:
+                raise IngestError('sensor_data is required.')
+            readings.append((parse_reading_timestamp(reading, now), parse_sensor_payload(reading['sensor_data'])))
+        except IngestError as e:
+            raise IngestError(f'readings[{index}]: {e}')
+    return readings
+
+
+def record_latest_reading(device, reading):
+    """
+    Upserts the DeviceLatestReading row for `reading` unless a newer one is already
+    stored (batches can arrive late or out of order). One UPDATE in the common case.
+    Returns True if `reading` is now the device's latest reading.
+    """
+    updated = DeviceLatestReading.objects.filter(device_id=device.id, timestamp__lte=reading.timestamp).update(
+        sensor_data_id=reading.id,
+        timestamp=reading.timestamp,
+        data=reading.data,
+    )
+    if not updated:
+        # Either the device has no row yet, or the stored one is newer and get_or_create leaves it alone
+        _, created = DeviceLatestReading.objects.get_or_create(
+            device_id=device.id,
+            defaults={'sensor_data_id': reading.id, 'timestamp': reading.timestamp, 'data': reading.data},
+        )
+        return created
+    return True
+
+
+def publish_event(device_id, event, payload):
+    """Pushes a live update to dashboard subscribers of this device (see dashboard.views.device_stream)."""
+    get_broker().publish(device_topic(device_id), {'event': event, 'payload': payload})
+
+
+def publish_reading(device, data, seen_at=None):
+    publish_event(device.id, 'reading', {
+        'device': {
+            'id': device.id,
+            'device_type': device.device_type,
+            'is_online': True,
+            'last_seen': (seen_at or timezone.now()).isoformat(),
+        },
+        'latest_data': data,
+    })
+
+
+def publish_heartbeat(device_id, seen_at=None):
+    publish_event(device_id, 'heartbeat', {
+        'device': {'id': device_id, 'is_online': True, 'last_seen': (seen_at or timezone.now()).isoformat()},
+    })
+
+
+def publish_anomalies(device_id, anomalies):
+    for anomaly in anomalies:
+        publish_event(device_id, 'anomaly', {
+            'device': {'id': device_id},
+            'anomaly': serialize_anomaly(anomaly),
+        })
+
+
+def store_readings(device, readings):
+    """
+    Writes (timestamp, sensor_data) tuples for a Device or CachedDevice with a single
+    bulk insert, refreshes the device's latest reading and runs the streaming anomaly
+    detector over the new readings. Must be called inside a transaction.
+    """
+    sensor_data = SensorData.objects.bulk_create([
+        SensorData(device_id=device.id, timestamp=timestamp, data=data).fill_typed_metrics()
+        for timestamp, data in readings
+    ])
+    newest = max(sensor_data, key=lambda reading: reading.timestamp)
+    if record_latest_reading(device, newest):
+        transaction.on_commit(lambda: publish_reading(device, newest.data))
+    # O(1) per reading; IsolationForest in the analysis view still covers the whole window
+    anomalies = anomaly_monitor.observe(device, sensor_data)
+    if anomalies:
+        transaction.on_commit(lambda: publish_anomalies(device.id, anomalies))
+    return sensor_data
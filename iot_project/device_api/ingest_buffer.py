@@ -0,0 +1,232 @@
+import glob
+import json
+import logging
+import os
+import uuid
+from datetime import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+
+from core.models import Device
+from .buffers import BackgroundFlusher
+from .device_cache import CachedDevice, device_cache
+from .models import SensorData
+
+logger = logging.getLogger(__name__)
+
+
+class IngestBufferFull(Exception):
+    """Raised when readings can't be accepted because the database has fallen too far behind."""
+
+
+class ReadingBuffer(BackgroundFlusher):
+    """
+    Write-behind buffer for the ingest endpoints. add() accepts validated readings
+    and returns at once. The readings are group-committed to SensorData with one
+    transaction every `flush_interval` seconds, or as soon as `max_rows` are
+    pending, so many uploads share each SQLite write lock and commit.
+
+    Acknowledged readings are lost if the process dies before the next flush,
+    unless `wal_dir` is set. Each process then appends them to its own log
+    segment (ingest-<id>-<seq>.wal) before acknowledging them, and deletes the
+    segments once the readings are committed. With `wal_fsync` the append is
+    fsynced as well, so the readings also survive a power loss. Segments left by
+    a process that died are replayed by the next process that opens its log.
+    Each process holds an flock on its ingest-<id>.lock, which marks its segments
+    as in use. This needs a POSIX system.
+    """
+
+    name = 'sensor readings'
+
+    def __init__(self, flush_interval=0.2, max_rows=500, max_pending=50000, wal_dir=None, wal_fsync=False, enabled=False):
+        super().__init__(flush_interval)
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.wal_dir = wal_dir
+        self.wal_fsync = wal_fsync
+        self.enabled = enabled
+        self._pending = [] # (CachedDevice, timestamp, data)
+        self._sealed = []  # Log segments holding pending readings, closed for writing
+        self._wal = None   # Open segment file
+        self._wal_path = None
+        self._wal_id = None
+        self._wal_seq = 0
+        self._lock_file = None
+
+    def add(self, device, readings):
+        """
+        Buffers (timestamp, sensor_data) tuples for a Device or CachedDevice.
+        Once this returns the readings are accepted: a failed flush is retried
+        by the background flusher.
+        """
+        device = CachedDevice(device.id, device.device_type)
+        with self._lock:
+            if len(self._pending) >= self.max_pending:
+                raise IngestBufferFull(f'{len(self._pending)} readings are waiting to be stored; try again later.')
+            if self.wal_dir:
+                self._append_wal(device, readings)
+            self._pending.extend((device, timestamp, data) for timestamp, data in readings)
+            full = len(self._pending) >= self.max_rows
+        if full:
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error flushing {self.name}: {e}", exc_info=True)
+        self._ensure_flusher()
+
+    def pending_count(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, []
+            sealed, self._sealed = self._sealed, []
+            if self._wal is not None:
+                # New readings go to a fresh segment while these are committed
+                self._wal.close()
+                sealed.append(self._wal_path)
+                self._wal = None
+        try:
+            pending = self._store(pending)
+        except Exception:
+            with self._lock:
+                self._pending[:0] = pending
+                self._sealed[:0] = sealed
+            raise
+        for path in sealed:
+            _remove(path)
+        return len(pending)
+
+    def _store(self, pending):
+        """Writes the readings in one transaction and returns those written."""
+        # Imported here: ingest.py imports this module
+        from .ingest import store_readings
+
+        try:
+            _store_grouped(store_readings, pending)
+        except IntegrityError:
+            # Most likely a device deleted since its readings were buffered; drop those and retry
+            device_ids = {device.id for device, _, _ in pending}
+            existing = set(Device.objects.filter(pk__in=device_ids).values_list('pk', flat=True))
+            if existing == device_ids:
+                raise
+            for device_id in device_ids - existing:
+                device_cache.invalidate(device_id=device_id)
+                logger.error(f"Dropping buffered readings of deleted device {device_id}")
+            pending = [entry for entry in pending if entry[0].id in existing]
+            _store_grouped(store_readings, pending)
+        return pending
+
+    # Write-ahead log
+
+    def _append_wal(self, device, readings):
+        # Called with self._lock held
+        if self._wal is None:
+            if self._lock_file is None:
+                self._acquire_wal()
+            self._wal_seq += 1
+            self._wal_path = os.path.join(self.wal_dir, f'ingest-{self._wal_id}-{self._wal_seq:06d}.wal')
+            self._wal = open(self._wal_path, 'a', encoding='utf-8')
+        self._wal.write(''.join(
+            json.dumps([device.id, device.device_type, timestamp.isoformat(), data]) + '\n' for timestamp, data in readings
+        ))
+        self._wal.flush()
+        if self.wal_fsync:
+            os.fsync(self._wal.fileno())
+
+    def _acquire_wal(self):
+        import fcntl
+
+        os.makedirs(self.wal_dir, exist_ok=True)
+        # Replay what dead processes left behind before logging anything new
+        replay_orphaned_segments(self.wal_dir)
+        self._wal_id = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        path = os.path.join(self.wal_dir, f'ingest-{self._wal_id}.lock')
+        # Locked under a temporary name, so a concurrent orphan scan never sees it unlocked
+        lock_file = open(path + '.new', 'w')
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        os.replace(path + '.new', path)
+        self._lock_file = lock_file
+
+
+def _store_grouped(store_readings, pending):
+    by_device = {}
+    for device, timestamp, data in pending:
+        by_device.setdefault(device, []).append((timestamp, data))
+    with transaction.atomic():
+        for device, readings in by_device.items():
+            store_readings(device, readings)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _read_segment(path):
+    entries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                device_id, device_type, timestamp, data = json.loads(line)
+            except ValueError:
+                # The last line of a segment is cut short if the process died mid-write
+                logger.warning(f"Skipping unreadable line in ingest log {path}")
+                continue
+            entries.append((CachedDevice(device_id, device_type), datetime.fromisoformat(timestamp), data))
+    return entries
+
+
+def replay_orphaned_segments(wal_dir):
+    """
+    Stores the readings logged by processes that died before committing them and
+    removes their segments. A process may have died after a commit but before it
+    removed the segment, so readings already stored for the device at the same
+    timestamp are skipped. Returns the number of readings stored.
+    """
+    import fcntl
+
+    from .ingest import store_readings
+
+    replayed = 0
+    for lock_path in glob.glob(os.path.join(wal_dir, 'ingest-*.lock')):
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue # Its process is alive
+            segments = sorted(glob.glob(lock_path[:-len('.lock')] + '-*.wal'))
+            entries = [entry for path in segments for entry in _read_segment(path)]
+
+            existing_devices = set(Device.objects.filter(pk__in={device.id for device, _, _ in entries}).values_list('pk', flat=True))
+            entries = [entry for entry in entries if entry[0].id in existing_devices]
+            stored = set()
+            for device_id in existing_devices:
+                timestamps = [timestamp for device, timestamp, _ in entries if device.id == device_id]
+                stored.update((device_id, timestamp) for timestamp in SensorData.objects.filter(
+                    device_id=device_id, timestamp__range=(min(timestamps), max(timestamps))).values_list('timestamp', flat=True))
+            entries = [entry for entry in entries if (entry[0].id, entry[1]) not in stored]
+            if entries:
+                _store_grouped(store_readings, entries)
+                logger.warning(f"Replayed {len(entries)} readings from {len(segments)} orphaned ingest log segments")
+                replayed += len(entries)
+            for path in segments:
+                _remove(path)
+            _remove(lock_path)
+    return replayed
+
+
+reading_buffer = ReadingBuffer(
+    flush_interval=getattr(settings, 'INGEST_BUFFER_FLUSH_INTERVAL', 0.2),
+    max_rows=getattr(settings, 'INGEST_BUFFER_MAX_ROWS', 500),
+    max_pending=getattr(settings, 'INGEST_BUFFER_MAX_PENDING', 50000),
+    wal_dir=getattr(settings, 'INGEST_BUFFER_WAL_DIR', None),
+    wal_fsync=getattr(settings, 'INGEST_BUFFER_WAL_FSYNC', False),
+    enabled=getattr(settings, 'INGEST_BUFFER_ENABLED', False),
+)
@@ -0,0 +1,44 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from device_api.archive import archive_old_readings, sensor_archive, vacuum
+
+
+class Command(BaseCommand):
+    help = ("Moves raw SensorData older than the retention period into compressed per-device, per-month "
+            "NPZ files under SENSOR_ARCHIVE_DIR, then deletes it from the database in chunks.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retention-days', type=int, default=getattr(settings, 'SENSOR_DATA_RETENTION_DAYS', None),
+                            help="Keep this many days of raw readings in the database (default and minimum: SENSOR_DATA_RETENTION_DAYS).")
+        parser.add_argument('--delete-chunk-size', type=int, default=getattr(settings, 'SENSOR_ARCHIVE_DELETE_CHUNK', 1000),
+                            help="Rows deleted per transaction once archived.")
+        parser.add_argument('--skip-rollup-check', action='store_true',
+                            help="Also archive rows compact_rollups hasn't processed yet (they will be missing from rollups).")
+        parser.add_argument('--vacuum', action='store_true',
+                            help="VACUUM the SQLite database afterwards so the file actually shrinks.")
+
+    def handle(self, *args, **options):
+        retention_days = getattr(settings, 'SENSOR_DATA_RETENTION_DAYS', None)
+        if not retention_days:
+            raise CommandError("Set SENSOR_DATA_RETENTION_DAYS: the analysis API only reads archived readings older than that.")
+        if options['retention_days'] is None or options['retention_days'] < retention_days:
+            # load_window() reads the archive only before hot_cutoff(), so anything newer would drop out of the analysis
+            raise CommandError(f"--retention-days must be at least SENSOR_DATA_RETENTION_DAYS ({retention_days}).")
+
+        started = time.monotonic()
+        cutoff = timezone.now() - timezone.timedelta(days=options['retention_days'])
+        archived, files = archive_old_readings(
+            sensor_archive, cutoff,
+            delete_chunk_size=options['delete_chunk_size'],
+            require_rolled_up=not options['skip_rollup_check'],
+            log=self.stdout.write,
+        )
+        if options['vacuum'] and archived:
+            vacuum()
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {archived} readings older than {cutoff:%Y-%m-%d %H:%M} into {files} files in {time.monotonic() - started:.1f}s"
+        ))
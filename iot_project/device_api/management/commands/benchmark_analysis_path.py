@@ -0,0 +1,79 @@
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from device_api.analysis import encode_window, window_frame
+from device_api.models import TYPED_METRICS, merge_typed_metrics
+from ml_models import metric_series, readings_to_frame
+from ml_models.utils import timestamp_micros
+
+
+def _synthetic_readings(n, rng):
+    """n power monitor readings ten seconds apart, both as values() rows and as payload_columns() columns."""
+    start = datetime(2026, 1, 1, tzinfo=dt_timezone.utc)
+    timestamps = [start + timedelta(seconds=10 * i, microseconds=i % 1000) for i in range(n)]
+    power = rng.normal(100, 5, n).tolist()
+    voltage = rng.normal(230, 2, n).tolist()
+    rows = [{'timestamp': t, 'data': {'relay_state': 'ON'}, **dict.fromkeys(TYPED_METRICS), 'power': p, 'voltage': v}
+            for t, p, v in zip(timestamps, power, voltage)]
+    columns = {'timestamp': tuple(timestamps), 'power': tuple(power), 'voltage': tuple(voltage),
+               'data': ({'relay_state': 'ON'},) * n}
+    return rows, columns
+
+
+def _payload_rows(rows):
+    """What payload_values() yields for values() rows: the typed columns merged back into each payload."""
+    return [{'timestamp': row['timestamp'], 'data': merge_typed_metrics(row['data'], row)} for row in rows]
+
+
+def _to_window(columns):
+    return {
+        'timestamp': timestamp_micros(columns['timestamp']),
+        'data': {metric: np.asarray(columns[metric], dtype=float) for metric in ('power', 'voltage')},
+        'extras': list(columns['data']),
+    }
+
+
+class Command(BaseCommand):
+    help = ("Times the analysis path's Python-level work on synthetic readings, row by row (dicts per "
+            "reading) versus columnar: building the metric series the models are fitted on, and "
+            "serializing the window for the API. No database access; models are not fitted.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 100_000, 1_000_000],
+                            help="Window sizes to time.")
+        parser.add_argument('--repeat', type=int, default=3, help="Runs per measurement; the fastest is reported.")
+
+    def _time(self, func, repeat):
+        best = None
+        for _ in range(repeat):
+            started = time.perf_counter()
+            func()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(0)
+        repeat = options['repeat']
+        for n in options['rows']:
+            rows, columns = _synthetic_readings(n, rng)
+            payload_rows = _payload_rows(rows)
+            window = _to_window(columns)
+            stages = (
+                ('series', lambda: metric_series(readings_to_frame(_payload_rows(rows)), 'power'),
+                 lambda: metric_series(window_frame(_to_window(columns), 'power'), 'power')),
+                ('data_points', lambda: [dict(entry, timestamp=entry['timestamp'].isoformat()) for entry in payload_rows],
+                 lambda: encode_window(window, n)),
+                ('columnar', lambda: [dict(entry, timestamp=entry['timestamp'].isoformat()) for entry in payload_rows],
+                 lambda: encode_window(window, n, 'columnar')),
+            )
+            for stage, rowwise, columnar in stages:
+                rowwise_time = self._time(rowwise, repeat)
+                columnar_time = self._time(columnar, repeat)
+                self.stdout.write(
+                    f"{n:>9} rows  {stage:<12} row-wise {rowwise_time:7.3f}s  columnar {columnar_time:7.3f}s  "
+                    f"({rowwise_time / columnar_time:.1f}x)"
+                )
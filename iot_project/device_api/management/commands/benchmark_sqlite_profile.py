@@ -0,0 +1,166 @@
+import multiprocessing
+import os
+import queue
+import random
+import shutil
+import tempfile
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from iot_project.sqlite_profile import DEPLOYMENTS, sqlite_profile_for
+
+OWNER = 'sqlite-benchmark'
+
+
+def _setup_django(database):
+    # Spawned processes start from a fresh interpreter: point 'default' at the benchmark database before setup
+    import django
+    settings.DATABASES['default'] = database
+    settings.INGEST_BUFFER_ENABLED = False # Measure the database, not the write-behind buffer
+    django.setup()
+
+
+def _prepare(database, devices, history):
+    """Migrates a fresh database and gives each device `history` readings over the last 24 hours."""
+    _setup_django(database)
+    from django.contrib.auth import get_user_model
+    from django.core.management import call_command
+    from django.db import transaction
+    from django.utils import timezone
+
+    from core.models import Device
+    from device_api.ingest import store_readings
+
+    call_command('migrate', verbosity=0, interactive=False)
+    owner = get_user_model().objects.create_user(OWNER)
+    now = timezone.now()
+    step = timedelta(hours=24) / max(history, 1)
+    with transaction.atomic():
+        for i in range(devices):
+            device = Device.objects.create(device_api_key=f'benchmark-{i:04d}', device_type='power_monitor',
+                                           name=f'Benchmark {i}', owner=owner, is_registered=True,
+                                           is_online=True, last_seen=now)
+            store_readings(device, [(now - (history - j) * step, {'power': 100.0 + j % 50, 'voltage': 230.0})
+                                    for j in range(history)])
+
+
+def _worker(role, database, devices, seconds, barrier, results):
+    """
+    Runs one kind of request in a loop for `seconds` and reports (role, completed,
+    "database is locked" errors, latencies). Connections are recycled around each
+    iteration the way Django does around a request, so CONN_MAX_AGE applies.
+    """
+    _setup_django(database)
+    from django.db import OperationalError, close_old_connections
+    from django.utils import timezone
+
+    from core.models import Device
+    from device_api.analysis import load_window
+    from device_api.ingest import ingest_readings
+
+    rng = random.Random(os.getpid())
+
+    def ingest():
+        key = f'benchmark-{rng.randrange(devices):04d}'
+        ingest_readings(key, 'power_monitor', [(timezone.now(), {'power': rng.uniform(50, 150), 'voltage': 230.0})])
+
+    def dashboard():
+        # The dashboard's polling of /api/v1/device/latest/ plus an analysis window read
+        list(Device.objects.filter(owner__username=OWNER, is_registered=True).select_related('latest_reading'))
+        load_window(Device.objects.get(device_api_key=f'benchmark-{rng.randrange(devices):04d}'), '24h')
+
+    request = ingest if role == 'ingest' else dashboard
+    completed = locked = 0
+    latencies = []
+    barrier.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        close_old_connections()
+        started = time.perf_counter()
+        try:
+            request()
+            completed += 1
+            latencies.append(time.perf_counter() - started)
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            locked += 1
+        close_old_connections()
+    results.put((role, completed, locked, latencies))
+
+
+def _percentile(values, q):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class Command(BaseCommand):
+    help = ("Measures concurrent ingest and dashboard throughput on a scratch SQLite database, with "
+            "the bare sqlite3 configuration and with the production profile for each SQLITE_PROFILE value "
+            "(iot_project/sqlite_profile.py). "
+            "Ingest processes store single readings the way /api/v1/device/data/ does; dashboard processes "
+            "run the latest-data query and load a 24h analysis window.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ingest-workers', type=int, default=4, help="Processes uploading readings.")
+        parser.add_argument('--dashboard-workers', type=int, default=4, help="Processes reading like the dashboard.")
+        parser.add_argument('--seconds', type=float, default=10, help="Duration of each run.")
+        parser.add_argument('--devices', type=int, default=20)
+        parser.add_argument('--history', type=int, default=500, help="Readings per device stored before the run.")
+        parser.add_argument('--profiles', nargs='+', choices=['bare', *DEPLOYMENTS], default=['bare', *DEPLOYMENTS])
+
+    def handle(self, *args, **options):
+        context = multiprocessing.get_context('spawn')
+        directory = tempfile.mkdtemp(prefix='sqlite-benchmark-')
+        try:
+            for profile in options['profiles']:
+                database = {'ENGINE': 'django.db.backends.sqlite3', 'NAME': os.path.join(directory, f'{profile}.sqlite3')}
+                database.update(sqlite_profile_for('' if profile == 'bare' else profile))
+
+                prepare = context.Process(target=_prepare, args=(database, options['devices'], options['history']))
+                prepare.start()
+                prepare.join()
+                if prepare.exitcode != 0:
+                    self.stderr.write(f"Preparing the {profile} database failed")
+                    return
+
+                roles = ['ingest'] * options['ingest_workers'] + ['dashboard'] * options['dashboard_workers']
+                barrier = context.Barrier(len(roles))
+                results = context.Queue()
+                workers = [context.Process(target=_worker, args=(role, database, options['devices'], options['seconds'], barrier, results))
+                           for role in roles]
+                for worker in workers:
+                    worker.start()
+                totals = {}
+                for _ in workers:
+                    try:
+                        role, completed, locked, latencies = results.get(timeout=options['seconds'] + 300)
+                    except queue.Empty:
+                        # A worker died (its traceback is above) and the others are stuck at the barrier
+                        for worker in workers:
+                            worker.terminate()
+                        self.stderr.write(f"The {profile} run did not finish")
+                        return
+                    total = totals.setdefault(role, [0, 0, []])
+                    total[0] += completed
+                    total[1] += locked
+                    total[2].extend(latencies)
+                for worker in workers:
+                    worker.join()
+
+                for role in ('ingest', 'dashboard'):
+                    if role not in totals:
+                        continue
+                    completed, locked, latencies = totals[role]
+                    self.stdout.write(
+                        f"{profile:<10} {role:<9} {completed / options['seconds']:8.0f} req/s  "
+                        f"{locked:6} locked  p50 {1000 * _percentile(latencies, 0.5):7.1f} ms  "
+                        f"p99 {1000 * _percentile(latencies, 0.99):7.1f} ms"
+                    )
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,25 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from device_api.rollups import compact
+
+
+class Command(BaseCommand):
+    help = ("Folds new SensorData rows into the 1-minute/1-hour/1-day rollups used by the analysis API. "
+            "Run from cron (e.g. every minute); only run one at a time. SQLite only (see rollups.compact).")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'ROLLUP_BATCH_SIZE', 5000),
+                            help="SensorData rows folded per transaction.")
+
+    def handle(self, *args, **options):
+        started = time.monotonic()
+        total = 0
+        while True:
+            compacted = compact(options['batch_size'])
+            total += compacted
+            if compacted < options['batch_size']: # Caught up; don't chase live ingest forever
+                break
+        self.stdout.write(self.style.SUCCESS(f"Rolled up {total} readings in {time.monotonic() - started:.1f}s"))
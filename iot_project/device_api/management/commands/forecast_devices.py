@@ -0,0 +1,74 @@
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.utils import timezone
+
+from core.models import Device
+from device_api.analysis import DURATIONS, duration_start
+from device_api.forecasts import forecast_chunk, save_forecast
+from ml_models import analysed_device_types
+
+
+class Command(BaseCommand):
+    help = ("Forecasts every active device whose type has a metric config (ml_models.metrics, ANALYSIS_METRIC_CONFIGS) "
+            "in a process pool and stores the results for the analysis API. Meant to be run from cron.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'FORECAST_WORKERS', None) or os.cpu_count(),
+                            help="Worker processes (default: FORECAST_WORKERS or the CPU count). 0 runs in this process.")
+        parser.add_argument('--chunk-size', type=int, default=getattr(settings, 'FORECAST_CHUNK_SIZE', 10),
+                            help="Devices handed to a worker per task.")
+        parser.add_argument('--time-budget', type=float, default=getattr(settings, 'FORECAST_DEVICE_TIME_BUDGET', 120),
+                            help="Seconds one device's forecast may take before it is abandoned (0 = no limit).")
+        parser.add_argument('--duration', choices=DURATIONS, default='24h',
+                            help="Training window; devices without a reading in it are skipped.")
+
+    def handle(self, *args, **options):
+        duration = options['duration']
+        chunk_size = max(1, options['chunk_size'])
+        started = timezone.now()
+
+        device_ids = list(Device.objects.filter(
+            device_type__in=analysed_device_types(),
+            latest_reading__timestamp__gte=duration_start(duration, started),
+        ).order_by('pk').values_list('pk', flat=True))
+        chunks = [device_ids[i:i + chunk_size] for i in range(0, len(device_ids), chunk_size)]
+        self.stdout.write(f"Forecasting {len(device_ids)} devices ({duration} window) in {len(chunks)} chunks with {options['workers']} workers")
+
+        counts = {'ok': 0, 'skipped': 0, 'error': 0}
+
+        def collect(results):
+            for result in results:
+                if result['status'] == 'ok':
+                    save_forecast(result)
+                else:
+                    self.stderr.write(f"Device {result['device_id']}: {result['status']} ({result['reason']})")
+                counts[result['status']] += 1
+
+        if options['workers'] <= 0:
+            for chunk in chunks:
+                collect(forecast_chunk(chunk, duration, options['time_budget']))
+        else:
+            # Spawned workers start from a fresh interpreter and set Django up themselves
+            # (DJANGO_SETTINGS_MODULE is inherited), each with its own database connection
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context('spawn'),
+                                     initializer=django.setup) as pool:
+                futures = {pool.submit(forecast_chunk, chunk, duration, options['time_budget']): chunk for chunk in chunks}
+                for future in as_completed(futures):
+                    try:
+                        collect(future.result())
+                    except Exception as e:
+                        # e.g. a worker died (BrokenProcessPool); count its chunk as failed
+                        self.stderr.write(f"Error forecasting devices {futures[future]}: {e}")
+                        counts['error'] += len(futures[future])
+
+        elapsed = (timezone.now() - started).total_seconds()
+        self.stdout.write(self.style.SUCCESS(
+            f"Done in {elapsed:.1f}s: {counts['ok']} forecast, {counts['skipped']} skipped, {counts['error']} failed"
+        ))
@@ -0,0 +1,132 @@
+import logging
+import multiprocessing
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from device_api.analysis_queue import (claim_analysis_jobs, finish_analysis_job, release_analysis_jobs,
+                                       requeue_stalled_jobs, run_analysis_job)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ("Runs the analysis jobs queued by the analysis API (DEVICE_ANALYSIS_RUNNER = 'worker') in a pool of "
+            "worker processes, so model fitting never runs inside a web worker. Runs until interrupted.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=getattr(settings, 'DEVICE_ANALYSIS_WORKERS', 2),
+                            help="Worker processes (default: DEVICE_ANALYSIS_WORKERS). 0 runs jobs in this process.")
+        parser.add_argument('--poll-interval', type=float, default=getattr(settings, 'ANALYSIS_WORKER_POLL_INTERVAL', 1.0),
+                            help="Seconds between checks for new jobs while idle.")
+        parser.add_argument('--time-budget', type=float, default=getattr(settings, 'ANALYSIS_JOB_TIME_BUDGET', 300),
+                            help="Seconds one job may take before it is failed (0 = no limit).")
+        parser.add_argument('--max-attempts', type=int, default=getattr(settings, 'ANALYSIS_JOB_MAX_ATTEMPTS', 3),
+                            help="Times a job interrupted by a worker crash is retried.")
+        parser.add_argument('--once', action='store_true', help="Exit once the queue is empty instead of waiting for jobs.")
+
+    def handle(self, *args, **options):
+        # Jobs still 'running' long after their budget ran out were orphaned by a previous worker
+        stalled_after = 2 * options['time_budget'] if options['time_budget'] > 0 else 3600
+        requeued, failed = requeue_stalled_jobs(stalled_after, options['max_attempts'])
+        if requeued or failed:
+            self.stdout.write(f"Requeued {requeued} and failed {failed} stalled jobs")
+
+        self.stdout.write(f"Analysis worker started with {options['workers']} workers")
+        counts = {'done': 0, 'failed': 0}
+        try:
+            if options['workers'] <= 0:
+                self._run_inline(options, counts)
+            else:
+                self._run_pool(options, counts)
+        except KeyboardInterrupt:
+            self.stdout.write("Interrupted")
+        self.stdout.write(self.style.SUCCESS(f"Stopped: {counts['done']} jobs done, {counts['failed']} failed"))
+
+    def _finish(self, job, result, error, counts):
+        finish_analysis_job(job, result, error)
+        counts[job.status] += 1
+        if error:
+            self.stderr.write(f"Job {job.pk} (device {job.device_id}, {job.duration}) failed: {error}")
+
+    def _run_inline(self, options, counts):
+        while True:
+            jobs = claim_analysis_jobs(1)
+            if not jobs:
+                if options['once']:
+                    return
+                close_old_connections()
+                time.sleep(options['poll_interval'])
+                continue
+            job = jobs[0]
+            result, error = run_analysis_job(job.device_id, job.duration, options['time_budget'])
+            self._finish(job, result, error, counts)
+
+    def _start_pool(self, options):
+        # Spawned workers start from a fresh interpreter and set Django up themselves
+        # (DJANGO_SETTINGS_MODULE is inherited), each with its own database connection
+        return ProcessPoolExecutor(max_workers=options['workers'], mp_context=multiprocessing.get_context('spawn'),
+                                   initializer=django.setup)
+
+    def _run_pool(self, options, counts):
+        connections.close_all()
+        running = {} # Future -> AnalysisJob
+        pool = self._start_pool(options)
+        try:
+            while True:
+                broken = [] # Jobs lost with a worker process that died
+                for job in claim_analysis_jobs(options['workers'] - len(running)):
+                    try:
+                        running[pool.submit(run_analysis_job, job.device_id, job.duration, options['time_budget'])] = job
+                    except BrokenProcessPool:
+                        broken.append(job)
+                if not running and not broken:
+                    if options['once']:
+                        return
+                    close_old_connections()
+                    time.sleep(options['poll_interval'])
+                    continue
+                finished, _ = wait(running, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job = running.pop(future)
+                    try:
+                        result, error = future.result()
+                    except BrokenProcessPool:
+                        broken.append(job)
+                        continue
+                    except Exception as e:
+                        logger.error(f"Error running analysis job {job.pk}: {e}", exc_info=True)
+                        result, error = None, f"{type(e).__name__}: {e}"
+                    self._finish(job, result, error, counts)
+                if broken:
+                    pool = self._restart_pool(pool, running, broken, options, counts)
+        finally:
+            # Jobs this worker claimed but won't finish go back to the queue
+            for future in running:
+                future.cancel()
+            release_analysis_jobs(running.values())
+            pool.shutdown()
+
+    def _restart_pool(self, pool, running, broken, options, counts):
+        """
+        A worker process died (e.g. killed for running out of memory during a fit) and
+        took the pool with it. Every job still in the pool is lost and there is no
+        telling which one killed it, so each is retried until it has used up
+        --max-attempts: the culprit ends up failed, the others are redone.
+        """
+        pool.shutdown(wait=True, cancel_futures=True)
+        for future, job in list(running.items()):
+            del running[future]
+            if future.done() and not future.cancelled() and future.exception() is None:
+                self._finish(job, *future.result(), counts) # Finished before the pool broke
+            else:
+                broken.append(job)
+        requeued, failed = release_analysis_jobs(broken, options['max_attempts'], 'A worker process died while running the job.')
+        counts['failed'] += failed
+        self.stderr.write(f"A worker process died: requeued {requeued} and failed {failed} jobs; restarting the pool")
+        return self._start_pool(options)
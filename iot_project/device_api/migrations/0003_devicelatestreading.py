@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:53
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_customuser_address_customuser_date_of_birth_and_more'),
+        ('device_api', '0002_sensordata_timestamp_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceLatestReading',
+            fields=[
+                ('device', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='latest_reading', serialize=False, to='core.device')),
+                ('timestamp', models.DateTimeField()),
+                ('data', models.JSONField(help_text='Copy of the newest SensorData.data for this device')),
+                ('sensor_data', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='device_api.sensordata')),
+            ],
+            options={
+                'verbose_name': 'Device Latest Reading',
+                'verbose_name_plural': 'Device Latest Readings',
+            },
+        ),
+    ]
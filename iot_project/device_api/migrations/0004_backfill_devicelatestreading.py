@@ -0,0 +1,28 @@
+from django.db import migrations
+
+
+def backfill_latest_readings(apps, schema_editor):
+    SensorData = apps.get_model('device_api', 'SensorData')
+    DeviceLatestReading = apps.get_model('device_api', 'DeviceLatestReading')
+
+    latest_readings = []
+    for device_id in SensorData.objects.order_by().values_list('device_id', flat=True).distinct():
+        latest = SensorData.objects.filter(device_id=device_id).order_by('-timestamp', '-id').first()
+        latest_readings.append(DeviceLatestReading(
+            device_id=device_id,
+            sensor_data_id=latest.id,
+            timestamp=latest.timestamp,
+            data=latest.data,
+        ))
+    DeviceLatestReading.objects.bulk_create(latest_readings, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_api', '0003_devicelatestreading'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_latest_readings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_customuser_address_customuser_date_of_birth_and_more'),
+        ('device_api', '0004_backfill_devicelatestreading'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='sensordata',
+            index=models.Index(fields=['device', '-timestamp'], name='sensordata_device_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_customuser_address_customuser_date_of_birth_and_more'),
+        ('device_api', '0005_sensordata_device_ts_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='devicecommandqueue',
+            index=models.Index(condition=models.Q(('is_pending', True)), fields=['device', 'created_at'], name='cmdqueue_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_customuser_address_customuser_date_of_birth_and_more'),
+        ('device_api', '0006_devicecommandqueue_pending_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='commandlog',
+            name='command',
+            field=models.ForeignKey(blank=True, help_text='The queued command this log acknowledges', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='logs', to='device_api.devicecommandqueue'),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='delivered_at',
+            field=models.DateTimeField(blank=True, help_text='When the device picked the command up', null=True),
+        ),
+        migrations.AddField(
+            model_name='commandlog',
+            name='queued_at',
+            field=models.DateTimeField(blank=True, help_text='When the command was queued', null=True),
+        ),
+        migrations.AddField(
+            model_name='devicecommandqueue',
+            name='delivered_at',
+            field=models.DateTimeField(blank=True, help_text='When a poll claimed the command', null=True),
+        ),
+        migrations.AddIndex(
+            model_name='commandlog',
+            index=models.Index(fields=['device', '-timestamp'], name='commandlog_device_ts_idx'),
+        ),
+    ]
@@ -0,0 +1,35 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:06
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_customuser_address_customuser_date_of_birth_and_more'),
+        ('device_api', '0007_command_acknowledgements'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SensorAnomaly',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('timestamp', models.DateTimeField(help_text='Timestamp of the anomalous reading')),
+                ('metric', models.CharField(help_text="e.g., 'power', 'water_level'", max_length=50)),
+                ('value', models.FloatField()),
+                ('expected', models.FloatField(help_text='Moving average just before this reading')),
+                ('score', models.FloatField(help_text='z-score of the reading against the moving average')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='anomalies', to='core.device')),
+                ('sensor_data', models.ForeignKey(blank=True, db_constraint=False, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='device_api.sensordata')),
+            ],
+            options={
+                'verbose_name': 'Sensor Anomaly',
+                'verbose_name_plural': 'Sensor Anomalies',
+                'ordering': ['-timestamp'],
+                'indexes': [models.Index(fields=['device', '-timestamp'], name='anomaly_device_ts_idx')],
+            },
+        ),
+    ]
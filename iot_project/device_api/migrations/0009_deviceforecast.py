@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_customuser_address_customuser_date_of_birth_and_more'),
+        ('device_api', '0008_sensoranomaly'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceForecast',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('metric', models.CharField(help_text="e.g., 'power', 'water_level'", max_length=50)),
+                ('duration', models.CharField(help_text="Training window, e.g. '24h', '7d', '30d'", max_length=10)),
+                ('generated_at', models.DateTimeField()),
+                ('watermark', models.DateTimeField(help_text='Timestamp of the newest reading the forecast was fitted on')),
+                ('predictions', models.JSONField(help_text='Forecast points as returned by the analysis API')),
+                ('suggestions', models.JSONField(default=list, help_text='Forecast-based suggestions')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='forecasts', to='core.device')),
+            ],
+            options={
+                'verbose_name': 'Device Forecast',
+                'verbose_name_plural': 'Device Forecasts',
+                'constraints': [models.UniqueConstraint(fields=('device', 'metric', 'duration'), name='unique_device_forecast')],
+            },
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:10
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_customuser_address_customuser_date_of_birth_and_more'),
+        ('device_api', '0009_deviceforecast'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RollupCursor',
+            fields=[
+                ('name', models.CharField(max_length=50, primary_key=True, serialize=False)),
+                ('last_id', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SensorRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('resolution', models.CharField(choices=[('1m', '1 minute'), ('1h', '1 hour'), ('1d', '1 day')], max_length=2)),
+                ('bucket', models.DateTimeField(help_text='Start of the bucket (UTC)')),
+                ('metric', models.CharField(help_text="Key in SensorData.data, e.g. 'power'", max_length=50)),
+                ('count', models.PositiveIntegerField()),
+                ('min', models.FloatField()),
+                ('max', models.FloatField()),
+                ('mean', models.FloatField()),
+                ('last', models.FloatField(help_text='Value of the newest reading in the bucket')),
+                ('last_timestamp', models.DateTimeField()),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rollups', to='core.device')),
+            ],
+            options={
+                'verbose_name': 'Sensor Rollup',
+                'verbose_name_plural': 'Sensor Rollups',
+                'constraints': [models.UniqueConstraint(fields=('device', 'resolution', 'bucket', 'metric'), name='unique_sensor_rollup')],
+            },
+        ),
+    ]
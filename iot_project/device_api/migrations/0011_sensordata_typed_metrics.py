@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:12
+
+import device_api.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_api', '0010_sensor_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='sensordata',
+            name='current',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sensordata',
+            name='energy',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sensordata',
+            name='frequency',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sensordata',
+            name='power',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sensordata',
+            name='power_factor',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sensordata',
+            name='voltage',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='sensordata',
+            name='water_level',
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='sensordata',
+            name='data',
+            field=device_api.models.SensorPayloadField(help_text="JSON object containing sensor readings (e.g., {'voltage': 230, 'current': 1.5})"),
+        ),
+    ]
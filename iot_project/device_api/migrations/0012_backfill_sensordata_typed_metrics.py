@@ -0,0 +1,73 @@
+import math
+
+from django.db import migrations
+
+TYPED_METRICS = ('voltage', 'current', 'power', 'energy', 'frequency', 'power_factor', 'water_level')
+BATCH_SIZE = 2000
+
+
+def _column_value(value):
+    # Same rule as device_api.models.typed_metric_value at the time of this migration
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        return number if math.isfinite(number) else None
+    return None
+
+
+def _batches(SensorData):
+    last_pk = 0
+    while True:
+        batch = list(SensorData.objects.filter(pk__gt=last_pk).order_by('pk')[:BATCH_SIZE])
+        if not batch:
+            return
+        yield batch
+        last_pk = batch[-1].pk
+
+
+def move_metrics_to_columns(apps, schema_editor):
+    SensorData = apps.get_model('device_api', 'SensorData')
+    for batch in _batches(SensorData):
+        changed = []
+        for reading in batch:
+            if not isinstance(reading.data, dict):
+                continue
+            moved = False
+            for metric in TYPED_METRICS:
+                value = _column_value(reading.data.get(metric))
+                if value is not None:
+                    setattr(reading, metric, value)
+                    del reading.data[metric]
+                    moved = True
+            if moved:
+                changed.append(reading)
+        SensorData.objects.bulk_update(changed, ['data', *TYPED_METRICS])
+
+
+def move_metrics_to_json(apps, schema_editor):
+    SensorData = apps.get_model('device_api', 'SensorData')
+    for batch in _batches(SensorData):
+        changed = []
+        for reading in batch:
+            typed = {metric: getattr(reading, metric) for metric in TYPED_METRICS if getattr(reading, metric) is not None}
+            if typed:
+                reading.data = {**typed, **(reading.data or {})}
+                changed.append(reading)
+        SensorData.objects.bulk_update(changed, ['data'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('device_api', '0011_sensordata_typed_metrics'),
+    ]
+
+    operations = [
+        migrations.RunPython(move_metrics_to_columns, move_metrics_to_json),
+    ]
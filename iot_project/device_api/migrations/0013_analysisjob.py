@@ -0,0 +1,38 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:28
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0003_customuser_address_customuser_date_of_birth_and_more'),
+        ('device_api', '0012_backfill_sensordata_typed_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('duration', models.CharField(help_text="Analysis window, e.g. '24h', '7d', '30d'", max_length=10)),
+                ('metric', models.CharField(blank=True, help_text='Metric analysed; empty for unconfigured device types', max_length=50, null=True)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], default='queued', max_length=10)),
+                ('latest_reading_id', models.BigIntegerField(blank=True, help_text="Device's latest SensorData id when queued", null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('result', models.JSONField(blank=True, help_text='compute_analysis() result, JSON-encoded', null=True)),
+                ('error', models.TextField(blank=True, default='')),
+                ('device', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='analysis_jobs', to='core.device')),
+            ],
+            options={
+                'verbose_name': 'Analysis Job',
+                'verbose_name_plural': 'Analysis Jobs',
+                'indexes': [models.Index(fields=['status', 'created_at'], name='analysisjob_status_idx')],
+                'constraints': [models.UniqueConstraint(condition=models.Q(('status__in', ('queued', 'running'))), fields=('device', 'duration'), name='unique_active_analysis_job')],
+            },
+        ),
+    ]
@@ -1,12 +1,138 @@
+import math
+
 from django.db import models
+from django.db.models import Avg, Count, Max, Min
 from django.utils import timezone
 from core.models import Device # Import Device from core app
 
+# Readings stored in typed float columns on SensorData instead of the JSON payload
+TYPED_METRICS = ('voltage', 'current', 'power', 'energy', 'frequency', 'power_factor', 'water_level')
+
+
+def typed_metric_value(value):
+    """
+    The float stored in a typed column for a payload value, or None to keep it in the JSON.
+    Numeric strings ("230.5") are coerced like rollups and the anomaly detector read them;
+    booleans and non-finite strings ("nan", "inf") stay in the JSON as sent.
+    """
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            number = float(value)
+        except ValueError:
+            return None
+        return number if math.isfinite(number) else None
+    return None
+
+
+def merge_typed_metrics(extra_data, typed_values):
+    """Rebuilds a full payload from the JSON extras and a mapping of typed column values."""
+    data = {metric: typed_values[metric] for metric in TYPED_METRICS if typed_values.get(metric) is not None}
+    data.update(extra_data or {})
+    return data
+
+
+class SensorPayloadField(models.JSONField):
+    """
+    SensorData.data: holds the full payload in memory, but only writes the keys that
+    are not already stored in a typed column (see SensorData.fill_typed_metrics).
+    """
+
+    def pre_save(self, model_instance, add):
+        data = super().pre_save(model_instance, add)
+        if not isinstance(data, dict):
+            return data
+        return {key: value for key, value in data.items()
+                if not (key in TYPED_METRICS and getattr(model_instance, key, None) is not None)}
+
+
+class SensorDataQuerySet(models.QuerySet):
+    # The access patterns the views use; all of them are served by the (device, -timestamp) index
+
+    def for_device(self, device):
+        return self.filter(device=device).order_by('-timestamp')
+
+    def recent_for_device(self, device, limit=50):
+        return self.for_device(device)[:limit]
+
+    def window_for_device(self, device, start_time, end_time):
+        return self.filter(device=device, timestamp__gte=start_time, timestamp__lte=end_time).order_by('timestamp')
+
+    def payload_values(self, *fields):
+        """Like values(*fields, 'data'), with each row's typed columns merged back into 'data'."""
+        for row in self.values(*fields, 'data', *TYPED_METRICS):
+            typed_values = {metric: row.pop(metric) for metric in TYPED_METRICS}
+            row['data'] = merge_typed_metrics(row['data'], typed_values)
+            yield row
+
+    def payload_columns(self, *fields):
+        """
+        The rows as columns: {field: tuple of values} for each of `fields`, the typed
+        metrics (None where missing) and 'data', holding only the JSON extras. One
+        values_list() query transposed, without building a dict per row.
+        """
+        names = (*fields, *TYPED_METRICS, 'data')
+        rows = list(self.values_list(*names))
+        if not rows:
+            return {name: () for name in names}
+        return dict(zip(names, zip(*rows)))
+
+    def metric_summary(self, metrics=TYPED_METRICS):
+        """Count/min/max/mean per typed metric, aggregated in SQL. Metrics with no readings are left out."""
+        aggregates = {}
+        for metric in metrics:
+            aggregates[f'{metric}__count'] = Count(metric)
+            aggregates[f'{metric}__min'] = Min(metric)
+            aggregates[f'{metric}__max'] = Max(metric)
+            aggregates[f'{metric}__mean'] = Avg(metric)
+        result = self.order_by().aggregate(**aggregates)
+        return {
+            metric: {stat: result[f'{metric}__{stat}'] for stat in ('count', 'min', 'max', 'mean')}
+            for metric in metrics if result[f'{metric}__count']
+        }
+
 class SensorData(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='sensor_data')
-    timestamp = models.DateTimeField(auto_now_add=True)
+    # Defaults to arrival time; batch uploads set the device-side reading time explicitly
+    timestamp = models.DateTimeField(default=timezone.now)
     # Use JSONField to store generic sensor readings
-    data = models.JSONField(help_text="JSON object containing sensor readings (e.g., {'voltage': 230, 'current': 1.5})")
+    data = SensorPayloadField(help_text="JSON object containing sensor readings (e.g., {'voltage': 230, 'current': 1.5})")
+    # Core numeric readings, queryable and aggregatable in SQL. Stored here instead of in the JSON
+    voltage = models.FloatField(null=True, blank=True)
+    current = models.FloatField(null=True, blank=True)
+    power = models.FloatField(null=True, blank=True)
+    energy = models.FloatField(null=True, blank=True)
+    frequency = models.FloatField(null=True, blank=True)
+    power_factor = models.FloatField(null=True, blank=True)
+    water_level = models.FloatField(null=True, blank=True)
+
+    objects = SensorDataQuerySet.as_manager()
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Present the full payload, whichever part of it lives in typed columns
+        if 'data' in instance.__dict__ and all(metric in instance.__dict__ for metric in TYPED_METRICS):
+            instance.data = merge_typed_metrics(instance.data, instance.__dict__)
+        return instance
+
+    def fill_typed_metrics(self):
+        """Copies the numeric core readings in self.data into their typed columns."""
+        data = self.data if isinstance(self.data, dict) else {}
+        for metric in TYPED_METRICS:
+            setattr(self, metric, typed_metric_value(data.get(metric)))
+        return self
+
+    def save(self, *args, **kwargs):
+        self.fill_typed_metrics()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'data' in update_fields:
+            # The JSON is written without the typed keys, so the columns must be written with it
+            kwargs['update_fields'] = set(update_fields) | set(TYPED_METRICS)
+        super().save(*args, **kwargs)
 
     def __str__(self):
         return f"Sensor data from {self.device.name} at {self.timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
@@ -15,6 +141,144 @@ class SensorData(models.Model):
         verbose_name = "Sensor Data"
         verbose_name_plural = "Sensor Data"
         ordering = ['-timestamp']
+        indexes = [
+            # Every read filters by device and sorts or ranges on timestamp
+            models.Index(fields=['device', '-timestamp'], name='sensordata_device_ts_idx'),
+        ]
+
+class DeviceLatestReading(models.Model):
+    # One row per device, upserted by the ingest path so dashboards never aggregate over SensorData
+    device = models.OneToOneField(Device, on_delete=models.CASCADE, primary_key=True, related_name='latest_reading')
+    # Plain marker of which SensorData row this mirrors; no constraint so pruning history never touches this table
+    sensor_data = models.ForeignKey(SensorData, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name='+')
+    timestamp = models.DateTimeField()
+    data = models.JSONField(help_text="Copy of the newest SensorData.data for this device")
+
+    def __str__(self):
+        return f"Latest reading from {self.device.name} at {self.timestamp.strftime('%Y-%m-%d %H:%M:%S')}"
+
+    class Meta:
+        verbose_name = "Device Latest Reading"
+        verbose_name_plural = "Device Latest Readings"
+
+class SensorAnomaly(models.Model):
+    # Written by the streaming detector in the ingest path, seconds after the reading arrives
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='anomalies')
+    # Plain marker like DeviceLatestReading.sensor_data, so pruning history keeps the anomaly record
+    sensor_data = models.ForeignKey(SensorData, on_delete=models.DO_NOTHING, db_constraint=False, null=True, blank=True, related_name='+')
+    timestamp = models.DateTimeField(help_text="Timestamp of the anomalous reading")
+    metric = models.CharField(max_length=50, help_text="e.g., 'power', 'water_level'")
+    value = models.FloatField()
+    expected = models.FloatField(help_text="Moving average just before this reading")
+    score = models.FloatField(help_text="z-score of the reading against the moving average")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Anomalous {self.metric} {self.value} from {self.device.name} at {self.timestamp}"
+
+    class Meta:
+        verbose_name = "Sensor Anomaly"
+        verbose_name_plural = "Sensor Anomalies"
+        ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['device', '-timestamp'], name='anomaly_device_ts_idx'),
+        ]
+
+class DeviceForecast(models.Model):
+    # Written by `manage.py forecast_devices`; the analysis API serves these instead of fitting Prophet per request
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='forecasts')
+    metric = models.CharField(max_length=50, help_text="e.g., 'power', 'water_level'")
+    duration = models.CharField(max_length=10, help_text="Training window, e.g. '24h', '7d', '30d'")
+    generated_at = models.DateTimeField()
+    watermark = models.DateTimeField(help_text="Timestamp of the newest reading the forecast was fitted on")
+    predictions = models.JSONField(help_text="Forecast points as returned by the analysis API")
+    suggestions = models.JSONField(default=list, help_text="Forecast-based suggestions")
+
+    def __str__(self):
+        return f"{self.metric} forecast ({self.duration}) for {self.device.name} at {self.generated_at}"
+
+    class Meta:
+        verbose_name = "Device Forecast"
+        verbose_name_plural = "Device Forecasts"
+        constraints = [
+            models.UniqueConstraint(fields=['device', 'metric', 'duration'], name='unique_device_forecast'),
+        ]
+
+class SensorRollup(models.Model):
+    # Per-metric aggregates of SensorData over fixed buckets, maintained by `manage.py compact_rollups`
+    RESOLUTION_CHOICES = (
+        ('1m', '1 minute'),
+        ('1h', '1 hour'),
+        ('1d', '1 day'),
+    )
+
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='rollups')
+    resolution = models.CharField(max_length=2, choices=RESOLUTION_CHOICES)
+    bucket = models.DateTimeField(help_text="Start of the bucket (UTC)")
+    metric = models.CharField(max_length=50, help_text="Key in SensorData.data, e.g. 'power'")
+    count = models.PositiveIntegerField()
+    min = models.FloatField()
+    max = models.FloatField()
+    mean = models.FloatField()
+    last = models.FloatField(help_text="Value of the newest reading in the bucket")
+    last_timestamp = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.metric} {self.resolution} rollup for {self.device.name} at {self.bucket}"
+
+    class Meta:
+        verbose_name = "Sensor Rollup"
+        verbose_name_plural = "Sensor Rollups"
+        constraints = [
+            # Also the index every window read uses
+            models.UniqueConstraint(fields=['device', 'resolution', 'bucket', 'metric'], name='unique_sensor_rollup'),
+        ]
+
+class RollupCursor(models.Model):
+    # How far the compactor has read SensorData, by primary key
+    name = models.CharField(max_length=50, primary_key=True)
+    last_id = models.BigIntegerField(default=0)
+
+    def __str__(self):
+        return f"{self.name} rolled up to id {self.last_id}"
+
+class AnalysisJob(models.Model):
+    # Queued by the analysis API and run by `manage.py run_analysis_worker`, so no web worker fits models.
+    # The newest finished job per device/window holds the result the API serves.
+    STATUS_CHOICES = (
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    )
+    ACTIVE_STATUSES = ('queued', 'running')
+
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='analysis_jobs')
+    duration = models.CharField(max_length=10, help_text="Analysis window, e.g. '24h', '7d', '30d'")
+    metric = models.CharField(max_length=50, null=True, blank=True, help_text="Metric analysed; empty for unconfigured device types")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='queued')
+    latest_reading_id = models.BigIntegerField(null=True, blank=True, help_text="Device's latest SensorData id when queued")
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    result = models.JSONField(null=True, blank=True, help_text="compute_analysis() result, JSON-encoded")
+    error = models.TextField(blank=True, default='')
+
+    def __str__(self):
+        return f"{self.duration} analysis of {self.device.name} ({self.status})"
+
+    class Meta:
+        verbose_name = "Analysis Job"
+        verbose_name_plural = "Analysis Jobs"
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='analysisjob_status_idx'),
+        ]
+        constraints = [
+            # At most one queued or running job per device and window; requests for it share that job
+            models.UniqueConstraint(fields=['device', 'duration'], condition=models.Q(status__in=('queued', 'running')),
+                                    name='unique_active_analysis_job'),
+        ]
 
 class CommandLog(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='command_logs')
@@ -24,6 +288,11 @@ class CommandLog(models.Model):
     executed = models.BooleanField(default=False, help_text="True if the device reported executing the command")
     executed_at = models.DateTimeField(null=True, blank=True)
     response = models.TextField(blank=True, null=True, help_text="Device's response to the command (optional)")
+    # Written when the device acknowledges a queued command; used for actuation latency reporting
+    command = models.ForeignKey('DeviceCommandQueue', on_delete=models.SET_NULL, null=True, blank=True, related_name='logs',
+                                help_text="The queued command this log acknowledges")
+    queued_at = models.DateTimeField(null=True, blank=True, help_text="When the command was queued")
+    delivered_at = models.DateTimeField(null=True, blank=True, help_text="When the device picked the command up")
 
     def __str__(self):
         return f"Command '{self.command_type}' for {self.device.name} at {self.timestamp}"
@@ -32,6 +301,9 @@ class CommandLog(models.Model):
         verbose_name = "Command Log"
         verbose_name_plural = "Command Logs"
         ordering = ['-timestamp']
+        indexes = [
+            models.Index(fields=['device', '-timestamp'], name='commandlog_device_ts_idx'),
+        ]
 
 class DeviceCommandQueue(models.Model):
     device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='command_queue')
@@ -39,6 +311,7 @@ class DeviceCommandQueue(models.Model):
     parameters = models.JSONField(blank=True, null=True, help_text="JSON parameters for the command")
     created_at = models.DateTimeField(auto_now_add=True)
     is_pending = models.BooleanField(default=True, help_text="True if command is waiting for device to poll")
+    delivered_at = models.DateTimeField(null=True, blank=True, help_text="When a poll claimed the command")
 
     def __str__(self):
         return f"Pending '{self.command_type}' for {self.device.name} (Created: {self.created_at})"
@@ -46,4 +319,10 @@ class DeviceCommandQueue(models.Model):
     class Meta:
         verbose_name = "Device Command in Queue"
         verbose_name_plural = "Device Command Queue"
-        ordering = ['created_at']
\ No newline at end of file
+        ordering = ['created_at']
+        indexes = [
+            # Partial index over pending rows only: the poll's (device, is_pending) lookup plus its
+            # created_at ordering, without delivered history bloating the index. is_pending is the
+            # index condition rather than a column, which also lets SQLite skip the ORDER BY sort.
+            models.Index(fields=['device', 'created_at'], condition=models.Q(is_pending=True), name='cmdqueue_pending_idx'),
+        ]
\ No newline at end of file
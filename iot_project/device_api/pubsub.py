@@ -0,0 +1,92 @@
+import asyncio
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+
+def device_topic(device_id):
+    return f"device:{device_id}"
+
+
+class Subscription:
+    """
+    A subscriber's mailbox. Created on (and read from) an asyncio event loop, but
+    deliver() may be called from any thread, e.g. a sync ingest view.
+    Slow consumers lose the oldest messages rather than growing without bound.
+    """
+
+    def __init__(self, broker, topics, maxsize=100):
+        self.broker = broker
+        self.topics = frozenset(topics)
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=maxsize)
+
+    def deliver(self, message):
+        try:
+            self._loop.call_soon_threadsafe(self._put, message)
+        except RuntimeError:
+            # The subscriber's event loop is gone without the stream having been closed
+            self.close()
+
+    def _put(self, message):
+        if self._queue.full():
+            self._queue.get_nowait()
+        self._queue.put_nowait(message)
+
+    async def get(self, timeout=None):
+        """Returns the next message, or None if nothing arrived within `timeout` seconds."""
+        try:
+            return await asyncio.wait_for(self._queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class InProcessBroker:
+    """
+    Fan-out to subscribers in the current process only. Fine for a single ASGI
+    process; multi-process deployments need a broker backend shared between
+    workers (see DEVICE_PUBSUB_BACKEND).
+    """
+
+    def __init__(self):
+        self._subscriptions = {} # topic -> set of Subscription
+        self._lock = threading.Lock()
+
+    def publish(self, topic, message):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(topic, ()))
+        for subscription in subscriptions:
+            subscription.deliver(message)
+
+    def subscribe(self, topics):
+        subscription = Subscription(self, topics)
+        with self._lock:
+            for topic in subscription.topics:
+                self._subscriptions.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscriptions.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscriptions[topic]
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                _broker = import_string(getattr(settings, 'DEVICE_PUBSUB_BACKEND', 'device_api.pubsub.InProcessBroker'))()
+    return _broker
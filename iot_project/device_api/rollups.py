@@ -0,0 +1,199 @@
+from datetime import datetime, timezone as dt_timezone
+
+import numpy as np
+from django.db import NotSupportedError, connection, transaction
+from django.db.models import F, Max, Min, Q, Sum
+
+import ml_models
+from .models import RollupCursor, SensorData, SensorRollup
+
+# Bucket sizes in seconds, finest first
+RESOLUTIONS = {
+    '1m': 60,
+    '1h': 3600,
+    '1d': 86400,
+}
+
+CURSOR_NAME = 'sensordata'
+
+
+def bucket_start(timestamp, seconds):
+    epoch = timestamp.timestamp()
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=dt_timezone.utc)
+
+
+def numeric_metrics(data):
+    """The (metric, float value) pairs of a SensorData.data payload that can be rolled up."""
+    if not isinstance(data, dict):
+        return
+    for metric, value in data.items():
+        if isinstance(value, bool):
+            continue
+        if isinstance(value, (int, float)):
+            yield metric, float(value)
+        elif isinstance(value, str):
+            try:
+                yield metric, float(value)
+            except ValueError:
+                continue
+
+
+def _aggregate(rows):
+    """Folds (device_id, timestamp, data) rows into {(device, resolution, bucket, metric): [count, min, max, sum, last, last_ts]}."""
+    aggregates = {}
+    for device_id, timestamp, data in rows:
+        for metric, value in numeric_metrics(data):
+            for resolution, seconds in RESOLUTIONS.items():
+                key = (device_id, resolution, bucket_start(timestamp, seconds), metric)
+                agg = aggregates.get(key)
+                if agg is None:
+                    aggregates[key] = [1, value, value, value, value, timestamp]
+                    continue
+                agg[0] += 1
+                agg[1] = min(agg[1], value)
+                agg[2] = max(agg[2], value)
+                agg[3] += value
+                if timestamp >= agg[5]:
+                    agg[4], agg[5] = value, timestamp
+    return aggregates
+
+
+def compact(batch_size=5000):
+    """
+    Folds the next `batch_size` SensorData rows past the cursor into the 1m/1h/1d
+    rollups and advances the cursor, all in one transaction, so each reading is
+    counted exactly once even if the compactor is interrupted. Readings that arrive
+    late (old timestamps) update their old buckets. Returns the number of rows read.
+    Run one compactor at a time.
+
+    SQLite only: the cursor assumes rows become visible in id order. SQLite has a
+    single writer, so an id is never committed after a higher one. Elsewhere a
+    transaction can commit a lower id after the cursor has passed it, and that
+    reading would never be rolled up.
+    """
+    if connection.vendor != 'sqlite':
+        raise NotSupportedError(f"Rollup compaction relies on SQLite's commit order and doesn't support {connection.vendor}.")
+    with transaction.atomic():
+        cursor, _ = RollupCursor.objects.get_or_create(name=CURSOR_NAME)
+        rows = list(SensorData.objects.filter(pk__gt=cursor.last_id).order_by('pk')[:batch_size]
+                    .payload_values('pk', 'device_id', 'timestamp'))
+        if not rows:
+            return 0
+
+        aggregates = _aggregate((row['device_id'], row['timestamp'], row['data']) for row in rows)
+
+        # Load the existing buckets this batch touches: per resolution, a bucket range over the batch's devices
+        existing_filter = Q()
+        for resolution in RESOLUTIONS:
+            keys = [key for key in aggregates if key[1] == resolution]
+            if keys:
+                existing_filter |= Q(
+                    resolution=resolution,
+                    device_id__in={key[0] for key in keys},
+                    bucket__gte=min(key[2] for key in keys),
+                    bucket__lte=max(key[2] for key in keys),
+                    metric__in={key[3] for key in keys},
+                )
+        existing = {
+            (rollup.device_id, rollup.resolution, rollup.bucket, rollup.metric): rollup
+            for rollup in SensorRollup.objects.filter(existing_filter)
+        }
+
+        to_create, to_update = [], []
+        for key, (count, low, high, total, last, last_timestamp) in aggregates.items():
+            rollup = existing.get(key)
+            if rollup is None:
+                device_id, resolution, bucket, metric = key
+                to_create.append(SensorRollup(
+                    device_id=device_id, resolution=resolution, bucket=bucket, metric=metric,
+                    count=count, min=low, max=high, mean=total / count, last=last, last_timestamp=last_timestamp,
+                ))
+                continue
+            rollup.mean = (rollup.mean * rollup.count + total) / (rollup.count + count)
+            rollup.count += count
+            rollup.min = min(rollup.min, low)
+            rollup.max = max(rollup.max, high)
+            if last_timestamp >= rollup.last_timestamp:
+                rollup.last, rollup.last_timestamp = last, last_timestamp
+            to_update.append(rollup)
+
+        SensorRollup.objects.bulk_create(to_create, batch_size=1000)
+        SensorRollup.objects.bulk_update(to_update, ['count', 'min', 'max', 'mean', 'last', 'last_timestamp'], batch_size=1000)
+
+        cursor.last_id = rows[-1]['pk']
+        cursor.save(update_fields=['last_id'])
+    return len(rows)
+
+
+def rollups_cover(device, start_time, end_time):
+    """True if the compactor has folded every reading the device has in the window into the rollups."""
+    last_id = RollupCursor.objects.filter(name=CURSOR_NAME).values_list('last_id', flat=True).first() or 0
+    return not SensorData.objects.window_for_device(device, start_time, end_time).filter(pk__gt=last_id).exists()
+
+
+def choose_resolution(device, start_time, end_time, max_points, archived_points=0, min_points=0):
+    """
+    'raw' when the window's readings (plus `archived_points` no longer in the database)
+    fit in `max_points`. Otherwise the finest rollup whose buckets over the span the
+    device actually has data for (its first reading in the window to `end_time`) fit
+    in `max_points`, provided the compactor has caught up with the window and the
+    rollup yields more than `min_points` buckets. If none qualifies this falls back to
+    'raw', and the caller reads only the newest `max_points` readings.
+    """
+    raw = SensorData.objects.window_for_device(device, start_time, end_time)
+    if archived_points + raw[:max_points + 1].count() <= max_points:
+        return 'raw'
+    # Archived readings are older than any in the database, so the window then starts at start_time
+    first = None if archived_points else raw.values_list('timestamp', flat=True).first()
+    span = (end_time - max(start_time, first or start_time)).total_seconds()
+    fitting = [resolution for resolution, seconds in RESOLUTIONS.items() if span / seconds <= max_points]
+    resolution = fitting[0] if fitting else list(RESOLUTIONS)[-1]
+    if not rollups_cover(device, start_time, end_time):
+        return 'raw' # The newest readings aren't rolled up yet; coarser tiers share the same cursor
+    buckets = SensorRollup.objects.filter(
+        device=device, resolution=resolution,
+        bucket__gte=bucket_start(start_time, RESOLUTIONS[resolution]), bucket__lte=end_time,
+    ).values('bucket').distinct()[:min_points + 1].count()
+    # A coarser tier would have even fewer buckets
+    return resolution if buckets > min_points else 'raw'
+
+
+def rollup_window(device, resolution, start_time, end_time):
+    """
+    A device's rollups for the window as columns, oldest bucket first: 'timestamp'
+    (bucket starts in microseconds since the epoch), 'data', 'min' and 'max' mapping
+    each metric to a float array of its bucket means/minimums/maximums (NaN where a
+    bucket has no reading of it), and 'count', the readings in each bucket.
+    """
+    rollups = list(SensorRollup.objects.filter(
+        device=device, resolution=resolution,
+        bucket__gte=bucket_start(start_time, RESOLUTIONS[resolution]), bucket__lte=end_time,
+    ).order_by('bucket').values_list('bucket', 'metric', 'mean', 'min', 'max', 'count'))
+    if not rollups:
+        return {'timestamp': np.empty(0, dtype=np.int64), 'data': {}, 'min': {}, 'max': {}, 'count': np.empty(0, dtype=np.int64)}
+
+    buckets, metrics, means, lows, highs, counts = (np.asarray(column) for column in zip(*rollups))
+    timestamps, position = np.unique(ml_models.timestamp_micros(buckets), return_inverse=True)
+    window = {'timestamp': timestamps, 'data': {}, 'min': {}, 'max': {}, 'count': np.zeros(len(timestamps), dtype=np.int64)}
+    np.maximum.at(window['count'], position, counts.astype(np.int64))
+    for metric in np.unique(metrics).tolist():
+        rows = metrics == metric
+        for key, values in (('data', means), ('min', lows), ('max', highs)):
+            column = np.full(len(timestamps), np.nan)
+            column[position[rows]] = values[rows].astype(float)
+            window[key][metric] = column
+    return window
+
+
+def rollup_summary(device, resolution, start_time, end_time):
+    """Count/min/max/mean per metric over the window's rollup buckets, aggregated in SQL."""
+    rows = SensorRollup.objects.filter(
+        device=device, resolution=resolution,
+        bucket__gte=bucket_start(start_time, RESOLUTIONS[resolution]), bucket__lte=end_time,
+    ).values('metric').annotate(
+        total_count=Sum('count'), low=Min('min'), high=Max('max'), total=Sum(F('mean') * F('count')),
+    ).order_by()
+    return {
+        row['metric']: {'count': row['total_count'], 'min': row['low'], 'max': row['high'], 'mean': row['total'] / row['total_count']}
+        for row in rows
+    }
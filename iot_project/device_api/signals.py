@@ -0,0 +1,22 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from core.models import Device
+from .commands import command_notifier
+from .device_cache import device_cache
+from .models import DeviceCommandQueue
+
+
+@receiver(post_save, sender=Device)
+@receiver(post_delete, sender=Device)
+def invalidate_device_lookup(sender, instance, **kwargs):
+    # Invalidate by pk as well, in case the save changed the device_api_key itself
+    device_cache.invalidate(device_api_key=instance.device_api_key, device_id=instance.pk)
+
+
+@receiver(post_save, sender=DeviceCommandQueue)
+def wake_long_polling_device(sender, instance, created, **kwargs):
+    # Covers control_device, the admin and anything else that queues a command
+    if created and instance.is_pending:
+        transaction.on_commit(lambda: command_notifier.notify(instance.device_id))
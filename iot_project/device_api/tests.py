@@ -1,3 +1,1316 @@
-from django.test import TestCase
+import asyncio
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import NotSupportedError, OperationalError, connection, transaction
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from core.admin import DeviceAdmin
+from core.models import Device
+from iot_project.sqlite_profile import sqlite_profile_for
+from ml_models import lttb_indices
+from ml_models.anomaly_detection import fit_isolation_forest, flag_anomalies
+from ml_models.engine import analyze_series, trained_models
+from ml_models.forecasting import fit_prophet, predict_prophet
+from ml_models.metrics import PowerMetric, WaterLevelMetric
+from ml_models.model_store import ModelArtifacts, ModelStore
+from .analysis import AnalysisCache, downsample_window, encode_window, load_window, parse_max_points
+from .analysis_queue import finish_analysis_job, result_from_json, result_to_json
+from .anomalies import StreamingAnomalyMonitor
+from .archive import SensorArchive, archive_old_readings
+from .commands import (CommandLogBuffer, _percentiles, claim_commands, command_latency_stats, command_log_buffer,
+                       command_notifier, parse_acks, parse_max_commands, parse_wait)
+from .device_cache import device_cache
+from .heartbeat import HeartbeatRecorder, heartbeat
+from .ingest import (IngestError, lookup_device, parse_reading_timestamp, parse_readings, publish_event,
+                     publish_heartbeat, publish_reading, record_latest_reading, store_readings)
+from .ingest_buffer import IngestBufferFull, ReadingBuffer, replay_orphaned_segments
+from .models import (AnalysisJob, CommandLog, DeviceCommandQueue, DeviceLatestReading, RollupCursor, SensorAnomaly,
+                     SensorData, SensorRollup, typed_metric_value)
+from .pubsub import InProcessBroker, device_topic
+from .rollups import CURSOR_NAME, compact, rollup_summary
+from .views import AsyncDeviceCommandPoll, AsyncDeviceDataReceive, AsyncDeviceOnboardingCheck
+
+
+class BatchIngestTests(TestCase):
+    def setUp(self):
+        self.now = timezone.now()
+
+    def test_timestamp_formats(self):
+        epoch = datetime(2026, 1, 2, 3, 4, 5, tzinfo=dt_timezone.utc)
+        self.assertEqual(parse_reading_timestamp({}, self.now), self.now)
+        self.assertEqual(parse_reading_timestamp({'timestamp': epoch.timestamp()}, self.now), epoch)
+        self.assertEqual(parse_reading_timestamp({'timestamp': '2026-01-02T03:04:05Z'}, self.now), epoch)
+        self.assertEqual(parse_reading_timestamp({'timestamp': '2026-01-02T03:04:05'}, self.now), epoch) # Naive means UTC
+        self.assertEqual(parse_reading_timestamp({'age_ms': 1500}, self.now), self.now - timedelta(milliseconds=1500))
+
+    def test_invalid_timestamps_are_rejected(self):
+        for reading in ({'timestamp': True}, {'timestamp': 'yesterday'}, {'timestamp': [1]}, {'timestamp': 1e20},
+                        {'age_ms': -1}, {'age_ms': '5'}, {'timestamp': (self.now + timedelta(hours=1)).isoformat()}):
+            with self.subTest(reading=reading), self.assertRaises(IngestError):
+                parse_reading_timestamp(reading, self.now)
+
+    def test_one_bad_reading_rejects_the_batch(self):
+        with self.assertRaisesMessage(IngestError, 'readings[1]: sensor_data is required.'):
+            parse_readings([{'sensor_data': {'power': 1}}, {'timestamp': 0}], self.now)
+        with self.assertRaisesMessage(IngestError, 'readings[0]: sensor_data must be a valid JSON object or dict.'):
+            parse_readings([{'sensor_data': '[1, 2]'}], self.now)
+        for payload in ([], {}, 'not json'):
+            with self.subTest(payload=payload), self.assertRaises(IngestError):
+                parse_readings(payload, self.now)
+        with override_settings(DEVICE_API_MAX_BATCH_SIZE=2), self.assertRaisesMessage(IngestError, 'max 2'):
+            parse_readings([{'sensor_data': {}}] * 3, self.now)
+
+    def test_batch_endpoint_stores_every_reading(self):
+        response = self.client.post('/api/v1/device/data/batch/', {
+            'device_api_key': 'batch-test-device',
+            'device_type': 'power_monitor',
+            'readings': [{'sensor_data': {'power': float(i)}, 'age_ms': 1000 * (3 - i)} for i in range(3)]
+                        + [{'sensor_data': '{"power": 9.0}', 'timestamp': '2026-01-02T03:04:05Z'}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 200, response.content)
+        self.assertEqual(response.json()['received'], 4)
+        device = Device.objects.get(device_api_key='batch-test-device')
+        stored = list(SensorData.objects.filter(device=device).order_by('timestamp').values_list('power', flat=True))
+        self.assertEqual(stored, [9.0, 0.0, 1.0, 2.0])
+        # The latest reading is the newest by device time, not the last in the batch
+        self.assertEqual(DeviceLatestReading.objects.get(device=device).data, {'power': 2.0})
+
+    def test_invalid_batch_writes_nothing(self):
+        response = self.client.post('/api/v1/device/data/batch/', {
+            'device_api_key': 'batch-test-device', 'device_type': 'power_monitor',
+            'readings': [{'sensor_data': {'power': 1.0}}, {'sensor_data': {'power': 2.0}, 'age_ms': -5}],
+        }, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('readings[1]', response.json()['error'])
+        self.assertFalse(Device.objects.filter(device_api_key='batch-test-device').exists())
+
+
+class DeviceCacheTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='cache-test-device', device_type='power_monitor')
+        device_cache.clear()
+        self.addCleanup(device_cache.clear)
+        with self.captureOnCommitCallbacks(execute=True):
+            lookup_device('cache-test-device', 'power_monitor')
+
+    def test_lookup_is_served_from_the_cache(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(lookup_device('cache-test-device', 'power_monitor').id, self.device.id)
+
+    def test_save_invalidates_the_cached_lookup(self):
+        self.device.device_api_key = 'cache-test-renamed'
+        self.device.save()
+        self.assertIsNone(device_cache.get('cache-test-device'))
+
+    def test_delete_invalidates_the_cached_lookup(self):
+        self.device.delete()
+        self.assertIsNone(device_cache.get('cache-test-device'))
+
+    def test_admin_action_invalidates_devices_it_filters_out(self):
+        Device.objects.filter(pk=self.device.pk).update(is_online=True)
+        # The changelist is filtered on is_online=True, which the action turns off
+        DeviceAdmin(Device, admin.site).mark_offline(None, Device.objects.filter(is_online=True))
+        self.assertIsNone(device_cache.get('cache-test-device'))
+
+
+class HeartbeatTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='heartbeat-test-device', device_type='power_monitor', is_online=False)
+        self.recorder = HeartbeatRecorder(flush_interval=3600)
+        self.addCleanup(self.recorder.flush) # Not at interpreter exit, against the real database
+        self.now = timezone.now()
+
+    def test_polls_are_coalesced_into_one_update(self):
+        other = Device.objects.create(device_api_key='heartbeat-test-other', device_type='power_monitor')
+        self.recorder.record(self.device.id, self.now - timedelta(seconds=5))
+        self.recorder.record(self.device.id, self.now)
+        self.recorder.record(self.device.id, self.now - timedelta(seconds=10)) # Late, older poll
+        self.recorder.record(other.id, self.now)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.recorder.flush(), 2)
+        self.device.refresh_from_db()
+        self.assertEqual((self.device.is_online, self.device.last_seen), (True, self.now))
+        self.assertEqual(self.recorder.flush(), 0)
+
+    def test_apply_merges_pending_and_stored_liveness(self):
+        self.recorder.record(self.device.id, self.now)
+        device = self.recorder.apply(Device.objects.get(pk=self.device.id))
+        self.assertEqual((device.is_online, device.last_seen), (True, self.now))
+
+        Device.objects.filter(pk=self.device.id).update(last_seen=self.now + timedelta(seconds=1))
+        device = self.recorder.apply(Device.objects.get(pk=self.device.id))
+        self.assertEqual(device.last_seen, self.now + timedelta(seconds=1))
+
+    def test_failed_flush_keeps_the_newest_heartbeat(self):
+        self.recorder.record(self.device.id, self.now - timedelta(seconds=5))
+        with mock.patch.object(Device.objects, 'bulk_update', side_effect=RuntimeError('database is locked')):
+            with self.assertRaises(RuntimeError):
+                self.recorder.flush()
+        self.assertEqual(self.recorder.pending_last_seen(self.device.id), self.now - timedelta(seconds=5))
+        self.recorder.record(self.device.id, self.now)
+        self.assertEqual(self.recorder.flush(), 1)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.last_seen, self.now)
+
+    def test_zero_interval_writes_through(self):
+        HeartbeatRecorder(flush_interval=0).record(self.device.id, self.now)
+        self.device.refresh_from_db()
+        self.assertEqual(self.device.last_seen, self.now)
+
+
+class LatestReadingTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='latest-test-device', device_type='power_monitor')
+        self.now = timezone.now()
+
+    def reading(self, seconds_ago, power):
+        return SensorData.objects.create(device=self.device, timestamp=self.now - timedelta(seconds=seconds_ago), data={'power': power})
+
+    def test_newer_reading_replaces_the_latest(self):
+        self.assertTrue(record_latest_reading(self.device, self.reading(10, 1.0)))
+        newer = self.reading(0, 2.0)
+        with self.assertNumQueries(1):
+            self.assertTrue(record_latest_reading(self.device, newer))
+        latest = DeviceLatestReading.objects.get(device=self.device)
+        self.assertEqual((latest.sensor_data_id, latest.data), (newer.id, {'power': 2.0}))
+
+    def test_late_reading_leaves_the_latest_alone(self):
+        newest = self.reading(0, 2.0)
+        record_latest_reading(self.device, newest)
+        self.assertFalse(record_latest_reading(self.device, self.reading(60, 1.0)))
+        self.assertEqual(DeviceLatestReading.objects.get(device=self.device).sensor_data_id, newest.id)
+
+    def test_store_readings_records_the_newest_of_a_batch(self):
+        store_readings(self.device, [(self.now, {'power': 3.0}), (self.now - timedelta(seconds=30), {'power': 1.0})])
+        store_readings(self.device, [(self.now - timedelta(seconds=10), {'power': 2.0})]) # Delayed batch
+        self.assertEqual(DeviceLatestReading.objects.get(device=self.device).data, {'power': 3.0})
+        self.assertEqual(DeviceLatestReading.objects.count(), 1)
+
+
+@unittest.skipUnless(connection.vendor == 'sqlite', 'Query plan assertions are written against SQLite EXPLAIN QUERY PLAN output.')
+class SensorDataQueryPlanTests(TestCase):
+    """
+    The dashboard and analysis views must stay index-only on SensorData: a full
+    table scan or a temp B-tree sort here makes 30-day windows unusable.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.device = Device.objects.create(device_api_key='plan-test-device', device_type='power_monitor')
+        other = Device.objects.create(device_api_key='plan-test-other', device_type='water_level')
+        now = timezone.now()
+        SensorData.objects.bulk_create(
+            [SensorData(device=cls.device, timestamp=now - timedelta(seconds=i), data={'power': i}) for i in range(200)]
+            + [SensorData(device=other, timestamp=now - timedelta(seconds=i), data={'water_level': i}) for i in range(200)]
+        )
+        DeviceLatestReading.objects.create(device=cls.device, timestamp=now, data={'power': 0})
+
+    def assertUsesIndex(self, queryset):
+        plan = queryset.explain()
+        self.assertNotIn('SCAN device_api_sensordata', plan)
+        self.assertNotIn('USE TEMP B-TREE', plan)
+        return plan
+
+    def test_analysis_window_query(self):
+        # DeviceAnalysisAPIView
+        end_time = timezone.now()
+        queryset = SensorData.objects.window_for_device(self.device, end_time - timedelta(days=30), end_time)
+        plan = self.assertUsesIndex(queryset.values('timestamp', 'data'))
+        self.assertIn('sensordata_device_ts_idx', plan)
+
+    def test_recent_readings_query(self):
+        # device_detail and device_analysis_page
+        plan = self.assertUsesIndex(SensorData.objects.recent_for_device(self.device, 50))
+        self.assertIn('sensordata_device_ts_idx', plan)
+
+    def test_latest_reading_query(self):
+        # DeviceLatestDataRetrieve reads the materialized row; the SensorData fallback must stay indexed too
+        self.assertUsesIndex(SensorData.objects.for_device(self.device)[:1])
+        plan = DeviceLatestReading.objects.filter(device_id=self.device.id).explain()
+        self.assertNotIn('SCAN', plan)
+
+
+class LatestDataListTests(TestCase):
+    url = '/api/v1/device/latest/'
+
+    def setUp(self):
+        User = get_user_model()
+        self.user = User.objects.create_user('latest-owner', password='pw')
+        self.other = User.objects.create_user('latest-other', password='pw')
+        self.devices = [
+            Device.objects.create(device_api_key=f'latest-list-{i}', name=f'Device {i}', owner=self.user, is_registered=True,
+                                  device_type='power_monitor', last_seen=timezone.now(), is_online=True)
+            for i in range(3)
+        ]
+        self.foreign = Device.objects.create(device_api_key='latest-list-foreign', owner=self.other, is_registered=True)
+        DeviceLatestReading.objects.create(device=self.devices[0], timestamp=timezone.now(), data={'power': 42.0, 'relay_state': True})
+        self.client.force_login(self.user)
+
+    def device_ids(self, response):
+        return sorted(item['device']['id'] for item in response.json()['devices'])
+
+    def test_lists_only_the_users_devices(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.device_ids(response), sorted(device.id for device in self.devices))
+
+        self.client.logout()
+        self.assertIn(self.client.get(self.url).status_code, (401, 403))
+
+    def test_ids_filter(self):
+        ids = f'{self.devices[0].id},{self.devices[2].id},{self.foreign.id},999999'
+        response = self.client.get(self.url, {'ids': ids})
+        # Other users' and unknown ids are left out, not an error
+        self.assertEqual(self.device_ids(response), [self.devices[0].id, self.devices[2].id])
+        for ids in ('1,x', 'abc', '1;2'):
+            with self.subTest(ids=ids):
+                self.assertEqual(self.client.get(self.url, {'ids': ids}).status_code, 400)
+
+    def test_one_request_serves_every_card(self):
+        # The dashboard updates each card from this list (updateDeviceCard in dashboard.html)
+        response = self.client.get(self.url, {'ids': ','.join(str(device.id) for device in self.devices)})
+        items = {item['device']['id']: item for item in response.json()['devices']}
+        item = items[self.devices[0].id]
+        self.assertEqual(item['latest_data'], {'power': 42.0, 'relay_state': True})
+        self.assertEqual(item['device']['device_type'], 'power_monitor')
+        self.assertTrue(item['device']['is_online'])
+        self.assertIsNotNone(item['device']['last_seen'])
+        self.assertEqual(items[self.devices[1].id]['latest_data'], {})
+
+        # A constant number of queries however many devices there are
+        with CaptureQueriesContext(connection) as one_device:
+            self.client.get(self.url, {'ids': self.devices[0].id})
+        with CaptureQueriesContext(connection) as three_devices:
+            self.client.get(self.url)
+        self.assertEqual(len(one_device), len(three_devices))
+
+
+class DeviceStreamTests(TestCase):
+    async def test_fan_out_to_every_subscriber(self):
+        broker = InProcessBroker()
+        first, second = broker.subscribe([device_topic(1)]), broker.subscribe([device_topic(1), device_topic(2)])
+        broker.publish(device_topic(1), {'event': 'reading'})
+        broker.publish(device_topic(2), {'event': 'heartbeat'})
+        self.assertEqual(await first.get(timeout=1), {'event': 'reading'})
+        self.assertIsNone(await first.get(timeout=0.05))
+        self.assertEqual([await second.get(timeout=1), await second.get(timeout=1)], [{'event': 'reading'}, {'event': 'heartbeat'}])
+
+        first.close()
+        broker.publish(device_topic(1), {'event': 'reading'})
+        await asyncio.sleep(0)
+        self.assertIsNone(await first.get(timeout=0.05))
+
+    async def test_slow_subscriber_loses_the_oldest_messages(self):
+        subscription = InProcessBroker().subscribe([device_topic(1)])
+        for i in range(150):
+            subscription.broker.publish(device_topic(1), i)
+        await asyncio.sleep(0) # Deliveries are scheduled on the subscriber's loop
+        self.assertEqual(await subscription.get(timeout=1), 50)
+
+    async def test_event_stream(self):
+        user = await sync_to_async(get_user_model().objects.create_user)('stream-owner', password='pw')
+        device = await Device.objects.acreate(device_api_key='stream-device', owner=user, is_registered=True)
+        await self.async_client.aforce_login(user)
+        response = await self.async_client.get('/dashboard/stream/')
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await anext(stream), b'retry: 5000\n\n')
+
+        now = timezone.now()
+        publish_reading(device, {'power': 5.0}, now)
+        publish_heartbeat(device.id, now)
+        publish_event(device.id, 'anomaly', {'device': {'id': device.id}, 'anomaly': {'metric': 'power'}})
+        events = [(await anext(stream)).decode() for _ in range(3)]
+        self.assertEqual([event.split('\n')[0] for event in events], ['event: reading', 'event: heartbeat', 'event: anomaly'])
+        self.assertTrue(all(event.endswith('\n\n') for event in events))
+        reading = json.loads(events[0].split('\n')[1][len('data: '):])
+        self.assertEqual(reading['latest_data'], {'power': 5.0})
+        self.assertEqual(reading['device']['id'], device.id)
+        await stream.aclose()
+
+    def test_wsgi_answers_no_content(self):
+        # The dashboard's EventSource then gives up and falls back to polling /api/v1/device/latest/
+        self.client.force_login(get_user_model().objects.create_user('stream-wsgi', password='pw'))
+        self.assertEqual(self.client.get('/dashboard/stream/').status_code, 204)
+
+
+@override_settings(COMMAND_LONG_POLL_MAX_WAIT=10)
+class CommandLongPollTests(TransactionTestCase):
+    # The command is queued from a second thread, i.e. over another database connection
+    url = '/api/v1/device/commands/?device_api_key=long-poll-device&wait='
+
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='long-poll-device', device_type='power_monitor')
+        self.addCleanup(heartbeat.flush)
+        self.addCleanup(cache.clear)
+
+    def queue_command_later(self, delay=0.3):
+        def queue():
+            DeviceCommandQueue.objects.create(device=self.device, command_type='reboot')
+            connection.close()
+
+        timer = threading.Timer(delay, queue)
+        timer.start()
+        self.addCleanup(timer.join)
+
+    def poll(self, wait):
+        started = time.monotonic()
+        body = self.client.get(self.url + str(wait)).json()
+        return body, time.monotonic() - started
+
+    @override_settings(COMMAND_LONG_POLL_RECHECK=30)
+    def test_queued_command_wakes_the_poll(self):
+        self.queue_command_later()
+        body, elapsed = self.poll(8)
+        self.assertEqual(body['command'], 'reboot')
+        self.assertLess(elapsed, 5) # Woken by the notifier, not the 30s re-check
+
+    def test_poll_times_out_empty(self):
+        body, elapsed = self.poll(0.3)
+        self.assertEqual(body, {'command': 'no_command'})
+        self.assertGreaterEqual(elapsed, 0.3)
+
+    @override_settings(COMMAND_LONG_POLL_RECHECK=0.2)
+    def test_recheck_finds_commands_queued_elsewhere(self):
+        # As if queued by another process: this process's notifier never hears of it
+        with mock.patch.object(command_notifier, 'notify'):
+            self.queue_command_later()
+            body, elapsed = self.poll(8)
+        self.assertEqual(body['command'], 'reboot')
+        self.assertLess(elapsed, 5)
+
+    def test_parse_wait(self):
+        self.assertEqual(parse_wait(None), 0)
+        self.assertEqual(parse_wait(''), 0)
+        self.assertEqual(parse_wait('2.5'), 2.5)
+        self.assertEqual(parse_wait('-3'), 0)
+        self.assertEqual(parse_wait('3600'), 10)
+        for value in ('nan', 'soon'):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_wait(value)
+
+
+class CommandClaimTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='claim-test-device', device_type='power_monitor')
+        self.commands = [DeviceCommandQueue.objects.create(device=self.device, command_type=f'command-{i}') for i in range(3)]
+        self.addCleanup(heartbeat.flush) # The poll endpoint records a heartbeat
+
+    def test_claims_oldest_first_and_only_once(self):
+        claimed = claim_commands(self.device.id, 2)
+        self.assertEqual([command.pk for command in claimed], [command.pk for command in self.commands[:2]])
+        self.assertTrue(all(not command.is_pending and command.delivered_at for command in claimed))
+        self.assertEqual([command.pk for command in claim_commands(self.device.id, 2)], [self.commands[2].pk])
+        self.assertEqual(claim_commands(self.device.id, 2), [])
+
+    @unittest.skipIf(connection.features.has_select_for_update_skip_locked, 'Exercises the conditional UPDATE used without row locks.')
+    def test_command_claimed_concurrently_is_skipped(self):
+        real_atomic = transaction.atomic
+
+        def atomic_after_concurrent_claim(*args, **kwargs):
+            # Another poll claims the oldest command between our SELECT and our UPDATE
+            DeviceCommandQueue.objects.filter(pk=self.commands[0].pk).update(is_pending=False)
+            return real_atomic(*args, **kwargs)
+
+        with mock.patch('device_api.commands.transaction.atomic', atomic_after_concurrent_claim):
+            claimed = claim_commands(self.device.id, 2)
+        self.assertEqual([command.pk for command in claimed], [self.commands[1].pk])
+
+    def test_max_commands(self):
+        self.assertIsNone(parse_max_commands(None))
+        with override_settings(COMMAND_POLL_MAX_BATCH=2):
+            self.assertEqual(parse_max_commands('5'), 2)
+        for value in ('0', '-1', 'x'):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_max_commands(value)
+
+    def test_poll_endpoint_batches(self):
+        url = '/api/v1/device/commands/?device_api_key=claim-test-device'
+        response = self.client.get(url + '&max_commands=2')
+        self.assertEqual([command['command'] for command in response.json()['commands']], ['command-0', 'command-1'])
+        self.assertEqual(self.client.get(url).json()['command'], 'command-2')
+        self.assertEqual(self.client.get(url + '&max_commands=2').json(), {'commands': []})
+        self.assertEqual(self.client.get(url).json(), {'command': 'no_command'})
+        self.assertEqual(self.client.get(url + '&max_commands=0').status_code, 400)
+
+
+class CommandAckTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='ack-test-device', device_type='power_monitor')
+        self.other = Device.objects.create(device_api_key='ack-test-other', device_type='power_monitor')
+        self.command = DeviceCommandQueue.objects.create(device=self.device, command_type='set_relay_state', is_pending=False)
+        self.buffer = CommandLogBuffer(flush_interval=60)
+
+    def test_retried_acks_are_logged_once(self):
+        acks = parse_acks({'command_id': self.command.id, 'response': 'ok'})
+        self.buffer.add(self.device.id, acks)
+        self.buffer.add(self.device.id, acks)
+        self.assertEqual(self.buffer.flush(), 1)
+        self.buffer.add(self.device.id, acks)
+        self.assertEqual(self.buffer.flush(), 0)
+        self.assertEqual(CommandLog.objects.filter(command=self.command).count(), 1)
+
+    def test_failed_flush_keeps_the_acks(self):
+        self.buffer.add(self.device.id, parse_acks({'command_id': self.command.id, 'response': 'ok'}))
+        with mock.patch.object(CommandLog.objects, 'bulk_create', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                self.buffer.flush()
+        later = DeviceCommandQueue.objects.create(device=self.device, command_type='reboot', is_pending=False)
+        self.buffer.add(self.device.id, parse_acks({'command_id': later.id}))
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(set(CommandLog.objects.values_list('command_id', flat=True)), {self.command.id, later.id})
+
+    def test_ack_for_another_devices_command_is_ignored(self):
+        self.buffer.add(self.other.id, parse_acks([{'command_id': self.command.id}]))
+        with self.assertLogs('device_api.commands', 'WARNING'):
+            self.assertEqual(self.buffer.flush(), 0)
+
+    def test_percentiles_interpolate(self):
+        stats = _percentiles([4.0, 1.0, 3.0, 2.0, 5.0])
+        self.assertEqual(stats, {'p50': 3.0, 'p90': 4.6, 'p99': 4.96, 'max': 5.0, 'count': 5})
+        self.assertIsNone(_percentiles([]))
+
+    def test_latency_stats(self):
+        now = timezone.now()
+        for seconds in (1, 2, 3):
+            CommandLog.objects.create(device=self.device, command_type='set_relay_state', executed=True,
+                                      queued_at=now - timedelta(seconds=10), delivered_at=now - timedelta(seconds=10 - seconds),
+                                      executed_at=now)
+        stats = command_latency_stats(self.device.id, now - timedelta(hours=1))
+        self.assertEqual(stats['delivery']['p50'], 2.0)
+        self.assertEqual(stats['execution']['max'], 9.0)
+        self.assertEqual(stats['round_trip']['count'], 3)
+
+    def test_latency_endpoint_does_not_flush_the_buffer(self):
+        command_log_buffer.add(self.device.id, parse_acks({'command_id': self.command.id}))
+        self.addCleanup(command_log_buffer.flush)
+        response = self.client.get(f'/api/v1/device/{self.device.id}/command_latency/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.json()['latency_seconds']['round_trip'])
+        self.assertEqual(CommandLog.objects.count(), 0)
+
+
+def _fake_analysis(power):
+    return {'suggestions': [f'power {power}'], 'window': {'timestamp': np.array([0, 1]), 'data': {'power': np.array([power, np.nan])}}}
+
+
+class AnalysisCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.device = Device.objects.create(device_api_key='analysis-cache-device', device_type='power_monitor')
+        self.analysis_cache = AnalysisCache(runner='worker', ttl=300)
+
+    def set_latest_reading(self, power):
+        reading = SensorData.objects.create(device=self.device, data={'power': power})
+        DeviceLatestReading.objects.update_or_create(device=self.device, defaults={
+            'sensor_data_id': reading.id, 'timestamp': reading.timestamp, 'data': reading.data})
+        return reading
+
+    def finish(self, job, power):
+        job = AnalysisJob.objects.get(pk=job.pk)
+        finish_analysis_job(job, result_to_json(_fake_analysis(power)))
+
+    def test_key_separates_devices_windows_and_metrics(self):
+        keys = {self.analysis_cache._key(1, '24h', 'power'), self.analysis_cache._key(2, '24h', 'power'),
+                self.analysis_cache._key(1, '7d', 'power'), self.analysis_cache._key(1, '24h', 'water_level')}
+        self.assertEqual(len(keys), 4)
+
+    def test_cold_cache_queues_one_job(self):
+        self.set_latest_reading(1.0)
+        result, stale, job = self.analysis_cache.get(self.device, '24h')
+        self.assertEqual((result, stale, job.status, job.metric), (None, True, 'queued', 'power'))
+        self.assertEqual(self.analysis_cache.get(self.device, '24h')[2].pk, job.pk)
+        self.assertEqual(AnalysisJob.objects.count(), 1)
+
+    def test_stale_result_is_served_while_a_refit_is_queued(self):
+        self.set_latest_reading(1.0)
+        _, _, job = self.analysis_cache.get(self.device, '24h')
+        self.finish(job, 1.0)
+        result, stale, refit = self.analysis_cache.get(self.device, '24h')
+        self.assertEqual((result['suggestions'], stale, refit), (['power 1.0'], False, None))
+
+        self.set_latest_reading(2.0) # A new reading makes the result stale
+        result, stale, refit = self.analysis_cache.get(self.device, '24h')
+        self.assertEqual((result['suggestions'], stale, refit.status), (['power 1.0'], True, 'queued'))
+        self.finish(refit, 2.0)
+        result, stale, _ = self.analysis_cache.get(self.device, '24h')
+        self.assertEqual((result['suggestions'], stale), (['power 2.0'], False))
+        self.assertTrue(np.isnan(result['window']['data']['power'][1]))
+
+    def test_expired_result_is_stale(self):
+        self.set_latest_reading(1.0)
+        _, _, job = self.analysis_cache.get(self.device, '24h')
+        self.finish(job, 1.0)
+        with mock.patch('device_api.analysis.timezone.now', return_value=timezone.now() + timedelta(seconds=301)):
+            _, stale, refit = self.analysis_cache.get(self.device, '24h')
+        self.assertTrue(stale)
+        self.assertIsNotNone(refit)
+
+
+class ThreadAnalysisCacheTests(TransactionTestCase):
+    # The 'thread' runner fits on a pool thread, which only sees committed rows
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.device = Device.objects.create(device_api_key='thread-cache-device', device_type='power_monitor')
+        self.analysis_cache = AnalysisCache(runner='thread', ttl=300, cold_wait=30)
+
+    def test_concurrent_refreshes_share_one_fit(self):
+        release = threading.Event()
+
+        def slow_fit(device, duration):
+            release.wait(30)
+            return _fake_analysis(1.0)
+
+        with mock.patch('device_api.analysis.compute_analysis', side_effect=slow_fit) as compute:
+            first = self.analysis_cache._refresh('key', self.device.id, '24h', None)
+            second = self.analysis_cache._refresh('key', self.device.id, '24h', None)
+            release.set()
+            self.assertIs(first, second)
+            self.assertEqual(first.result(timeout=30)['suggestions'], ['power 1.0'])
+        self.assertEqual(compute.call_count, 1)
+
+    def test_stale_results_are_served_during_a_refit(self):
+        with mock.patch('device_api.analysis.compute_analysis', side_effect=lambda device, duration: _fake_analysis(1.0)) as compute:
+            result, stale, _ = self.analysis_cache.get(self.device, '24h')
+            self.assertEqual((result['suggestions'], stale), (['power 1.0'], False))
+            self.assertEqual(self.analysis_cache.get(self.device, '24h')[1], False)
+            self.assertEqual(compute.call_count, 1)
+
+        DeviceLatestReading.objects.create(device=self.device, timestamp=timezone.now(), data={'power': 2.0}, sensor_data_id=123)
+        with mock.patch('device_api.analysis.compute_analysis', side_effect=lambda device, duration: _fake_analysis(2.0)):
+            result, stale, _ = self.analysis_cache.get(self.device, '24h')
+            self.assertEqual((result['suggestions'], stale), (['power 1.0'], True))
+            self.analysis_cache._executor.shutdown(wait=True) # Let the background refit finish
+        result, stale, _ = self.analysis_cache.get(self.device, '24h')
+        self.assertEqual((result['suggestions'], stale), (['power 2.0'], False))
+
+
+def _inline_view_analysis(df, metric):
+    """
+    The anomaly detection and forecast DeviceAnalysisAPIView ran inline before the
+    ml_models package, condensed. Returns (anomalous values, predicted values, suggestions).
+    """
+    from prophet import Prophet
+    from sklearn.ensemble import IsolationForest
+
+    suggestions = []
+    iso_forest = IsolationForest(random_state=42, contamination=0.05)
+    df['anomaly'] = iso_forest.fit_predict(df[[metric]])
+    anomalous_points = df[df['anomaly'] == -1]
+    for idx, row in anomalous_points.iterrows():
+        if metric == 'power':
+            suggestions.append(f"⚠️ Anomaly detected: Power spike to {row['power']:.2f} W at {idx.strftime('%Y-%m-%d %H:%M')}. Consider checking connected devices.")
+        elif row['water_level'] < 10:
+            suggestions.append(f"🚨 Water level is critically low ({row['water_level']:.2f}%). Consider refilling the tank immediately.")
+        elif row['water_level'] > 90:
+            suggestions.append(f"⚠️ Water level is very high ({row['water_level']:.2f}%). Ensure no overflow issues.")
+
+    prophet_df = df[[metric]].reset_index().rename(columns={'timestamp': 'ds', metric: 'y'})
+    prophet_df['ds'] = prophet_df['ds'].dt.tz_localize(None) # Only the power branch did this; water level forecasts failed
+    m = Prophet(daily_seasonality=True, changepoint_prior_scale=0.05)
+    m.fit(prophet_df)
+    forecast = m.predict(m.make_future_dataframe(periods=24, freq='h'))
+    predicted = forecast['yhat'].tail(24)
+    if metric == 'power':
+        mean = predicted[predicted > 0].mean()
+        if mean > 500:
+            suggestions.append(f"💡 Expected average power consumption over next 24 hours: {mean:.2f} W. Consider optimizing usage during peak times.")
+        else:
+            suggestions.append("✅ Power consumption forecast looks normal for the next 24 hours.")
+    else:
+        mean = predicted[(predicted >= 0) & (predicted <= 100)].mean()
+        if mean < 20:
+            suggestions.append(f"💡 Predicted average water level over next 24 hours: {mean:.2f}%. Plan for refilling soon.")
+        else:
+            suggestions.append("✅ Water level forecast looks stable for the next 24 hours.")
+    return anomalous_points[metric].tolist(), predicted.tolist(), suggestions
+
+
+class MetricEngineTests(SimpleTestCase):
+    def series(self, base, amplitude, noise, spikes):
+        rng = np.random.RandomState(0)
+        index = pd.date_range('2024-03-01', periods=72, freq='h', tz='UTC', name='timestamp')
+        values = base + amplitude * np.sin(np.arange(72) * 2 * np.pi / 24) + rng.normal(0, noise, 72)
+        for position, value in spikes.items():
+            values[position] = value
+        return pd.Series(values, index=index)
+
+    def assert_matches_inline_code(self, series, config):
+        result = analyze_series(series, config)
+        values, predicted, suggestions = _inline_view_analysis(series.to_frame(config.metric), config.metric)
+        self.assertEqual([anomaly['value'] for anomaly in result['anomalies']], values)
+        self.assertTrue(all(anomaly['metric'] == config.metric for anomaly in result['anomalies']))
+        self.assertEqual(result['suggestions'], suggestions)
+        self.assertEqual(len(result['predictions']), 24)
+        np.testing.assert_allclose([prediction[config.prediction_key] for prediction in result['predictions']], predicted, rtol=1e-6)
+        return result
+
+    def test_power(self):
+        result = self.assert_matches_inline_code(self.series(600, 100, 10, {20: 2500, 50: 3000}), PowerMetric())
+        self.assertIn(2500.0, [anomaly['value'] for anomaly in result['anomalies']])
+        self.assertTrue(result['suggestions'][-1].startswith('💡 Expected average power consumption'))
+
+    def test_water_level(self):
+        result = self.assert_matches_inline_code(self.series(50, 5, 1, {10: 3, 40: 97}), WaterLevelMetric())
+        self.assertIn('🚨 Water level is critically low (3.00%). Consider refilling the tank immediately.', result['suggestions'])
+        self.assertIn('⚠️ Water level is very high (97.00%). Ensure no overflow issues.', result['suggestions'])
+
+    def test_not_enough_data(self):
+        result = analyze_series(self.series(600, 100, 10, {})[:5], PowerMetric())
+        self.assertEqual(result['suggestions'], [
+            "ℹ️ Not enough diverse data to perform power anomaly detection (needs > 10 varied readings).",
+            "ℹ️ Not enough diverse data to generate power consumption forecast (needs > 20 varied readings).",
+        ])
+        self.assertEqual((result['anomalies'], result['predictions']), ([], []))
+
+
+class ModelStoreTests(SimpleTestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.store = ModelStore(root, drift_threshold=1.0, refit_ratio=0.2, max_age=3600)
+        self.config = PowerMetric()
+        rng = np.random.RandomState(0)
+        self.index = pd.date_range('2024-03-01', periods=60, freq='h', tz='UTC')
+        self.series = pd.Series(500 + rng.normal(0, 10, 60), index=self.index)
+
+    def extended(self, values):
+        index = pd.date_range(self.index[-1] + pd.Timedelta(hours=1), periods=len(values), freq='h')
+        return pd.concat([self.series, pd.Series(values, index=index)])
+
+    def test_round_trip(self):
+        iso_forest, prophet_model = trained_models(self.series, self.config, self.store, 'device-1')
+        artifacts = self.store.load('device-1')
+        self.assertEqual(artifacts.meta['models'], ['isolation_forest', 'prophet'])
+        self.assertEqual(artifacts.watermark, self.index[-1])
+        self.assertEqual(artifacts.meta['n_points'], 60)
+        self.assertFalse(artifacts.meta['warm_started']) # Nothing stored to start from
+        self.assertEqual(flag_anomalies(artifacts.isolation_forest, self.series).index.tolist(),
+                         flag_anomalies(iso_forest, self.series).index.tolist())
+        pd.testing.assert_series_equal(predict_prophet(artifacts.prophet_model, self.index[-1])['yhat'],
+                                       predict_prophet(prophet_model, self.index[-1])['yhat'])
+
+        # Reused while the data hasn't moved on
+        with mock.patch('ml_models.engine.fit_prophet') as fit_prophet:
+            trained_models(self.series, self.config, self.store, 'device-1')
+        fit_prophet.assert_not_called()
+
+    def test_refit_reasons(self):
+        artifacts = ModelArtifacts.describe(self.series, fit_isolation_forest(self.series))
+        self.store.save('device-1', artifacts)
+        reason = lambda series, needs_prophet=False: self.store.refit_reason(self.store.load('device-1'), series, True, needs_prophet)
+
+        self.assertIsNone(reason(self.series))
+        self.assertIsNone(reason(self.extended([505.0, 495.0]))) # A few similar readings
+        self.assertEqual(self.store.refit_reason(None, self.series, True, False), 'no stored model')
+        self.assertEqual(reason(self.series, needs_prophet=True), 'stored model is missing a component')
+        self.assertEqual(reason(self.extended(np.full(13, 500.0))), '13 new readings since the last fit')
+        self.assertIn('drifted', reason(self.extended([900.0, 910.0])))
+
+        self.store.save('device-1', ModelArtifacts(dict(artifacts.meta, format=0), artifacts.isolation_forest))
+        self.assertEqual(reason(self.series), 'stored model is from another version')
+        trained_at = (pd.Timestamp.now(tz='UTC') - pd.Timedelta(hours=2)).isoformat()
+        self.store.save('device-1', ModelArtifacts(dict(artifacts.meta, trained_at=trained_at), artifacts.isolation_forest))
+        self.assertEqual(reason(self.series), 'stored model is too old')
+
+    def test_refit_without_prophet_keeps_the_stored_one(self):
+        _, prophet_model = trained_models(self.series, self.config, self.store, 'device-1')
+        series = self.extended(500 + np.random.RandomState(1).normal(0, 10, 13))
+        with mock.patch('ml_models.engine.fit_prophet') as fit_prophet:
+            iso_forest, kept = trained_models(series, self.config, self.store, 'device-1', with_prophet=False)
+        fit_prophet.assert_not_called()
+        self.assertIsNone(kept)
+
+        artifacts = self.store.load('device-1')
+        self.assertEqual(artifacts.meta['models'], ['isolation_forest', 'prophet'])
+        self.assertEqual((artifacts.meta['n_points'], artifacts.prophet_fit()['n_points']), (73, 60))
+        pd.testing.assert_series_equal(predict_prophet(artifacts.prophet_model, self.index[-1])['yhat'],
+                                       predict_prophet(prophet_model, self.index[-1])['yhat'])
+        # The kept Prophet model is checked against the data it was trained on
+        self.assertIsNone(self.store.refit_reason(artifacts, series, True, False))
+        self.assertEqual(self.store.refit_reason(artifacts, series, True, True), '13 new readings since the last fit')
+
+    def test_unreadable_artifacts_are_refitted(self):
+        trained_models(self.series, self.config, self.store, 'device-1')
+        with open(os.path.join(self.store.root, 'device-1', 'prophet.json'), 'w') as f:
+            f.write('{"truncated')
+        with self.assertLogs('ml_models.model_store', 'WARNING'):
+            self.assertIsNone(self.store.load('device-1'))
+
+        iso_forest, prophet_model = trained_models(self.series, self.config, self.store, 'device-1')
+        self.assertIsNotNone(prophet_model)
+        artifacts = self.store.load('device-1')
+        self.assertFalse(artifacts.meta['warm_started'])
+        self.assertEqual(artifacts.meta['models'], ['isolation_forest', 'prophet'])
+
+    def test_refit_warm_starts_prophet(self):
+        trained_models(self.series, self.config, self.store, 'device-1')
+        series = self.extended(500 + np.random.RandomState(1).normal(0, 10, 24))
+        trained_models(series, self.config, self.store, 'device-1')
+        artifacts = self.store.load('device-1')
+        self.assertTrue(artifacts.meta['warm_started'])
+        self.assertEqual(artifacts.meta['n_points'], 84)
+
+    def test_failed_warm_start_falls_back_to_a_cold_fit(self):
+        trained_models(self.series, self.config, self.store, 'device-1')
+
+        def fit_without_warm_start(series, init=None):
+            if init is not None:
+                raise ValueError('changepoints changed')
+            return fit_prophet(series)
+
+        series = self.extended(500 + np.random.RandomState(1).normal(0, 10, 24))
+        with mock.patch('ml_models.engine.fit_prophet', side_effect=fit_without_warm_start) as mocked:
+            with self.assertLogs('ml_models.engine', 'WARNING'):
+                _, prophet_model = trained_models(series, self.config, self.store, 'device-1')
+        self.assertEqual(mocked.call_count, 2)
+        self.assertIsNotNone(prophet_model)
+        self.assertFalse(self.store.load('device-1').meta['warm_started'])
+
+
+class StreamingAnomalyTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='streaming-test-device', device_type='power_monitor')
+        self.monitor = StreamingAnomalyMonitor(seed_readings=50)
+        self.now = timezone.now()
+
+    def store(self, values, start=0):
+        return SensorData.objects.bulk_create([
+            SensorData(device=self.device, timestamp=self.now + timedelta(seconds=start + i), data={'power': value}).fill_typed_metrics()
+            for i, value in enumerate(values)
+        ])
+
+    def steady(self, count):
+        return [100.0 + (i % 5) for i in range(count)]
+
+    def test_spike_is_flagged_once_warmed_up(self):
+        self.assertEqual(self.monitor.observe(self.device, self.store([100.0, 900.0])), []) # Still warming up
+        readings = self.store(self.steady(30) + [900.0], start=10)
+        anomalies = self.monitor.observe(self.device, readings)
+        self.assertEqual([anomaly.sensor_data_id for anomaly in anomalies], [readings[-1].pk])
+        self.assertEqual(SensorAnomaly.objects.get().value, 900.0)
+
+    def test_state_is_seeded_from_stored_readings(self):
+        self.store(self.steady(30))
+        # A fresh process: the history warms the detector up, so the first new reading can be flagged
+        self.assertEqual(len(self.monitor.observe(self.device, self.store([900.0], start=30))), 1)
+
+    def test_late_readings_are_skipped(self):
+        self.monitor.observe(self.device, self.store(self.steady(30), start=100))
+        self.assertEqual(self.monitor.observe(self.device, self.store([900.0])), [])
+
+
+class ForecastDevicesTests(TestCase):
+    @override_settings(ANALYSIS_METRIC_CONFIGS={'thermostat': 'ml_models.metrics.PowerMetric', 'water_level': None})
+    def test_device_types_follow_the_metric_config_setting(self):
+        now = timezone.now()
+        for device_type in ('power_monitor', 'water_level', 'thermostat'):
+            device = Device.objects.create(device_api_key=f'forecast-{device_type}', device_type=device_type)
+            DeviceLatestReading.objects.create(device=device, timestamp=now, data={'power': 1.0})
+        with mock.patch('device_api.management.commands.forecast_devices.forecast_chunk', return_value=[]) as forecast_chunk:
+            call_command('forecast_devices', workers=0, stdout=StringIO(), stderr=StringIO())
+        forecast_types = set(Device.objects.filter(pk__in=forecast_chunk.call_args.args[0]).values_list('device_type', flat=True))
+        self.assertEqual(forecast_types, {'power_monitor', 'thermostat'})
+
+
+@override_settings(ANALYSIS_MAX_FIT_POINTS=1000)
+class AnalysisResolutionTests(TestCase):
+    """
+    Rollups replace raw readings only when they are complete for the window and still
+    leave the models enough points; otherwise the newest raw readings are fitted on.
+    """
+
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='resolution-test-device', device_type='power_monitor')
+        self.now = timezone.now()
+
+    def add_readings(self, count, interval):
+        SensorData.objects.bulk_create([
+            SensorData(device=self.device, timestamp=self.now - timedelta(seconds=i * interval), data={'power': 100.0 + i % 7}).fill_typed_metrics()
+            for i in range(count)
+        ])
+
+    def test_uncompacted_window_reads_newest_raw_readings(self):
+        # 1500 readings 4 s apart: over the budget, and the compactor hasn't run
+        self.add_readings(1500, 4)
+        window, resolution = load_window(self.device, '24h', self.now)
+        self.assertEqual(resolution, 'raw')
+        self.assertEqual(len(window['timestamp']), 1000)
+        self.assertEqual(window['timestamp'][-1], int(self.now.timestamp() * 1_000_000))
+        self.assertTrue((window['timestamp'][1:] > window['timestamp'][:-1]).all())
+
+    def test_resolution_follows_the_span_with_data(self):
+        # 100 minutes of data in a 24h window read per minute, not as two hourly buckets
+        self.add_readings(1500, 4)
+        compact()
+        window, resolution = load_window(self.device, '24h', self.now)
+        self.assertEqual(resolution, '1m')
+        self.assertGreaterEqual(len(window['timestamp']), 100)
+        self.assertEqual(window['count'].sum(), 1500)
+
+    def test_new_readings_past_the_cursor_fall_back_to_raw(self):
+        self.add_readings(1500, 4)
+        compact()
+        SensorData.objects.create(device=self.device, timestamp=self.now, data={'power': 1.0})
+        _, resolution = load_window(self.device, '24h', self.now)
+        self.assertEqual(resolution, 'raw')
+
+    def test_short_span_keeps_raw_readings(self):
+        # 1500 readings in 150 s would make 3 one-minute buckets, too few to fit a model on
+        self.add_readings(1500, 0.1)
+        compact()
+        window, resolution = load_window(self.device, '24h', self.now)
+        self.assertEqual(resolution, 'raw')
+        self.assertEqual(len(window['timestamp']), 1000)
+
+
+class RollupCompactionTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='rollup-test-device', device_type='power_monitor')
+        self.hour = datetime(2026, 3, 1, 12, tzinfo=dt_timezone.utc)
+
+    def add(self, minute, power, **extra):
+        return SensorData.objects.create(device=self.device, timestamp=self.hour + timedelta(minutes=minute), data={'power': power, **extra})
+
+    def hourly(self):
+        return SensorRollup.objects.get(device=self.device, resolution='1h', bucket=self.hour, metric='power')
+
+    def test_batches_count_each_reading_once(self):
+        readings = [self.add(i, float(i)) for i in range(10)]
+        self.assertEqual([compact(batch_size=4) for _ in range(4)], [4, 4, 2, 0])
+        self.assertEqual(RollupCursor.objects.get(name=CURSOR_NAME).last_id, readings[-1].pk)
+        rollup = self.hourly()
+        self.assertEqual((rollup.count, rollup.min, rollup.max, rollup.mean, rollup.last), (10, 0.0, 9.0, 4.5, 9.0))
+        self.assertEqual(SensorRollup.objects.filter(device=self.device, resolution='1m').count(), 10)
+
+    def test_late_reading_updates_its_old_bucket(self):
+        self.add(30, 10.0)
+        self.add(40, 20.0)
+        compact()
+        self.add(5, 60.0) # Arrives after compaction with an older timestamp
+        self.assertEqual(compact(), 1)
+        rollup = self.hourly()
+        self.assertEqual((rollup.count, rollup.min, rollup.max, rollup.mean), (3, 10.0, 60.0, 30.0))
+        self.assertEqual(rollup.last, 20.0) # Still the newest by timestamp
+        self.assertEqual(rollup_summary(self.device, '1h', self.hour, self.hour + timedelta(hours=1))['power']['count'], 3)
+
+    def test_compaction_is_sqlite_only(self):
+        self.add(0, 1.0)
+        with mock.patch.object(connection, 'vendor', 'postgresql'), self.assertRaises(NotSupportedError):
+            compact()
+        self.assertFalse(SensorRollup.objects.exists())
+
+    def test_non_numeric_values_are_skipped(self):
+        self.add(0, 1.0, relay='on', voltage='230.5', ok=True)
+        compact()
+        metrics = set(SensorRollup.objects.filter(resolution='1h').values_list('metric', flat=True))
+        self.assertEqual(metrics, {'power', 'voltage'})
+
+
+class TypedMetricTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='typed-test-device', device_type='power_monitor')
+        self.payload = {'power': 5, 'frequency': 50.0, 'voltage': '230.5', 'current': 'nan', 'water_level': True, 'relay': 'on'}
+
+    def test_round_trip(self):
+        reading = SensorData.objects.create(device=self.device, data=self.payload)
+        stored = SensorData.objects.filter(pk=reading.pk).values('data', 'power', 'frequency', 'voltage', 'current', 'water_level').get()
+        # Numbers and numeric strings go to their columns; booleans and non-finite strings stay in the JSON as sent
+        self.assertEqual(stored, {'data': {'current': 'nan', 'water_level': True, 'relay': 'on'},
+                                  'power': 5.0, 'frequency': 50.0, 'voltage': 230.5, 'current': None, 'water_level': None})
+        row = next(SensorData.objects.filter(pk=reading.pk).payload_values())
+        self.assertEqual(row['data'], {**self.payload, 'power': 5.0, 'voltage': 230.5})
+        self.assertEqual(reading.data, self.payload) # The instance keeps the full payload
+
+    def test_backfill_uses_the_same_rule(self):
+        backfill = importlib.import_module('device_api.migrations.0012_backfill_sensordata_typed_metrics')
+        for value in (5, 50.0, '230.5', ' 12 ', '1e3', 'nan', '-inf', 'on', '', True, None, [1], {'v': 1}):
+            with self.subTest(value=value):
+                self.assertEqual(backfill._column_value(value), typed_metric_value(value))
+
+    def test_bulk_create_and_partial_update(self):
+        reading, = SensorData.objects.bulk_create([SensorData(device=self.device, data=self.payload).fill_typed_metrics()])
+        reading.data = {'power': 7.5}
+        reading.save(update_fields=['data'])
+        self.assertEqual(SensorData.objects.filter(pk=reading.pk).values_list('power', 'frequency', 'data').get(), (7.5, None, {}))
+
+    def test_metric_summary(self):
+        for power in (1, 2, 6):
+            SensorData.objects.create(device=self.device, data={'power': power})
+        summary = SensorData.objects.filter(device=self.device).metric_summary()
+        self.assertEqual(summary, {'power': {'count': 3, 'min': 1.0, 'max': 6.0, 'mean': 3.0}})
+
+
+class SensorArchiveTests(TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix='archive-test-')
+        self.addCleanup(shutil.rmtree, self.root)
+        self.archive = SensorArchive(self.root)
+        self.device = Device.objects.create(device_api_key='archive-test-device', device_type='power_monitor')
+        self.now = timezone.now()
+        self.old = self.now - timedelta(days=100)
+        SensorData.objects.bulk_create([
+            SensorData(device=self.device, timestamp=self.old + timedelta(minutes=i),
+                       data={'power': float(i), 'relay': 'on'} if i % 2 else {'voltage': 230.0}).fill_typed_metrics()
+            for i in range(25)
+        ] + [SensorData(device=self.device, timestamp=self.now, data={'power': 1.0}).fill_typed_metrics()])
+
+    def test_round_trip(self):
+        expected = list(SensorData.objects.filter(timestamp__lt=self.now).order_by('timestamp').payload_values('id', 'timestamp'))
+        archived, files = archive_old_readings(self.archive, self.now - timedelta(days=90), require_rolled_up=False, read_chunk_size=7)
+        self.assertEqual((archived, files), (25, 1))
+        self.assertEqual(SensorData.objects.count(), 1)
+
+        columns = self.archive.read_columns(self.device.id, self.old, self.now)
+        self.assertEqual(columns['id'].tolist(), [row['id'] for row in expected])
+        self.assertEqual(columns['timestamp'].tolist(), [int(round(row['timestamp'].timestamp() * 1_000_000)) for row in expected])
+        self.assertEqual(columns['data'][1], {'relay': 'on'})
+        self.assertEqual(columns['data'][0], {})
+        self.assertTrue(np.isnan(columns['power'][0]))
+        self.assertEqual(columns['power'][1], 1.0)
+        self.assertEqual(columns['voltage'][0], 230.0)
+        self.assertEqual(self.archive.count(self.device.id, self.old, self.old + timedelta(minutes=9)), 10)
+
+    def test_only_rolled_up_readings_are_archived(self):
+        self.assertEqual(archive_old_readings(self.archive, self.now - timedelta(days=90)), (0, 0))
+        compact()
+        self.assertEqual(archive_old_readings(self.archive, self.now - timedelta(days=90)), (25, 1))
+
+    @override_settings(SENSOR_DATA_RETENTION_DAYS=90)
+    def test_retention_shorter_than_the_setting_is_rejected(self):
+        # The analysis path reads the archive only for readings older than SENSOR_DATA_RETENTION_DAYS
+        with self.assertRaisesMessage(CommandError, 'at least SENSOR_DATA_RETENTION_DAYS'):
+            call_command('archive_sensor_data', retention_days=30, stdout=StringIO())
+        self.assertEqual(SensorData.objects.count(), 26)
+
+
+class DownsamplingTests(SimpleTestCase):
+    def window(self, n):
+        timestamps = np.arange(n, dtype=np.int64) * 1_000_000
+        power = np.sin(np.arange(n) / 50.0) * 100
+        power[n // 3] = 1000.0 # A spike the chart must keep
+        voltage = np.full(n, 230.0)
+        voltage[::2] = np.nan # Reported by every other reading only
+        return {'timestamp': timestamps, 'data': {'power': power, 'voltage': voltage}, 'extras': [{} for _ in range(n)]}
+
+    def test_lttb_keeps_endpoints_and_extremes(self):
+        x = np.arange(1000.0)
+        y = np.zeros(1000)
+        y[500] = 50.0
+        indices = lttb_indices(x, y, 20)
+        self.assertEqual(len(indices), 20)
+        self.assertEqual((indices[0], indices[-1]), (0, 999))
+        self.assertTrue((np.diff(indices) > 0).all())
+        self.assertIn(500, indices)
+        self.assertEqual(lttb_indices(x[:10], y[:10], 20).tolist(), list(range(10)))
+        self.assertEqual(lttb_indices(x, y, 2).tolist(), [0, 999])
+
+    def test_point_budget_per_metric(self):
+        window = self.window(5000)
+        points = encode_window(window, 100)
+        # 'points' is the union of the rows picked per metric
+        self.assertLessEqual(len(points), 200)
+        self.assertEqual(points[0]['timestamp'], '1970-01-01T00:00:00+00:00')
+        self.assertIn(1000.0, [point['data'].get('power') for point in points])
+        self.assertNotIn(None, [value for point in points for value in point['data'].values()])
+
+        columnar = encode_window(window, 100, 'columnar')
+        self.assertEqual(len(columnar['power']['values']), 100)
+        self.assertEqual(len(columnar['voltage']['timestamps']), 100)
+        self.assertEqual(columnar['power']['timestamps'][0], '1970-01-01T00:00:00+00:00')
+
+    def test_small_windows_are_returned_whole(self):
+        window = self.window(50)
+        self.assertEqual(len(encode_window(window, 100)), 50)
+        self.assertIs(downsample_window(window, 100), window)
+
+    def test_downsampled_window_keeps_the_chart(self):
+        window = self.window(5000)
+        reduced = downsample_window(window, 100)
+        self.assertLess(len(reduced['timestamp']), 201)
+        self.assertEqual(len(reduced['extras']), len(reduced['timestamp']))
+        self.assertEqual(reduced['timestamp'][[0, -1]].tolist(), window['timestamp'][[0, -1]].tolist())
+        chart = encode_window(reduced, 100, 'columnar')
+        self.assertEqual(len(chart['power']['values']), 100)
+        self.assertIn(1000.0, chart['power']['values'])
+
+    def test_max_points_parameter(self):
+        with override_settings(ANALYSIS_MAX_POINTS=500):
+            self.assertEqual(parse_max_points(None), 500)
+            self.assertEqual(parse_max_points('50'), 50)
+            self.assertEqual(parse_max_points('5000'), 500)
+        for value in ('2', 'x'):
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                parse_max_points(value)
+
+
+class ImportTimeTests(SimpleTestCase):
+    """
+    The ML stack costs seconds of import time and hundreds of MB per process. Only
+    the analysis path may load it, so workers that serve ingest, polling and the
+    dashboard (and every manage.py command) start without it.
+    """
+
+    HEAVY_PACKAGES = {'pandas', 'sklearn', 'prophet', 'joblib', 'matplotlib', 'cmdstanpy'}
+
+    def imported_modules(self, code):
+        """Top-level names of every module a fresh interpreter imports while running `code`, from -X importtime."""
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=settings.SETTINGS_MODULE)
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', f'import django; django.setup(); {code}'],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, timeout=120,
+        )
+        self.assertEqual(result.returncode, 0, result.stderr[-2000:])
+        modules = set()
+        for line in result.stderr.splitlines():
+            if line.startswith('import time:') and '|' in line:
+                modules.add(line.rsplit('|', 1)[1].strip().split('.')[0])
+        return modules
+
+    def test_url_conf_does_not_import_ml_stack(self):
+        # Loading the URLconf imports every view module, the ingest endpoints included
+        modules = self.imported_modules('import iot_project.urls')
+        self.assertIn('device_api', modules)
+        self.assertIn('dashboard', modules)
+        self.assertEqual(modules & self.HEAVY_PACKAGES, set())
+
+    def test_ingest_does_not_import_ml_stack(self):
+        # Streaming anomaly detection runs at ingest and must stay on the standard library
+        modules = self.imported_modules('from device_api.ingest import store_readings; from ml_models import StreamingDetector, get_metric_config')
+        self.assertEqual(modules & self.HEAVY_PACKAGES, set())
+
+
+def _analysis_job_killing_its_worker(device_id, duration_param, seconds=None):
+    # Stands in for run_analysis_job in the pool's processes, which don't see the test database
+    if duration_param == '7d':
+        os._exit(1)
+    return {'device_id': device_id}, None
+
+
+class AnalysisWorkerTests(TestCase):
+    @mock.patch('device_api.management.commands.run_analysis_worker.run_analysis_job', _analysis_job_killing_its_worker)
+    def test_worker_survives_a_dying_process(self):
+        device = Device.objects.create(device_api_key='worker-test-device', device_type='power_monitor')
+        crashing = AnalysisJob.objects.create(device=device, duration='7d', metric='power')
+        healthy = AnalysisJob.objects.create(device=device, duration='24h', metric='power')
+        stderr = StringIO()
+        call_command('run_analysis_worker', workers=1, once=True, max_attempts=2, stdout=StringIO(), stderr=stderr)
+
+        crashing.refresh_from_db()
+        healthy.refresh_from_db()
+        self.assertEqual((crashing.status, crashing.attempts), ('failed', 2))
+        self.assertIn('worker process died', crashing.error)
+        self.assertEqual(healthy.status, 'done')
+        self.assertEqual(healthy.result, {'device_id': device.id})
+        self.assertIn('restarting the pool', stderr.getvalue())
+
+    def test_result_json_round_trip(self):
+        result = {
+            'resolution': '1m',
+            'anomalies': [],
+            'window': {
+                'timestamp': np.array([0, 60_000_000, 120_000_000], dtype=np.int64),
+                'data': {'power': np.array([1.5, np.nan, 3.0]), 'voltage': np.array([np.nan, np.nan, 230.0])},
+                'min': {'power': np.array([1.0, np.nan, 2.0])},
+                'max': {'power': np.array([2.0, np.nan, 4.0])},
+                'count': np.array([3, 0, 2], dtype=np.int64),
+                'extras': [{}, {}, {'status': 'ok'}],
+            },
+        }
+        # Stored in a JSONField, so it must survive strict JSON: no NaN literals
+        encoded = json.loads(json.dumps(result_to_json(result), allow_nan=False))
+        self.assertEqual(encoded['window']['data']['power'], [1.5, None, 3.0])
+
+        decoded = result_from_json(encoded)
+        window = decoded['window']
+        self.assertEqual(window['timestamp'].dtype, np.int64)
+        self.assertEqual(window['count'].tolist(), [3, 0, 2])
+        for key in ('data', 'min', 'max'):
+            for metric, values in result['window'][key].items():
+                np.testing.assert_array_equal(window[key][metric], values)
+        self.assertEqual(window['extras'], result['window']['extras'])
+        self.assertEqual(decoded['resolution'], '1m')
+
+
+class AsyncViewTests(TransactionTestCase):
+    # The async command poll claims on the event loop's executor, i.e. another connection
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.device = Device.objects.create(device_api_key='async-test-device', device_type='power_monitor')
+        self.addCleanup(heartbeat.flush)
+        self.addCleanup(cache.clear)
+
+    async def post_data(self, body):
+        request = self.factory.post('/api/v1/device/data/', body, content_type='application/json')
+        return await AsyncDeviceDataReceive.as_view()(request)
+
+    async def test_data_receive(self):
+        response = await self.post_data({'device_api_key': 'async-test-device', 'device_type': 'power_monitor', 'sensor_data': {'power': 12.5}})
+        self.assertEqual(response.status_code, 200)
+        reading = await SensorData.objects.aget(device=self.device)
+        self.assertEqual(reading.data, {'power': 12.5})
+
+        response = await self.post_data({'device_api_key': 'async-test-device', 'device_type': 'power_monitor'})
+        self.assertEqual(response.status_code, 400)
+        request = self.factory.post('/api/v1/device/data/', '[1, 2]', content_type='application/json')
+        self.assertEqual((await AsyncDeviceDataReceive.as_view()(request)).status_code, 400)
+
+    async def test_data_receive_backs_off_when_the_buffer_is_full(self):
+        with mock.patch('device_api.views.ingest_readings', side_effect=IngestBufferFull('Ingest buffer is full; retry later.')):
+            response = await self.post_data({'device_api_key': 'async-test-device', 'device_type': 'power_monitor', 'sensor_data': {'power': 1}})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(await SensorData.objects.acount(), 0)
+
+    async def test_command_poll(self):
+        await DeviceCommandQueue.objects.acreate(device=self.device, command_type='reboot')
+        request = self.factory.get('/api/v1/device/commands/', {'device_api_key': 'async-test-device', 'max_commands': 5})
+        response = await AsyncDeviceCommandPoll.as_view()(request)
+        self.assertEqual([command['command'] for command in json.loads(response.content)['commands']], ['reboot'])
+        request = self.factory.get('/api/v1/device/commands/', {'device_api_key': 'async-test-device'})
+        self.assertEqual(json.loads((await AsyncDeviceCommandPoll.as_view()(request)).content), {'command': 'no_command'})
+
+    @override_settings(COMMAND_LONG_POLL_RECHECK=30)
+    async def test_long_poll_is_woken_by_a_queued_command(self):
+        request = self.factory.get('/api/v1/device/commands/', {'device_api_key': 'async-test-device', 'wait': 20})
+        poll = asyncio.ensure_future(AsyncDeviceCommandPoll.as_view()(request))
+        await asyncio.sleep(0.2) # Let the poll find no command and start waiting
+        self.assertFalse(poll.done())
+
+        started = time.monotonic()
+        await sync_to_async(DeviceCommandQueue.objects.create)(device=self.device, command_type='reboot')
+        response = await asyncio.wait_for(poll, 10)
+        self.assertLess(time.monotonic() - started, 5) # Woken by the notifier, not the 30s re-check
+        self.assertEqual(json.loads(response.content)['command'], 'reboot')
+
+    async def test_onboarding_check(self):
+        request = self.factory.get('/api/v1/device/onboard-check/', {'device_api_key': 'unknown-device'})
+        response = await AsyncDeviceOnboardingCheck.as_view()(request)
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(json.loads(response.content)['status'], 'error')
+
+        await Device.objects.filter(pk=self.device.pk).aupdate(is_online=True, last_seen=timezone.now())
+        request = self.factory.get('/api/v1/device/onboard-check/', {'device_api_key': 'async-test-device'})
+        response = await AsyncDeviceOnboardingCheck.as_view()(request)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)['device_type'], 'power_monitor')
+
+
+class ReadingBufferTests(TestCase):
+    def setUp(self):
+        self.device = Device.objects.create(device_api_key='buffer-test-device', device_type='power_monitor')
+        self.now = timezone.now().replace(microsecond=0)
+        self.wal_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.wal_dir)
+
+    def buffer(self, **kwargs):
+        # A long interval keeps the background flusher asleep; the tests flush themselves
+        buffer = ReadingBuffer(**dict({'flush_interval': 3600, 'max_rows': 100, 'max_pending': 1000}, **kwargs))
+        self.addCleanup(buffer.flush)
+        return buffer
+
+    def readings(self, count, start=0):
+        return [(self.now + timedelta(seconds=start + i), {'power': float(start + i)}) for i in range(count)]
+
+    def stored_powers(self):
+        return [reading.data['power'] for reading in SensorData.objects.filter(device=self.device).order_by('timestamp')]
+
+    def segments(self):
+        return sorted(name for name in os.listdir(self.wal_dir) if name.endswith('.wal'))
+
+    def test_readings_are_stored_on_flush(self):
+        buffer = self.buffer()
+        buffer.add(self.device, self.readings(3))
+        self.assertEqual((buffer.pending_count(), SensorData.objects.count()), (3, 0))
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(buffer.pending_count(), 0)
+        self.assertEqual(self.stored_powers(), [0.0, 1.0, 2.0])
+        self.assertEqual(DeviceLatestReading.objects.get(device=self.device).timestamp, self.now + timedelta(seconds=2))
+
+    def test_full_buffer_is_flushed_at_once(self):
+        buffer = self.buffer(max_rows=5)
+        buffer.add(self.device, self.readings(4))
+        buffer.add(self.device, self.readings(2, start=4))
+        self.assertEqual((buffer.pending_count(), SensorData.objects.count()), (0, 6))
+
+    def test_failed_flush_is_retried(self):
+        buffer = self.buffer(wal_dir=self.wal_dir)
+        buffer.add(self.device, self.readings(3))
+        with mock.patch.object(buffer, '_store', side_effect=OperationalError('database is locked')):
+            with self.assertRaises(OperationalError):
+                buffer.flush()
+        buffer.add(self.device, self.readings(1, start=3))
+        self.assertEqual(buffer.pending_count(), 4)
+        self.assertEqual(len(self.segments()), 2) # The failed batch's segment is kept until it is stored
+
+        self.assertEqual(buffer.flush(), 4)
+        self.assertEqual(SensorData.objects.count(), 4)
+        self.assertEqual(self.segments(), [])
+
+    def test_backs_off_when_too_many_readings_are_pending(self):
+        buffer = self.buffer(max_pending=2)
+        buffer.add(self.device, self.readings(2))
+        with self.assertRaises(IngestBufferFull):
+            buffer.add(self.device, self.readings(1, start=2))
+        self.assertEqual(buffer.pending_count(), 2)
+
+    def test_orphaned_log_is_replayed(self):
+        dead = ReadingBuffer(flush_interval=3600, wal_dir=self.wal_dir)
+        dead.add(self.device, self.readings(3))
+        # The process dies: its readings never reach the database and its lock is released
+        dead._pending.clear()
+        dead._wal.write('[1, "power_monitor", "2024-') # Cut short mid-write
+        dead._wal.close()
+        dead._lock_file.close()
+        # ...after the first reading had been committed, say
+        SensorData.objects.create(device=self.device, timestamp=self.now, data={'power': 0.0})
+
+        # The next buffer to open a log replays the orphan, without storing the committed reading twice
+        live = self.buffer(wal_dir=self.wal_dir)
+        with self.assertLogs('device_api.ingest_buffer', 'WARNING') as logs:
+            live.add(self.device, self.readings(1, start=10))
+        self.assertIn('Skipping unreadable line', logs.output[0])
+        self.assertEqual(self.stored_powers(), [0.0, 1.0, 2.0])
+        self.assertEqual(replay_orphaned_segments(self.wal_dir), 0)
+        self.assertEqual(len(self.segments()), 1) # The live buffer's segment is left alone
+
+    def test_replay_skips_live_logs(self):
+        live = self.buffer(wal_dir=self.wal_dir)
+        live.add(self.device, self.readings(2))
+        self.assertEqual(replay_orphaned_segments(self.wal_dir), 0)
+        self.assertEqual((SensorData.objects.count(), len(self.segments())), (0, 1))
+
+
+class SqliteProfileTests(SimpleTestCase):
+    def test_profile_is_opt_in(self):
+        self.assertEqual(sqlite_profile_for(''), {})
+        self.assertEqual(sqlite_profile_for('wsgi')['CONN_MAX_AGE'], 600)
+        asgi = sqlite_profile_for('asgi')
+        self.assertEqual(asgi['CONN_MAX_AGE'], 0) # Not reused across async requests anyway
+        self.assertIn('PRAGMA journal_mode=WAL', asgi['OPTIONS']['init_command'])
+        with self.assertRaises(ValueError):
+            sqlite_profile_for('production')
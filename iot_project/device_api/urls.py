@@ -1,14 +1,24 @@
+from django.conf import settings
 from django.urls import path
-from .views import DeviceDataReceive, DeviceCommandPoll, DeviceOnboardingCheck, DeviceLatestDataRetrieve, DeviceAnalysisAPIView
+from .views import DeviceDataReceive, DeviceDataBatchReceive, DeviceCommandPoll, DeviceCommandAck, DeviceCommandLatency, DeviceOnboardingCheck, DeviceLatestDataRetrieve, DeviceLatestDataList, DeviceAnalysisAPIView
+from .views import AsyncDeviceDataReceive, AsyncDeviceCommandPoll, AsyncDeviceOnboardingCheck
 
 
 app_name = 'device_api' # Namespace for API URLs
 
+# Under an ASGI server the device-facing endpoints can run as async views (docs/setup_guide.md)
+if getattr(settings, 'DEVICE_API_ASYNC_VIEWS', False):
+    DeviceDataReceive, DeviceCommandPoll, DeviceOnboardingCheck = AsyncDeviceDataReceive, AsyncDeviceCommandPoll, AsyncDeviceOnboardingCheck
+
 urlpatterns = [
     path('data/', DeviceDataReceive.as_view(), name='device_data_receive'),
+    path('data/batch/', DeviceDataBatchReceive.as_view(), name='device_data_batch_receive'),
     path('commands/', DeviceCommandPoll.as_view(), name='device_command_poll'),
+    path('commands/ack/', DeviceCommandAck.as_view(), name='device_command_ack'),
     path('onboard-check/', DeviceOnboardingCheck.as_view(), name='device_onboarding_check'),
+    path('latest/', DeviceLatestDataList.as_view(), name='device-latest-data-list'),
     path('<int:device_id>/latest_data/', DeviceLatestDataRetrieve.as_view(), name='device-latest-data-retrieve'),
     
+    path('<int:device_id>/command_latency/', DeviceCommandLatency.as_view(), name='device_command_latency'),
     path('<int:device_id>/analysis/', DeviceAnalysisAPIView.as_view(), name='device_analysis'),
 ]
\ No newline at end of file
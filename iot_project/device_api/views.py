@@ -4,13 +4,26 @@ import traceback
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
 from django.db.models import Max, Q, OuterRef, Subquery
 # ... other existing imports
-from .models import SensorData, DeviceCommandQueue
+from .models import SensorData, DeviceCommandQueue, DeviceLatestReading
+from .analysis import ENCODINGS, analysis_cache, duration_start, encode_window, normalize_duration, parse_max_points
+from .anomalies import recent_anomalies
+from .commands import anext_commands, command_latency_stats, command_log_buffer, next_commands, parse_acks, parse_max_commands, parse_wait
+from .device_cache import device_cache
+from .heartbeat import heartbeat
+from .ingest import IngestError, ingest_readings, parse_readings, parse_sensor_payload, publish_heartbeat
+from .ingest_buffer import IngestBufferFull
 from core.models import Device # Assuming Device model is in core.models
 from django.utils import timezone
+from django.utils.decorators import method_decorator
 from django.shortcuts import get_object_or_404
 from django.db import transaction
+from django.http import JsonResponse
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from asgiref.sync import sync_to_async
 from django.core.serializers.json import DjangoJSONEncoder # Import for serializing datetime objects
 
 # REQUIRED IMPORT FOR APIView
@@ -18,10 +31,6 @@ from rest_framework.views import APIView
 from rest_framework.response import Response # Also ensure Response is imported if used
 from rest_framework import status # Also ensure status is imported if used
 
-# For ML models and data manipulation
-import pandas as pd
-from sklearn.ensemble import IsolationForest
-from prophet import Prophet
 import logging
 
 logger = logging.getLogger(__name__)
@@ -39,46 +48,60 @@ class DeviceDataReceive(APIView):
         if not all([device_api_key, device_type, sensor_data_payload is not None]):
             return Response({'error': 'Missing data (device_api_key, device_type, or sensor_data).'}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Devices may piggy-back command acknowledgements on the next upload
         try:
-            with transaction.atomic():
-                device, created = Device.objects.get_or_create(
-                    device_api_key=device_api_key,
-                    defaults={
-                        'device_type': device_type,
-                        'name': f"{device_type.replace('_', ' ').title()} Device ({device_api_key[:4]})",
-                        'is_online': True, # Mark as online on data receive
-                        'last_seen': timezone.now() # Update last_seen on data receive
-                    }
-                )
+            sensor_data_payload = parse_sensor_payload(sensor_data_payload)
+            command_acks = parse_acks(request.data['command_acks']) if request.data.get('command_acks') else []
+        except IngestError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-                if not created:
-                    # If device already existed, update its properties
-                    if not device.device_type or device.device_type == 'UNSET_TYPE':
-                        device.device_type = device_type
-                        device.name = f"{device_type.replace('_', ' ').title()} Device ({device_api_key[:4]})"
-                        # Ensure is_online and last_seen are updated for existing devices
-                        device.is_online = True
-                        device.last_seen = timezone.now()
-                        device.save() # CRITICAL: Save the device object after updating fields
-                    
-                    
-
-                if not isinstance(sensor_data_payload, dict):
-                    try:
-                        sensor_data_payload = json.loads(sensor_data_payload)
-                    except json.JSONDecodeError:
-                        return Response({'error': 'sensor_data must be a valid JSON object or dict.'}, status=status.HTTP_400_BAD_REQUEST)
-
-                SensorData.objects.create(
-                    device=device,
-                    data=sensor_data_payload
-                )
-                return Response({'message': 'Data received successfully'}, status=status.HTTP_200_OK)
+        try:
+            device = ingest_readings(device_api_key, device_type, [(timezone.now(), sensor_data_payload)])
+            if command_acks:
+                command_log_buffer.add(device.id, command_acks)
+            return Response({'message': 'Data received successfully'}, status=status.HTTP_200_OK)
+        except IngestBufferFull as e:
+            # Write-behind buffer backed up behind a failing database; the device retries later
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
         except Exception as e:
+            device_cache.invalidate(device_api_key) # e.g. a cached device deleted by another worker
             print(f"An unexpected error occurred in DeviceDataReceive: {e}", file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
             return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+# Endpoint for devices to upload several buffered readings in one request
+class DeviceDataBatchReceive(APIView):
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request, format=None):
+        device_api_key = request.data.get('device_api_key')
+        device_type = request.data.get('device_type')
+        readings_payload = request.data.get('readings')
+
+        if not all([device_api_key, device_type, readings_payload is not None]):
+            return Response({'error': 'Missing data (device_api_key, device_type, or readings).'}, status=status.HTTP_400_BAD_REQUEST)
+
+        # Validate the whole batch before touching the database so a bad reading costs no write lock
+        try:
+            readings = parse_readings(readings_payload)
+            command_acks = parse_acks(request.data['command_acks']) if request.data.get('command_acks') else []
+        except IngestError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            device = ingest_readings(device_api_key, device_type, readings)
+            if command_acks:
+                command_log_buffer.add(device.id, command_acks)
+            return Response({'message': 'Data received successfully', 'received': len(readings)}, status=status.HTTP_200_OK)
+        except IngestBufferFull as e:
+            return Response({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as e:
+            device_cache.invalidate(device_api_key)
+            print(f"An unexpected error occurred in DeviceDataBatchReceive: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 # Endpoint for devices to poll for commands
 class DeviceCommandPoll(APIView):
     authentication_classes = []
@@ -90,51 +113,135 @@ class DeviceCommandPoll(APIView):
         if not device_api_key:
             return Response({'error': 'Missing device_api_key query parameter.'}, status=status.HTTP_400_BAD_REQUEST)
 
+        # Opt-in long-poll: ?wait=N holds the request for up to N seconds until a command is queued
+        # Opt-in batching: ?max_commands=N returns up to N pending commands as a 'commands' list
+        try:
+            wait = parse_wait(request.query_params.get('wait'))
+            max_commands = parse_max_commands(request.query_params.get('max_commands'))
+        except ValueError:
+            return Response({'error': 'wait must be a number of seconds and max_commands a positive integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
         try:
             with transaction.atomic():
-                device, created = Device.objects.get_or_create(
-                    device_api_key=device_api_key,
-                    defaults={
-                        'device_type': 'UNSET_TYPE',
-                        'name': f"Unknown Device ({device_api_key[:4]})",
-                        'is_online': True, # Mark as online on command poll
-                        'last_seen': timezone.now() # Update last_seen on command poll
-                    }
-                )
-               
+                device = device_cache.get(device_api_key)
+                created = False
+                if device is None:
+                    device, created = Device.objects.get_or_create(device_api_key=device_api_key, defaults=_polled_device_defaults(device_api_key))
+                    transaction.on_commit(lambda: device_cache.set(device_api_key, device))
+
                 if not created:
-                    # Always update is_online and last_seen when device polls
-                    device.is_online = True
-                    device.last_seen = timezone.now()
-                    device.save(update_fields=['is_online', 'last_seen']) # Only save changed fields
-
-                command_to_execute = DeviceCommandQueue.objects.filter(device=device, is_pending=True).order_by('created_at').first()
-
-                if command_to_execute:
-                    command_to_execute.is_pending = False
-                    command_to_execute.save() # Mark command as no longer pending
-                    
-                    parameters = command_to_execute.parameters
-                    if isinstance(parameters, str): # Handle case where parameters might be a JSON string
-                        try:
-                            parameters = json.loads(parameters)
-                        except json.JSONDecodeError:
-                            logger.error(f"Error decoding JSON parameters for command {command_to_execute.id}: {command_to_execute.parameters}", exc_info=True)
-                            parameters = {}
-                    elif parameters is None:
-                        parameters = {}
-
-                    return Response({
-                        'command': command_to_execute.command_type,
-                        'parameters': parameters
-                    }, status=status.HTTP_200_OK)
-                else:
-                    return Response({'command': 'no_command'}, status=status.HTTP_200_OK)
+                    # Always update is_online and last_seen when device polls; coalesced and flushed in bulk
+                    heartbeat.record(device.id)
+                    publish_heartbeat(device.id)
+
+            commands = next_commands(device.id, max_commands or 1, wait)
+            return Response(_command_poll_body(commands, max_commands), status=status.HTTP_200_OK)
         except Exception as e:
+            device_cache.invalidate(device_api_key)
             print(f"An unexpected error occurred in DeviceCommandPoll: {e}", file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
             return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+
+def _polled_device_defaults(device_api_key):
+    # A device that polls before it ever uploaded data; ingest fills in its type and name later
+    return {
+        'device_type': 'UNSET_TYPE',
+        'name': f"Unknown Device ({device_api_key[:4]})",
+        'is_online': True, # Mark as online on command poll
+        'last_seen': timezone.now() # Update last_seen on command poll
+    }
+
+
+def _command_parameters(command):
+    parameters = command.parameters
+    if isinstance(parameters, str): # Handle case where parameters might be a JSON string
+        try:
+            parameters = json.loads(parameters)
+        except json.JSONDecodeError:
+            logger.error(f"Error decoding JSON parameters for command {command.id}: {command.parameters}", exc_info=True)
+            parameters = {}
+    elif parameters is None:
+        parameters = {}
+    return parameters
+
+
+def _command_poll_body(commands, max_commands):
+    if max_commands is not None:
+        return {
+            'commands': [
+                {'command_id': command.id, 'command': command.command_type, 'parameters': _command_parameters(command)}
+                for command in commands
+            ]
+        }
+    if commands:
+        return {
+            'command_id': commands[0].id, # Echo back in an acknowledgement to report execution
+            'command': commands[0].command_type,
+            'parameters': _command_parameters(commands[0])
+        }
+    return {'command': 'no_command'}
+
+# Endpoint for devices to report that they executed a command
+class DeviceCommandAck(APIView):
+    authentication_classes = []
+    permission_classes = []
+
+    def post(self, request, format=None):
+        device_api_key = request.data.get('device_api_key')
+        acks_payload = request.data.get('acks')
+        if acks_payload is None and 'command_id' in request.data: # A single ack sent as top-level fields
+            acks_payload = {key: request.data[key] for key in ('command_id', 'executed', 'executed_at', 'response') if key in request.data}
+
+        if not device_api_key or not acks_payload:
+            return Response({'error': 'Missing data (device_api_key, and command_id or acks).'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            acks = parse_acks(acks_payload)
+        except IngestError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            device = device_cache.get(device_api_key)
+            if device is None:
+                device = Device.objects.filter(device_api_key=device_api_key).only('id', 'device_type').first()
+                if device is None:
+                    return Response({'error': 'Unknown device_api_key.'}, status=status.HTTP_404_NOT_FOUND)
+                device_cache.set(device_api_key, device)
+
+            # Buffered and bulk-inserted; unknown or foreign command ids are dropped at flush time
+            command_log_buffer.add(device.id, acks)
+            return Response({'message': 'Acknowledgement received', 'acknowledged': len(acks)}, status=status.HTTP_200_OK)
+        except Exception as e:
+            print(f"An unexpected error occurred in DeviceCommandAck: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+# Command round-trip latency percentiles for a device, from acknowledged CommandLog rows
+class DeviceCommandLatency(APIView):
+    authentication_classes = []
+    permission_classes = []
+
+    def get(self, request, device_id, format=None):
+        try:
+            device = get_object_or_404(Device, pk=device_id)
+            # Read-only: acknowledgements still in a worker's CommandLogBuffer are counted once it flushes
+
+            duration_param = request.query_params.get('duration', '24h')
+            end_time = timezone.now()
+            start_time = duration_start(duration_param, end_time)
+
+            return Response({
+                'device_id': device.id,
+                'duration': duration_param,
+                'latency_seconds': command_latency_stats(device.id, start_time, end_time),
+            }, status=status.HTTP_200_OK)
+        except Device.DoesNotExist:
+            return Response({'error': 'Device not found.'}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error(f"An unexpected error occurred in DeviceCommandLatency for PK: {device_id}: {e}", exc_info=True)
+            return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
 # Public endpoint for device onboarding check
 class DeviceOnboardingCheck(APIView):
     authentication_classes = []
@@ -146,104 +253,96 @@ class DeviceOnboardingCheck(APIView):
             return Response({'status': 'error', 'message': 'device_api_key is required.'}, status=status.HTTP_400_BAD_REQUEST)
 
         try:
-            device = get_object_or_404(Device, device_api_key=device_api_key)
-            if device.is_registered:
-                return Response({'status': 'error', 'message': 'This device is already registered to a user. Please login to manage it.'}, status=status.HTTP_409_CONFLICT)
-
-            if not device.is_online or (timezone.now() - device.last_seen).total_seconds() > 300: # 30 seconds threshold
-                return Response({'status': 'error', 'message': 'Device not recently online. Please ensure it is powered on and successfully connected to your Wi-Fi network first.'}, status=status.HTTP_412_PRECONDITION_FAILED)
-
-            return Response({'status': 'success', 'message': 'Device is available for registration!', 'device_name': device.name, 'device_type': device.device_type}, status=status.HTTP_200_OK)
+            device = heartbeat.apply(Device.objects.get(device_api_key=device_api_key))
+            return Response(*_onboarding_status(device))
         except Device.DoesNotExist:
             print(f"Device Does Not Exist in OnboardingCheck for API Key: {device_api_key}", file=sys.stderr)
-            return Response({'status': 'error', 'message': 'Invalid Device API Key. Please check the key on your physical device.'}, status=status.HTTP_404_NOT_FOUND)
+            return Response(ONBOARDING_UNKNOWN_DEVICE, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
             print(f"An unexpected error occurred in DeviceOnboardingCheck: {e}", file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
             return Response({'status': 'error', 'message': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+ONBOARDING_UNKNOWN_DEVICE = {'status': 'error', 'message': 'Invalid Device API Key. Please check the key on your physical device.'}
+
+
+def _onboarding_status(device):
+    """(body, status code) of the onboarding check for an existing device."""
+    if device.is_registered:
+        return {'status': 'error', 'message': 'This device is already registered to a user. Please login to manage it.'}, status.HTTP_409_CONFLICT
+
+    if not device.is_online or (timezone.now() - device.last_seen).total_seconds() > 300: # 30 seconds threshold
+        return {'status': 'error', 'message': 'Device not recently online. Please ensure it is powered on and successfully connected to your Wi-Fi network first.'}, status.HTTP_412_PRECONDITION_FAILED
+
+    return {'status': 'success', 'message': 'Device is available for registration!', 'device_name': device.name, 'device_type': device.device_type}, status.HTTP_200_OK
+
+
+def _device_online(device, now=None):
+    # Consistent with dashboard logic: online if seen within the last 5 minutes
+    if not device.last_seen:
+        return False
+    return ((now or timezone.now()) - device.last_seen).total_seconds() < 300
+
+def _device_latest_payload(device, latest_reading, now=None):
+    return {
+        'device': {
+            'id': device.id,
+            'name': device.name,
+            'device_type': device.device_type,
+            'is_online': _device_online(device, now), # Use the calculated online status
+            'last_seen': device.last_seen.isoformat() if device.last_seen else None,
+            'device_api_key': device.device_api_key, # Include API key for completeness
+        },
+        # Assuming data is already a JSONField, so it's a Python dict/list
+        'latest_data': latest_reading.data if latest_reading else {}
+    }
+
 class DeviceLatestDataRetrieve(APIView):
     authentication_classes = []
     permission_classes = []
 
     def get(self, request, device_id, format=None):
         try:
-            device = get_object_or_404(Device, pk=device_id)
-            latest_sensor_data = SensorData.objects.filter(device=device).order_by('-timestamp').first()
-
-            device_data = {
-                'id': device.id,
-                'name': device.name,
-                'device_api_key': device.device_api_key,
-                'device_type': device.device_type,
-                'is_online': device.is_online,
-                'last_seen': device.last_seen,
-                'is_registered': device.is_registered
-            }
-
-            latest_data_payload = None
-            if latest_sensor_data and latest_sensor_data.data:
-                try:
-                    latest_data_payload = json.loads(latest_sensor_data.data)
-                except json.JSONDecodeError:
-                    print(f"Error decoding JSON data for SensorData ID {latest_sensor_data.id}: {latest_sensor_data.data}", file=sys.stderr)
-                    latest_data_payload = {}
-
-            response_data = {
-                'device': device_data,
-                'latest_data': latest_data_payload
-            }
-            return Response(response_data, status=status.HTTP_200_OK)
+            # Get the device object based on the ID from the URL, with any heartbeat not yet flushed
+            device = heartbeat.apply(get_object_or_404(Device, id=device_id))
+
+            # Latest sensor data for this device, maintained by the ingest path
+            latest_sensor_data_entry = DeviceLatestReading.objects.filter(device_id=device.id).first()
+
+            return Response(_device_latest_payload(device, latest_sensor_data_entry), status=status.HTTP_200_OK)
+
         except Device.DoesNotExist:
             return Response({'error': 'Device not found.'}, status=status.HTTP_404_NOT_FOUND)
         except Exception as e:
-            print(f"An unexpected error occurred in DeviceLatestData: {e}", file=sys.stderr)
+            print(f"An unexpected error occurred in DeviceLatestDataRetrieve: {e}", file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
             return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
-    authentication_classes = []
-    permission_classes = []
+# Latest data for all of the logged-in user's devices in one request (dashboard polling)
+class DeviceLatestDataList(APIView):
+    permission_classes = [IsAuthenticated]
 
-    def get(self, request, device_id, format=None):
-        try:
-            # Get the device object based on the ID from the URL
-            device = get_object_or_404(Device, id=device_id)
-
-            # Fetch the latest sensor data for this device
-            latest_sensor_data_entry = SensorData.objects.filter(device=device).order_by('-timestamp').first()
-
-            # Determine online status based on last_seen (consistent with dashboard logic)
-            is_online = False
-            if device.last_seen:
-                time_difference = timezone.now() - device.last_seen
-                if time_difference.total_seconds() < 300:  # 5 minutes threshold
-                    is_online = True
-            
-            # Prepare the response data
-            response_data = {
-                'device': {
-                    'id': device.id,
-                    'name': device.name,
-                    'device_type': device.device_type,
-                    'is_online': is_online, # Use the calculated online status
-                    'last_seen': device.last_seen.isoformat() if device.last_seen else None,
-                    'device_api_key': device.device_api_key, # Include API key for completeness
-                },
-                'latest_data': {} # Default empty payload
-            }
-
-            if latest_sensor_data_entry:
-                # Assuming data is already a JSONField, so it's a Python dict/list
-                # If it's a string, you might need json.loads(latest_sensor_data_entry.data)
-                response_data['latest_data'] = latest_sensor_data_entry.data
+    def get(self, request, format=None):
+        devices = Device.objects.filter(owner=request.user, is_registered=True).select_related('latest_reading')
 
-            return Response(response_data, status=status.HTTP_200_OK)
+        ids_param = request.query_params.get('ids')
+        if ids_param:
+            try:
+                device_ids = [int(device_id) for device_id in ids_param.split(',') if device_id.strip()]
+            except ValueError:
+                return Response({'error': 'ids must be a comma-separated list of device ids.'}, status=status.HTTP_400_BAD_REQUEST)
+            devices = devices.filter(id__in=device_ids)
 
-        except Device.DoesNotExist:
-            return Response({'error': 'Device not found.'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            now = timezone.now()
+            results = [
+                _device_latest_payload(heartbeat.apply(device), getattr(device, 'latest_reading', None), now)
+                for device in devices
+            ]
+            return Response({'devices': results}, status=status.HTTP_200_OK)
         except Exception as e:
-            print(f"An unexpected error occurred in DeviceLatestDataRetrieve: {e}", file=sys.stderr)
+            print(f"An unexpected error occurred in DeviceLatestDataList: {e}", file=sys.stderr)
             traceback.print_exc(file=sys.stderr)
             return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
@@ -255,193 +354,41 @@ class DeviceAnalysisAPIView(APIView):
         try:
             device = get_object_or_404(Device, pk=device_id)
             
-            duration_param = request.query_params.get('duration', '24h')
-            end_time = timezone.now()
-            
-            if duration_param == '7d':
-                start_time = end_time - timezone.timedelta(days=7)
-            elif duration_param == '30d':
-                start_time = end_time - timezone.timedelta(days=30)
-            else: # Default to 24 hours
-                start_time = end_time - timezone.timedelta(hours=24)
-
-            sensor_data_qs = SensorData.objects.filter(
-                device=device,
-                timestamp__gte=start_time,
-                timestamp__lte=end_time
-            ).order_by('timestamp').values('timestamp', 'data')
-
-            if not sensor_data_qs.exists():
+            duration_param = normalize_duration(request.query_params.get('duration', '24h'))
+            encoding = request.query_params.get('encoding', 'points')
+            if encoding not in ENCODINGS:
+                return Response({'error': f"encoding must be one of: {', '.join(ENCODINGS)}."}, status=status.HTTP_400_BAD_REQUEST)
+            try:
+                max_points = parse_max_points(request.query_params.get('max_points'))
+            except ValueError:
+                return Response({'error': 'max_points must be an integer of at least 3.'}, status=status.HTTP_400_BAD_REQUEST)
+            data_key = 'data_points' if encoding == 'points' else 'series'
+            # Streaming anomalies are flagged at ingest, so they are read fresh rather than cached
+            live_anomalies = recent_anomalies(device.id, duration_start(duration_param, timezone.now()))
+
+            result, stale, job = analysis_cache.get(device, duration_param)
+            # The analysis worker's job refreshing a missing or stale result, for clients that poll on it
+            job_status = {'id': job.id, 'status': job.status} if job is not None else None
+            if result is None:
+                # First fit for this device/window is still running; the page polls again shortly
                 return Response({
                     'device_id': device.id,
                     'device_name': device.name,
                     'device_type': device.device_type,
-                    'message': f'No data available for analysis for the last {duration_param}.',
-                    'data_points': [],
+                    'message': 'Analysis is being computed. Please try again shortly.',
+                    data_key: [] if encoding == 'points' else {},
                     'anomalies': [],
                     'predictions': [],
-                    'suggestions': [f"No sensor data available for the last {duration_param}. Please ensure your device is sending data."]
-                }, status=status.HTTP_200_OK)
-
-            data_list = []
-            for entry in sensor_data_qs:
-                row = {'timestamp': entry['timestamp']}
-                # Assuming SensorData.data is a JSONField and already a dict
-                row.update(entry['data']) 
-                data_list.append(row)
-            
-            df = pd.DataFrame(data_list)
-            df['timestamp'] = pd.to_datetime(df['timestamp'])
-            df = df.set_index('timestamp')
-
-            anomalies = []
-            predictions = []
-            suggestions = []
-
-            # --- Anomaly Detection and Forecasting Logic ---
-            if device.device_type == 'power_monitor':
-                # Isolation Forest for Anomaly Detection (Power)
-                if 'power' in df.columns and len(df) > 10 and df['power'].nunique() > 1:
-                    try:
-                        iso_forest = IsolationForest(random_state=42, contamination=0.05) 
-                        df['anomaly'] = iso_forest.fit_predict(df[['power']])
-                        
-                        anomalous_points = df[df['anomaly'] == -1]
-                        for idx, row in anomalous_points.iterrows():
-                            anomalies.append({
-                                'timestamp': idx.isoformat(),
-                                'metric': 'power',
-                                'value': row['power'],
-                                'description': f"Unusual power consumption detected: {row['power']:.2f} W"
-                            })
-                            suggestions.append(f"⚠️ Anomaly detected: Power spike to {row['power']:.2f} W at {idx.strftime('%Y-%m-%d %H:%M')}. Consider checking connected devices.")
-                    except Exception as e:
-                        logger.error(f"Error running Isolation Forest for device {device_id}: {e}", exc_info=True)
-                        suggestions.append("⚠️ Could not run anomaly detection for power. Check data quality or ensure sufficient varied data points (needs > 10).")
-                else:
-                    suggestions.append("ℹ️ Not enough diverse data to perform power anomaly detection (needs > 10 varied readings).")
-
-                # Prophet for Forecasting (Power)
-                if 'power' in df.columns and len(df) > 20 and df['power'].nunique() > 1:
-                    try:
-                        prophet_df = df[['power']].reset_index().rename(columns={'timestamp': 'ds', 'power': 'y'})
-                        
-                        # --- FIX FOR PROPHET TIMEZONE ERROR - Add this line after renaming to 'ds' ---
-                        if prophet_df['ds'].dt.tz is not None:
-                            prophet_df['ds'] = prophet_df['ds'].dt.tz_localize(None)
-                        # --- END FIX ---
-
-                        m = Prophet(daily_seasonality=True, changepoint_prior_scale=0.05) 
-                        m.fit(prophet_df)
-
-                        future = m.make_future_dataframe(periods=24, freq='H') # Forecast next 24 hours
-                        forecast = m.predict(future)
-
-                        for idx, row in forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(24).iterrows():
-                            predictions.append({
-                                'timestamp': row['ds'].isoformat(),
-                                'predicted_power': row['yhat'],
-                                'lower_bound': row['yhat_lower'],
-                                'upper_bound': row['yhat_upper']
-                            })
-                        
-                        positive_predicted_power = forecast['yhat'].tail(24)
-                        positive_predicted_power = positive_predicted_power[positive_predicted_power > 0] # Filter out negative predictions
-
-                        if not positive_predicted_power.empty:
-                            avg_predicted_power = positive_predicted_power.mean()
-                            if avg_predicted_power > 500: # Example threshold for high usage
-                                suggestions.append(f"💡 Expected average power consumption over next 24 hours: {avg_predicted_power:.2f} W. Consider optimizing usage during peak times.")
-                            else:
-                                suggestions.append("✅ Power consumption forecast looks normal for the next 24 hours.")
-                        else:
-                            suggestions.append("ℹ️ Forecast generated, but predicted power values are unrealistic (zero/negative). Check historical data patterns.")
-
-                    except Exception as e:
-                        logger.error(f"Error running Prophet forecast for power on device {device_id}: {e}", exc_info=True)
-                        suggestions.append("⚠️ Could not generate power consumption forecast. Check data quality or ensure sufficient varied data points (needs > 20).")
-                else:
-                    suggestions.append("ℹ️ Not enough diverse data to generate power consumption forecast (needs > 20 varied readings).")
-
-            elif device.device_type == 'water_level':
-                # Isolation Forest for Anomaly Detection (Water Level)
-                if 'water_level' in df.columns and len(df) > 10 and df['water_level'].nunique() > 1:
-                    try:
-                        iso_forest = IsolationForest(random_state=42, contamination=0.05) 
-                        df['anomaly'] = iso_forest.fit_predict(df[['water_level']])
-                        anomalous_points = df[df['anomaly'] == -1]
-                        for idx, row in anomalous_points.iterrows():
-                            anomalies.append({
-                                'timestamp': idx.isoformat(),
-                                'metric': 'water_level',
-                                'value': row['water_level'],
-                                'description': f"Unusual water level detected: {row['water_level']:.2f}%"
-                            })
-                            if row['water_level'] < 10:
-                                suggestions.append(f"🚨 Water level is critically low ({row['water_level']:.2f}%). Consider refilling the tank immediately.")
-                            elif row['water_level'] > 90:
-                                suggestions.append(f"⚠️ Water level is very high ({row['water_level']:.2f}%). Ensure no overflow issues.")
-                    except Exception as e:
-                        logger.error(f"Error running Isolation Forest for water_level on device {device_id}: {e}", exc_info=True)
-                        suggestions.append("⚠️ Could not run water level anomaly detection. Check data quality or ensure sufficient varied data points.")
-                else:
-                    suggestions.append("ℹ️ Not enough diverse data to perform water level anomaly detection (needs > 10 varied readings).")
-
-                # Prophet for Forecasting (Water Level)
-                if 'water_level' in df.columns and len(df) > 20 and df['water_level'].nunique() > 1:
-                    try:
-                        prophet_df = df[['water_level']].reset_index().rename(columns={'timestamp': 'ds', 'water_level': 'y'})
-                        m = Prophet(daily_seasonality=True, changepoint_prior_scale=0.05)
-                        m.fit(prophet_df)
-                        future = m.make_future_dataframe(periods=24, freq='H') # Forecast next 24 hours
-                        forecast = m.predict(future)
-                        for idx, row in forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']].tail(24).iterrows():
-                            predictions.append({
-                                'timestamp': row['ds'].isoformat(),
-                                'predicted_water_level': row['yhat'],
-                                'lower_bound': row['yhat_lower'],
-                                'upper_bound': row['yhat_upper']
-                            })
-                        
-                        predicted_water_levels = forecast['yhat'].tail(24)
-                        predicted_water_levels = predicted_water_levels[(predicted_water_levels >= 0) & (predicted_water_levels <= 100)] # Clamp to 0-100%
-
-                        if not predicted_water_levels.empty:
-                            avg_predicted_level = predicted_water_levels.mean()
-                            if avg_predicted_level < 20: # Example threshold for low level
-                                suggestions.append(f"💡 Predicted average water level over next 24 hours: {avg_predicted_level:.2f}%. Plan for refilling soon.")
-                            else:
-                                suggestions.append("✅ Water level forecast looks stable for the next 24 hours.")
-                        else:
-                            suggestions.append("ℹ️ Forecast generated, but predicted water levels are unrealistic (outside 0-100% range). Check historical data patterns.")
-                    except Exception as e:
-                        logger.error(f"Error running Prophet forecast for water_level on device {device_id}: {e}", exc_info=True)
-                        suggestions.append("⚠️ Could not generate water level forecast. Check data quality or ensure sufficient varied data points (needs > 20).")
-                else:
-                    suggestions.append("ℹ️ Not enough diverse data to generate water level forecast (needs > 20 varied readings).")
-            
-            else:
-                # Default suggestions for unconfigured device types
-                suggestions.append("ℹ️ Analysis not yet configured for this device type.")
-                suggestions.append("ℹ️ Ensure the device is sending 'power' or 'water_level' data for analysis.")
-
-            # Prepare historical data for response (timestamp and data payload)
-            historical_data_for_response = []
-            for entry in data_list:
-                historical_data_for_response.append({
-                    'timestamp': entry['timestamp'].isoformat(), # Convert datetime to ISO string
-                    'data': {k: v for k, v in entry.items() if k != 'timestamp'} # Exclude timestamp from 'data' dict
-                })
+                    'suggestions': ["ℹ️ Analysis is being computed for this device. Results will appear shortly."],
+                    'live_anomalies': live_anomalies,
+                    'job': job_status,
+                }, status=status.HTTP_202_ACCEPTED)
 
-            return Response({
-                'device_id': device.id,
-                'device_name': device.name,
-                'device_type': device.device_type,
-                'data_points': historical_data_for_response,
-                'anomalies': anomalies,
-                'predictions': predictions,
-                'suggestions': suggestions
-            }, status=status.HTTP_200_OK)
+            # A stale result is the last good one; a refit from newer data is running in the background
+            # The cached window is already cut to ANALYSIS_MAX_POINTS; ?max_points= is applied per request
+            response = {key: value for key, value in result.items() if key != 'window'}
+            response[data_key] = encode_window(result['window'], max_points, encoding)
+            return Response(dict(response, stale=stale, live_anomalies=live_anomalies, job=job_status), status=status.HTTP_200_OK)
 
         except Device.DoesNotExist:
             logger.warning(f"Device Not Found for PK: {device_id} in DeviceAnalysisAPIView.")
@@ -449,3 +396,105 @@ class DeviceAnalysisAPIView(APIView):
         except Exception as e:
             logger.error(f"An unexpected error occurred in DeviceAnalysisAPIView for PK: {device_id}: {e}", exc_info=True)
             return Response({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+# Async variants of the device-facing endpoints, for running under an ASGI server (docs/setup_guide.md).
+# Same URLs, request parameters and responses; urls.py serves them with DEVICE_API_ASYNC_VIEWS = True.
+# They are plain Django views because DRF's APIView has no async handlers.
+
+def _request_data(request):
+    """The POSTed fields, from a JSON object body or form data. None if the JSON body is not an object."""
+    if request.content_type == 'application/json':
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return None
+        return data if isinstance(data, dict) else None
+    return request.POST
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class AsyncDeviceDataReceive(View):
+    async def post(self, request):
+        data = _request_data(request)
+        if data is None:
+            return JsonResponse({'error': 'Request body must be a JSON object.'}, status=status.HTTP_400_BAD_REQUEST)
+        device_api_key = data.get('device_api_key')
+        device_type = data.get('device_type')
+        sensor_data_payload = data.get('sensor_data')
+
+        if not all([device_api_key, device_type, sensor_data_payload is not None]):
+            return JsonResponse({'error': 'Missing data (device_api_key, device_type, or sensor_data).'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            sensor_data_payload = parse_sensor_payload(sensor_data_payload)
+            command_acks = parse_acks(data['command_acks']) if data.get('command_acks') else []
+        except IngestError as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # The write needs a transaction, which the async ORM doesn't support, so it runs in a worker thread
+            device = await sync_to_async(ingest_readings)(device_api_key, device_type, [(timezone.now(), sensor_data_payload)])
+            if command_acks:
+                await sync_to_async(command_log_buffer.add)(device.id, command_acks)
+            return JsonResponse({'message': 'Data received successfully'}, status=status.HTTP_200_OK)
+        except IngestBufferFull as e:
+            return JsonResponse({'error': str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        except Exception as e:
+            device_cache.invalidate(device_api_key)
+            print(f"An unexpected error occurred in AsyncDeviceDataReceive: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return JsonResponse({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class AsyncDeviceCommandPoll(View):
+    async def get(self, request):
+        device_api_key = request.GET.get('device_api_key')
+
+        if not device_api_key:
+            return JsonResponse({'error': 'Missing device_api_key query parameter.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            wait = parse_wait(request.GET.get('wait'))
+            max_commands = parse_max_commands(request.GET.get('max_commands'))
+        except ValueError:
+            return JsonResponse({'error': 'wait must be a number of seconds and max_commands a positive integer.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            device = device_cache.get(device_api_key)
+            created = False
+            if device is None:
+                device, created = await Device.objects.aget_or_create(device_api_key=device_api_key, defaults=_polled_device_defaults(device_api_key))
+                device_cache.set(device_api_key, device)
+
+            if not created:
+                await heartbeat.arecord(device.id)
+                publish_heartbeat(device.id)
+
+            # A long-poll waits on the event loop, not in a thread
+            commands = await anext_commands(device.id, max_commands or 1, wait)
+            return JsonResponse(_command_poll_body(commands, max_commands), status=status.HTTP_200_OK)
+        except Exception as e:
+            device_cache.invalidate(device_api_key)
+            print(f"An unexpected error occurred in AsyncDeviceCommandPoll: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return JsonResponse({'error': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+
+class AsyncDeviceOnboardingCheck(View):
+    async def get(self, request):
+        device_api_key = request.GET.get('device_api_key')
+        if not device_api_key:
+            return JsonResponse({'status': 'error', 'message': 'device_api_key is required.'}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            device = heartbeat.apply(await Device.objects.aget(device_api_key=device_api_key))
+            body, status_code = _onboarding_status(device)
+            return JsonResponse(body, status=status_code)
+        except Device.DoesNotExist:
+            print(f"Device Does Not Exist in OnboardingCheck for API Key: {device_api_key}", file=sys.stderr)
+            return JsonResponse(ONBOARDING_UNKNOWN_DEVICE, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            print(f"An unexpected error occurred in AsyncDeviceOnboardingCheck: {e}", file=sys.stderr)
+            traceback.print_exc(file=sys.stderr)
+            return JsonResponse({'status': 'error', 'message': f'An unexpected error occurred: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
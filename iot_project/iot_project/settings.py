@@ -1,6 +1,8 @@
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 import os
 
+from .sqlite_profile import sqlite_profile_for
+
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 # SECURITY WARNING: keep the secret key used in production secret!
@@ -60,6 +62,9 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # SQLITE_PROFILE=wsgi or asgi: WAL, synchronous=NORMAL, busy_timeout, mmap/cache size and
+        # IMMEDIATE transactions, with persistent connections under WSGI only (see sqlite_profile.py)
+        **sqlite_profile_for(os.environ.get('SQLITE_PROFILE', '')),
     }
 }
 
@@ -91,3 +96,48 @@ LOGOUT_REDIRECT_URL = '/'          # Where to redirect after logout
 
 # IMPORTANT: Tell Django to use your custom user model
 AUTH_USER_MODEL = 'core.CustomUser'
+
+# Device API tuning
+DEVICE_API_MAX_BATCH_SIZE = 500      # Max readings accepted by /api/v1/device/data/batch/ in one request
+DEVICE_API_MAX_CLOCK_SKEW = 300      # Seconds a device-side timestamp may run ahead of the server clock
+DEVICE_LOOKUP_CACHE_SIZE = 1024      # device_api_key -> device entries kept in each worker process
+DEVICE_LOOKUP_CACHE_TTL = 300        # Seconds before a cached key is re-read (bounds cross-worker staleness)
+INGEST_BUFFER_ENABLED = False        # Acknowledge uploads once buffered and group-commit them (device_api.ingest_buffer)
+INGEST_BUFFER_FLUSH_INTERVAL = 0.2   # Seconds between group commits; also the most a reading can lag behind in the database
+INGEST_BUFFER_MAX_ROWS = 500         # Commit as soon as this many readings are buffered
+INGEST_BUFFER_MAX_PENDING = 50000    # Answer uploads with 503 while this many readings wait for a failing database
+INGEST_BUFFER_WAL_DIR = None         # Log buffered readings here before acknowledging them (None = lost if the process dies)
+INGEST_BUFFER_WAL_FSYNC = False      # fsync each log append: survives power loss, at one fsync per upload
+DEVICE_HEARTBEAT_FLUSH_INTERVAL = 30 # Seconds between bulk last_seen/is_online writes (0 = write on every poll)
+DEVICE_API_ASYNC_VIEWS = False      # Serve data/, commands/ and onboard-check/ with async views; enable under uvicorn (asgi.py)
+DEVICE_PUBSUB_BACKEND = 'device_api.pubsub.InProcessBroker' # Live dashboard updates; in-process only reaches one ASGI process
+DASHBOARD_STREAM_KEEPALIVE = 15      # Seconds between SSE keep-alive comments on /dashboard/stream/
+COMMAND_LONG_POLL_MAX_WAIT = 30      # Upper bound for DeviceCommandPoll ?wait=N, in seconds
+COMMAND_LONG_POLL_RECHECK = 2        # Seconds between DB re-checks while waiting (catches commands queued by other workers)
+COMMAND_POLL_MAX_BATCH = 10          # Upper bound for DeviceCommandPoll ?max_commands=N
+COMMAND_LOG_FLUSH_INTERVAL = 5       # Seconds between bulk inserts of buffered command acknowledgements
+COMMAND_LOG_BUFFER_SIZE = 200        # Flush immediately once this many acknowledgements are buffered
+DEVICE_ANALYSIS_CACHE_ALIAS = 'default' # Cache holding fitted analysis results; use a shared backend with several workers
+DEVICE_ANALYSIS_CACHE_TTL = 300      # Seconds a result stays fresh when no new reading has arrived
+DEVICE_ANALYSIS_STALE_TTL = 86400    # Seconds the last good result is kept to serve while a refit runs
+DEVICE_ANALYSIS_RUNNER = 'worker'    # 'worker': fits run in `manage.py run_analysis_worker`; 'thread': in the web process
+DEVICE_ANALYSIS_WORKERS = 2          # Processes of run_analysis_worker (or threads per web process with the 'thread' runner)
+DEVICE_ANALYSIS_COLD_WAIT = 60       # 'thread' runner: seconds a request waits for the first fit before answering 202
+ANALYSIS_WORKER_POLL_INTERVAL = 1.0  # Seconds an idle run_analysis_worker waits between checks for queued jobs
+ANALYSIS_JOB_TIME_BUDGET = 300       # Seconds one analysis job may run before it is failed
+ANALYSIS_JOB_MAX_ATTEMPTS = 3        # Runs of a job interrupted by a worker crash before it is failed
+ML_MODEL_STORE_DIR = os.path.join(BASE_DIR, 'model_store') # Persisted Prophet/IsolationForest models (None = refit every time)
+ML_MODEL_DRIFT_THRESHOLD = 1.0       # Refit when new readings' mean moves this many training stds
+ML_MODEL_REFIT_RATIO = 0.2           # Refit when new readings exceed this share of the training set
+ML_MODEL_MAX_AGE = 86400             # Refit stored models older than this many seconds regardless
+STREAMING_ANOMALY_SEED_READINGS = 200 # Stored readings replayed to warm up a device's streaming detector per process
+FORECAST_WORKERS = None              # Processes used by `manage.py forecast_devices` (None = CPU count)
+FORECAST_CHUNK_SIZE = 10             # Devices per process pool task
+FORECAST_DEVICE_TIME_BUDGET = 120    # Seconds one device's forecast may take in the batch job
+FORECAST_MAX_AGE = 7200              # Seconds a batch forecast is served by the analysis API; run the job more often than this
+ANALYSIS_MAX_POINTS = 1000           # Chart points per metric in analysis responses (LTTB-downsampled); caps ?max_points=
+ANALYSIS_MAX_FIT_POINTS = 50000      # Readings the models are fitted on per window; past it the finest caught-up 1m/1h/1d rollup
+ROLLUP_BATCH_SIZE = 5000             # SensorData rows folded per transaction by `manage.py compact_rollups`
+SENSOR_DATA_RETENTION_DAYS = 90      # Raw readings older than this are moved out by `manage.py archive_sensor_data` (None = keep forever)
+SENSOR_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive') # Compressed per-device, per-month NPZ files of archived readings
+SENSOR_ARCHIVE_DELETE_CHUNK = 1000   # Archived rows deleted per transaction
@@ -0,0 +1,50 @@
+"""
+Forecasting and anomaly detection for device metrics.
+
+The engine works on a single metric series at a time; MetricConfig subclasses
+(see metrics.py) decide which metric a device type is analysed on and turn the
+results into user-facing suggestions. A ModelStore persists trained models so
+they are only refitted when the data has moved on (see model_store.py).
+
+The names below are imported from their submodule on first access, so importing
+the package (or only the streaming detector and metric configs, as ingest does)
+doesn't load pandas, scikit-learn or Prophet.
+"""
+import importlib
+
+_EXPORTS = {
+    'StreamingDetector': 'anomaly_detection',
+    'StreamState': 'anomaly_detection',
+    'lttb_indices': 'downsampling',
+    'analyze_series': 'engine',
+    'detect_anomalies': 'engine',
+    'forecast': 'engine',
+    'forecast_series': 'engine',
+    'ModelArtifacts': 'model_store',
+    'ModelStore': 'model_store',
+    'METRIC_CONFIGS': 'metrics',
+    'MetricConfig': 'metrics',
+    'analysed_device_types': 'metrics',
+    'get_metric_config': 'metrics',
+    'register_metric': 'metrics',
+    'columns_to_frame': 'utils',
+    'isoformat_micros': 'utils',
+    'metric_series': 'utils',
+    'readings_to_frame': 'utils',
+    'timestamp_micros': 'utils',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    globals()[name] = value # Later lookups skip __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,65 @@
+def fit_isolation_forest(series, contamination=0.05, random_state=42):
+    """Fits an IsolationForest on the values of a metric series."""
+    # Imported here: the streaming detector below runs at ingest, which must not load scikit-learn
+    from sklearn.ensemble import IsolationForest
+
+    iso_forest = IsolationForest(random_state=random_state, contamination=contamination)
+    iso_forest.fit(series.to_numpy().reshape(-1, 1))
+    return iso_forest
+
+
+def flag_anomalies(iso_forest, series):
+    """Returns the readings of a metric series that a fitted IsolationForest flags as anomalous."""
+    labels = iso_forest.predict(series.to_numpy().reshape(-1, 1))
+    return series[labels == -1]
+
+
+def isolation_forest_anomalies(series, contamination=0.05, random_state=42):
+    """Fits an IsolationForest on a metric series and returns the readings it flags as anomalous."""
+    return flag_anomalies(fit_isolation_forest(series, contamination, random_state), series)
+
+
+class StreamState:
+    """Running statistics of one metric stream: exponentially weighted mean and variance."""
+
+    __slots__ = ('mean', 'var', 'count')
+
+    def __init__(self, mean=0.0, var=0.0, count=0):
+        self.mean = mean
+        self.var = var
+        self.count = count
+
+
+class StreamingDetector:
+    """
+    Online spike detector: scores each reading against an exponentially weighted
+    moving average and variance (EWMA z-score) and updates them in O(1).
+
+    Readings are only flagged once `warmup` readings have been seen. Flagged values
+    are clipped to the threshold before updating the statistics, so one spike
+    doesn't inflate the variance and mask the next. `min_std` keeps sensors that
+    report a constant value from flagging every small change.
+    """
+
+    def __init__(self, alpha=0.05, threshold=4.0, warmup=20, min_std=0.0):
+        self.alpha = alpha
+        self.threshold = threshold
+        self.warmup = warmup
+        self.min_std = min_std
+
+    def update(self, state, value):
+        """Adds `value` to `state` in place. Returns (z_score, expected_value, is_anomaly)."""
+        expected = state.mean
+        std = max(state.var ** 0.5, self.min_std)
+        score = (value - expected) / std if std > 0 else 0.0
+        is_anomaly = state.count >= self.warmup and abs(score) > self.threshold
+
+        if is_anomaly:
+            value = expected + self.threshold * std * (1 if score > 0 else -1)
+        # Until warmed up, weigh readings equally so the estimate settles quickly
+        alpha = max(self.alpha, 1.0 / (state.count + 1))
+        diff = value - state.mean
+        state.mean += alpha * diff
+        state.var = (1 - alpha) * (state.var + alpha * diff * diff)
+        state.count += 1
+        return score, expected, is_anomaly
@@ -0,0 +1,41 @@
+import numpy as np
+
+
+def lttb_indices(x, y, max_points):
+    """
+    Largest-Triangle-Three-Buckets: the indices of at most `max_points` samples of
+    (x, y) that keep the visual shape of the series. The first and last samples are
+    always kept; every bucket in between contributes the sample forming the largest
+    triangle with the previously kept sample and the average of the next bucket.
+
+    x must be increasing (e.g. epoch seconds). Each bucket is scored with one
+    vectorized NumPy expression, so the Python loop runs once per output point.
+    """
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(x)
+    if max_points >= n or n <= 2:
+        return np.arange(n)
+    if max_points <= 2:
+        return np.array([0, n - 1])
+
+    # Bucket boundaries over the samples between the fixed first and last ones
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    # Averages of every bucket up front; the bucket after the last one is the final sample
+    sums_x = np.add.reduceat(x[:n - 1], edges[:-1])
+    sums_y = np.add.reduceat(y[:n - 1], edges[:-1])
+    counts = np.diff(edges)
+    avg_x = np.append(sums_x / counts, x[-1])
+    avg_y = np.append(sums_y / counts, y[-1])
+
+    selected = np.empty(max_points, dtype=int)
+    selected[0], selected[-1] = 0, n - 1
+    a = 0
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        next_x, next_y = avg_x[bucket + 1], avg_y[bucket + 1]
+        # Twice the triangle area; the constant factor doesn't change the argmax
+        area = np.abs((x[a] - next_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (next_y - y[a]))
+        a = start + int(np.argmax(area))
+        selected[bucket + 1] = a
+    return selected
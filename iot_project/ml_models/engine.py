@@ -0,0 +1,153 @@
+import logging
+
+from .anomaly_detection import fit_isolation_forest, flag_anomalies
+from .forecasting import fit_prophet, predict_prophet, stan_init
+from .model_store import ModelArtifacts
+from .utils import has_enough_data, isoformat_micros, timestamp_micros
+
+logger = logging.getLogger(__name__)
+
+
+def detect_anomalies(series, config, suggestions, context='', iso_forest=None):
+    anomalies = []
+    if not has_enough_data(series, config.min_anomaly_points):
+        suggestions.append(config.not_enough_for_anomalies())
+        return anomalies
+    try:
+        if iso_forest is None:
+            iso_forest = fit_isolation_forest(series, contamination=config.contamination)
+        anomalous_points = flag_anomalies(iso_forest, series)
+        timestamps = isoformat_micros(timestamp_micros(anomalous_points.index))
+        for timestamp, iso_timestamp, value in zip(anomalous_points.index, timestamps, anomalous_points.to_numpy(dtype=float).tolist()):
+            anomalies.append({
+                'timestamp': iso_timestamp,
+                'metric': config.metric,
+                'value': value,
+                'description': config.describe_anomaly(value),
+            })
+            suggestion = config.anomaly_suggestion(timestamp, value)
+            if suggestion:
+                suggestions.append(suggestion)
+    except Exception as e:
+        logger.error(f"Error running Isolation Forest for {config.metric}{context}: {e}", exc_info=True)
+        suggestions.append(config.anomaly_failed())
+    return anomalies
+
+
+def forecast(series, config, suggestions, context='', prophet_model=None):
+    predictions = []
+    if not has_enough_data(series, config.min_forecast_points):
+        suggestions.append(config.not_enough_for_forecast())
+        return predictions
+    try:
+        if prophet_model is None:
+            prophet_model = fit_prophet(series)
+        forecast_df = predict_prophet(prophet_model, series.index.max(), periods=config.forecast_periods)
+        columns = forecast_df[['yhat', 'yhat_lower', 'yhat_upper']].astype(float).to_dict('list')
+        # Prophet's ds is naive UTC (see strip_timezone), formatted here without an offset as before
+        timestamps = isoformat_micros(timestamp_micros(forecast_df['ds']), utc_offset='')
+        predictions = [
+            {'timestamp': timestamp, config.prediction_key: yhat, 'lower_bound': lower, 'upper_bound': upper}
+            for timestamp, yhat, lower, upper in zip(timestamps, columns['yhat'], columns['yhat_lower'], columns['yhat_upper'])
+        ]
+
+        plausible = config.plausible_forecast(forecast_df['yhat'])
+        if not plausible.empty:
+            suggestions.append(config.forecast_suggestion(plausible.mean()))
+        else:
+            suggestions.append(config.forecast_implausible())
+    except Exception as e:
+        logger.error(f"Error running Prophet forecast for {config.metric}{context}: {e}", exc_info=True)
+        suggestions.append(config.forecast_failed())
+    return predictions
+
+
+def trained_models(series, config, store, key, context='', with_prophet=True):
+    """
+    The IsolationForest and Prophet model for a series: loaded from `store` when the
+    stored ones still fit the data, otherwise refitted (Prophet warm-started from the
+    stored parameters when there are any) and saved back. Models the series doesn't
+    have enough data for, or Prophet when with_prophet is False, are None; a stored
+    Prophet model that isn't refitted is saved back as it was.
+    """
+    needs_isolation_forest = has_enough_data(series, config.min_anomaly_points)
+    needs_prophet = with_prophet and has_enough_data(series, config.min_forecast_points)
+    if not needs_isolation_forest and not needs_prophet:
+        return None, None
+
+    artifacts = store.load(key)
+    reason = store.refit_reason(artifacts, series, needs_isolation_forest, needs_prophet)
+    if reason is None:
+        return artifacts.isolation_forest, artifacts.prophet_model if needs_prophet else None
+
+    logger.info(f"Refitting {config.metric} models{context}: {reason}")
+    iso_forest = prophet_model = prophet_fit = None
+    warm_started = False
+    if needs_isolation_forest:
+        iso_forest = fit_isolation_forest(series, contamination=config.contamination)
+    if needs_prophet:
+        previous = artifacts.prophet_model if artifacts is not None and artifacts.compatible() else None
+        if previous is not None:
+            try:
+                prophet_model = fit_prophet(series, init=stan_init(previous))
+                warm_started = True
+            except Exception as e:
+                # e.g. the number of changepoints changed with the window; fall back to a cold fit
+                logger.warning(f"Warm start failed for {config.metric}{context}, fitting from scratch: {e}")
+        if prophet_model is None:
+            prophet_model = fit_prophet(series)
+    elif artifacts is not None and artifacts.compatible() and artifacts.prophet_model is not None:
+        # Prophet isn't refitted this time (e.g. a stored forecast is used): keep the stored one
+        prophet_fit = artifacts.prophet_fit()
+
+    try:
+        saved_prophet = artifacts.prophet_model if prophet_fit is not None else prophet_model
+        store.save(key, ModelArtifacts.describe(series, iso_forest, saved_prophet, warm_started, prophet_fit))
+    except Exception as e:
+        logger.error(f"Error saving {config.metric} models{context}: {e}", exc_info=True)
+    return iso_forest, prophet_model
+
+
+def analyze_series(series, config, context='', store=None, key=None, stored_forecast=None):
+    """
+    Runs anomaly detection and forecasting for one metric series (a pandas Series of
+    values indexed by timestamp). Returns {'anomalies', 'predictions', 'suggestions'}.
+    `context` is appended to log messages, e.g. ' on device 3'. With a ModelStore and
+    key, trained models are reused between calls instead of fitted every time. A
+    precomputed forecast ({'predictions', 'suggestions'}, see forecast_series) is
+    used as is instead of running Prophet.
+    """
+    iso_forest = prophet_model = None
+    if store is not None:
+        try:
+            iso_forest, prophet_model = trained_models(series, config, store, key, context, with_prophet=stored_forecast is None)
+        except Exception as e:
+            # Fitting errors are reported per model below, with the usual suggestions
+            logger.error(f"Error preparing {config.metric} models{context}: {e}", exc_info=True)
+
+    suggestions = []
+    anomalies = detect_anomalies(series, config, suggestions, context, iso_forest)
+    if stored_forecast is not None:
+        predictions = stored_forecast['predictions']
+        suggestions.extend(stored_forecast['suggestions'])
+    else:
+        predictions = forecast(series, config, suggestions, context, prophet_model)
+    return {'anomalies': anomalies, 'predictions': predictions, 'suggestions': suggestions}
+
+
+def forecast_series(series, config, context='', store=None, key=None):
+    """
+    Forecast only, for batch jobs: returns {'predictions', 'suggestions'} for one metric
+    series. With a store, the anomaly model is trained and stored alongside Prophet so
+    later analyze_series() calls only have to predict.
+    """
+    prophet_model = None
+    if store is not None:
+        try:
+            _, prophet_model = trained_models(series, config, store, key, context)
+        except Exception as e:
+            logger.error(f"Error preparing {config.metric} models{context}: {e}", exc_info=True)
+
+    suggestions = []
+    predictions = forecast(series, config, suggestions, context, prophet_model)
+    return {'predictions': predictions, 'suggestions': suggestions}
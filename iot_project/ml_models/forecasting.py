@@ -0,0 +1,51 @@
+import pandas as pd
+from prophet import Prophet
+
+from .utils import strip_timezone
+
+
+def fit_prophet(series, daily_seasonality=True, changepoint_prior_scale=0.05, init=None):
+    """
+    Fits Prophet on a metric series. `init` warm-starts the optimiser from the
+    parameters of a previous fit (see stan_init), which converges much faster when
+    the data has only moved on a little.
+    """
+    history = pd.DataFrame({'ds': strip_timezone(series.index), 'y': series.to_numpy()})
+
+    m = Prophet(daily_seasonality=daily_seasonality, changepoint_prior_scale=changepoint_prior_scale)
+    if init is not None:
+        m.fit(history, init=init)
+    else:
+        m.fit(history)
+    return m
+
+
+def stan_init(m):
+    """Fitted parameters of a Prophet model, in the form fit(init=...) expects."""
+    res = {}
+    for pname in ['k', 'm', 'sigma_obs']:
+        res[pname] = m.params[pname][0][0]
+    for pname in ['delta', 'beta']:
+        res[pname] = m.params[pname][0]
+    return res
+
+
+def predict_prophet(m, after, periods=24, freq='h'):
+    """
+    Forecasts `periods` steps of `freq` following the timestamp `after`, which need
+    not be the end of the model's training history. Returns columns ds, yhat,
+    yhat_lower, yhat_upper.
+    """
+    start = strip_timezone([after])[0]
+    future = pd.DataFrame({'ds': pd.date_range(start=start, periods=periods + 1, freq=freq)[1:]})
+    forecast = m.predict(future)
+    return forecast[['ds', 'yhat', 'yhat_lower', 'yhat_upper']]
+
+
+def prophet_forecast(series, periods=24, freq='h', daily_seasonality=True, changepoint_prior_scale=0.05):
+    """
+    Fits Prophet on a metric series and forecasts `periods` steps of `freq` past the
+    history. Returns the future rows only, with columns ds, yhat, yhat_lower, yhat_upper.
+    """
+    m = fit_prophet(series, daily_seasonality, changepoint_prior_scale)
+    return predict_prophet(m, series.index.max(), periods, freq)
@@ -0,0 +1,146 @@
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .anomaly_detection import StreamingDetector
+
+
+class MetricConfig:
+    """
+    Describes how one device metric is analysed and what suggestions its results
+    produce. The engine only deals with numbers; everything user-facing lives here,
+    so a new device type is supported by subclassing and registering a config.
+    """
+
+    metric = None            # Key in SensorData.data
+    label = None             # Human-readable name used in messages
+    prediction_key = None    # Field name for forecast values in the API response
+    min_anomaly_points = 10  # Anomaly detection needs more than this many varied readings
+    min_forecast_points = 20 # Forecasting needs more than this many varied readings
+    forecast_periods = 24    # Hours forecast past the latest reading
+    contamination = 0.05     # Expected share of anomalous readings (IsolationForest)
+    stream_alpha = 0.05      # EWMA weight of each new reading in the streaming detector
+    stream_threshold = 4.0   # |z-score| above which the streaming detector flags a reading
+    stream_warmup = 20       # Readings seen before the streaming detector flags anything
+    stream_min_std = 0.0     # Floor for the streaming detector's std, in the metric's unit
+
+    def describe_anomaly(self, value):
+        return f"Unusual {self.label} detected: {value:.2f}"
+
+    def streaming_detector(self):
+        return StreamingDetector(self.stream_alpha, self.stream_threshold, self.stream_warmup, self.stream_min_std)
+
+    def anomaly_suggestion(self, timestamp, value):
+        """Suggestion for one anomalous reading, or None."""
+        return None
+
+    def plausible_forecast(self, values):
+        """Filters predicted values down to the physically possible ones."""
+        return values
+
+    def forecast_suggestion(self, mean):
+        """Suggestion for the mean of the plausible predicted values."""
+        return f"✅ {self.label.capitalize()} forecast looks normal for the next {self.forecast_periods} hours."
+
+    def anomaly_failed(self):
+        return f"⚠️ Could not run {self.label} anomaly detection. Check data quality or ensure sufficient varied data points."
+
+    def not_enough_for_anomalies(self):
+        return f"ℹ️ Not enough diverse data to perform {self.label} anomaly detection (needs > {self.min_anomaly_points} varied readings)."
+
+    def forecast_implausible(self):
+        return f"ℹ️ Forecast generated, but predicted {self.label} values are unrealistic. Check historical data patterns."
+
+    def forecast_failed(self):
+        return f"⚠️ Could not generate {self.label} forecast. Check data quality or ensure sufficient varied data points (needs > {self.min_forecast_points})."
+
+    def not_enough_for_forecast(self):
+        return f"ℹ️ Not enough diverse data to generate {self.label} forecast (needs > {self.min_forecast_points} varied readings)."
+
+
+class PowerMetric(MetricConfig):
+    metric = 'power'
+    label = 'power consumption'
+    prediction_key = 'predicted_power'
+    high_usage_threshold = 500 # W; average forecast above this triggers an optimisation hint
+    stream_min_std = 1.0 # W; ignore jitter on idle loads
+
+    def describe_anomaly(self, value):
+        return f"Unusual power consumption detected: {value:.2f} W"
+
+    def anomaly_suggestion(self, timestamp, value):
+        return f"⚠️ Anomaly detected: Power spike to {value:.2f} W at {timestamp.strftime('%Y-%m-%d %H:%M')}. Consider checking connected devices."
+
+    def plausible_forecast(self, values):
+        return values[values > 0] # Filter out negative predictions
+
+    def forecast_suggestion(self, mean):
+        if mean > self.high_usage_threshold:
+            return f"💡 Expected average power consumption over next 24 hours: {mean:.2f} W. Consider optimizing usage during peak times."
+        return "✅ Power consumption forecast looks normal for the next 24 hours."
+
+    def anomaly_failed(self):
+        return "⚠️ Could not run anomaly detection for power. Check data quality or ensure sufficient varied data points (needs > 10)."
+
+    def not_enough_for_anomalies(self):
+        return "ℹ️ Not enough diverse data to perform power anomaly detection (needs > 10 varied readings)."
+
+    def forecast_implausible(self):
+        return "ℹ️ Forecast generated, but predicted power values are unrealistic (zero/negative). Check historical data patterns."
+
+
+class WaterLevelMetric(MetricConfig):
+    metric = 'water_level'
+    label = 'water level'
+    prediction_key = 'predicted_water_level'
+    critically_low = 10 # %
+    very_high = 90      # %
+    refill_threshold = 20 # %; average forecast below this suggests refilling
+    stream_min_std = 0.5 # %; ultrasonic level readings jitter around a steady level
+
+    def describe_anomaly(self, value):
+        return f"Unusual water level detected: {value:.2f}%"
+
+    def anomaly_suggestion(self, timestamp, value):
+        if value < self.critically_low:
+            return f"🚨 Water level is critically low ({value:.2f}%). Consider refilling the tank immediately."
+        if value > self.very_high:
+            return f"⚠️ Water level is very high ({value:.2f}%). Ensure no overflow issues."
+        return None
+
+    def plausible_forecast(self, values):
+        return values[(values >= 0) & (values <= 100)] # Clamp to 0-100%
+
+    def forecast_suggestion(self, mean):
+        if mean < self.refill_threshold:
+            return f"💡 Predicted average water level over next 24 hours: {mean:.2f}%. Plan for refilling soon."
+        return "✅ Water level forecast looks stable for the next 24 hours."
+
+    def forecast_implausible(self):
+        return "ℹ️ Forecast generated, but predicted water levels are unrealistic (outside 0-100% range). Check historical data patterns."
+
+
+# device_type -> MetricConfig. Extend with register_metric() or the ANALYSIS_METRIC_CONFIGS setting
+METRIC_CONFIGS = {
+    'power_monitor': PowerMetric(),
+    'water_level': WaterLevelMetric(),
+}
+
+
+def register_metric(device_type, config):
+    METRIC_CONFIGS[device_type] = config
+
+
+def get_metric_config(device_type):
+    """The MetricConfig analysed for a device type, or None if analysis isn't configured for it."""
+    # ANALYSIS_METRIC_CONFIGS = {'device_type': 'dotted.path.to.MetricConfigSubclass'}; None turns a built-in one off
+    configs = getattr(settings, 'ANALYSIS_METRIC_CONFIGS', {})
+    if device_type in configs:
+        path = configs[device_type]
+        return import_string(path)() if path is not None else None
+    return METRIC_CONFIGS.get(device_type)
+
+
+def analysed_device_types():
+    """The device types get_metric_config() returns a config for."""
+    device_types = {*METRIC_CONFIGS, *getattr(settings, 'ANALYSIS_METRIC_CONFIGS', {})}
+    return sorted(device_type for device_type in device_types if get_metric_config(device_type) is not None)
@@ -0,0 +1,159 @@
+import json
+import logging
+import os
+import tempfile
+
+import joblib
+import pandas as pd
+import prophet
+import sklearn
+from prophet.serialize import model_from_json, model_to_json
+
+logger = logging.getLogger(__name__)
+
+# Bump when the artifact layout or the way models are fitted changes; older artifacts are refitted
+ARTIFACT_FORMAT = 1
+
+META_FILE = 'meta.json'
+ISOLATION_FOREST_FILE = 'isolation_forest.joblib'
+PROPHET_FILE = 'prophet.json'
+
+# The training-data stats a fit is checked against before its model is reused
+FIT_KEYS = ('trained_at', 'watermark', 'n_points', 'mean', 'std', 'warm_started')
+
+
+class ModelArtifacts:
+    """
+    The trained models for one (device, metric, window) plus their metadata:
+    artifact format and library versions, when they were trained and the
+    training-window watermark (timestamp of the newest reading trained on),
+    and the training data's size, mean and std for drift checks. When a refit
+    leaves out Prophet, the stored Prophet model is kept and meta['prophet_fit']
+    holds the stats of the (older) data it was trained on.
+    """
+
+    def __init__(self, meta, isolation_forest=None, prophet_model=None):
+        self.meta = meta
+        self.isolation_forest = isolation_forest
+        self.prophet_model = prophet_model
+
+    @classmethod
+    def describe(cls, series, isolation_forest=None, prophet_model=None, warm_started=False, prophet_fit=None):
+        """Artifacts for models just trained on `series`; `prophet_fit` marks prophet_model as kept from an earlier fit."""
+        meta = {
+            'format': ARTIFACT_FORMAT,
+            'versions': {'prophet': prophet.__version__, 'sklearn': sklearn.__version__},
+            'trained_at': pd.Timestamp.now(tz='UTC').isoformat(),
+            'watermark': series.index.max().isoformat(),
+            'n_points': int(len(series)),
+            'mean': float(series.mean()),
+            'std': float(series.std(ddof=0)),
+            'warm_started': warm_started,
+        }
+        if prophet_fit is not None:
+            meta['prophet_fit'] = prophet_fit
+        return cls(meta, isolation_forest, prophet_model)
+
+    def prophet_fit(self):
+        """The training stats (FIT_KEYS) of the stored Prophet model."""
+        return self.meta.get('prophet_fit') or {key: self.meta[key] for key in FIT_KEYS}
+
+    @property
+    def watermark(self):
+        return pd.Timestamp(self.meta['watermark'])
+
+    @property
+    def trained_at(self):
+        return pd.Timestamp(self.meta['trained_at'])
+
+    def compatible(self):
+        return (self.meta.get('format') == ARTIFACT_FORMAT
+                and self.meta.get('versions') == {'prophet': prophet.__version__, 'sklearn': sklearn.__version__})
+
+
+class ModelStore:
+    """
+    Trained models persisted on the local filesystem, one directory per key:
+    the IsolationForest pickled with joblib, Prophet in its own JSON format and
+    the metadata as meta.json. Files are replaced atomically, so concurrent
+    readers in other processes never see a half-written artifact.
+    """
+
+    def __init__(self, root, drift_threshold=1.0, refit_ratio=0.2, max_age=86400):
+        self.root = root
+        self.drift_threshold = drift_threshold # Refit when new data's mean moves this many training stds
+        self.refit_ratio = refit_ratio         # ... or when new readings exceed this share of the training set
+        self.max_age = max_age                 # ... or when the artifact is older than this many seconds
+
+    def _path(self, key, filename):
+        return os.path.join(self.root, key, filename)
+
+    def load(self, key):
+        """The stored artifacts for `key`, or None if there are none (or they are unreadable)."""
+        try:
+            with open(self._path(key, META_FILE)) as f:
+                meta = json.load(f)
+            artifacts = ModelArtifacts(meta)
+            if 'isolation_forest' in meta.get('models', ()):
+                artifacts.isolation_forest = joblib.load(self._path(key, ISOLATION_FOREST_FILE))
+            if 'prophet' in meta.get('models', ()):
+                with open(self._path(key, PROPHET_FILE)) as f:
+                    artifacts.prophet_model = model_from_json(f.read())
+            return artifacts
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Ignoring unreadable model artifacts for {key}: {e}")
+            return None
+
+    def save(self, key, artifacts):
+        directory = os.path.join(self.root, key)
+        os.makedirs(directory, exist_ok=True)
+        models = []
+        if artifacts.isolation_forest is not None:
+            self._replace(directory, ISOLATION_FOREST_FILE, lambda f: joblib.dump(artifacts.isolation_forest, f), binary=True)
+            models.append('isolation_forest')
+        if artifacts.prophet_model is not None:
+            self._replace(directory, PROPHET_FILE, lambda f: f.write(model_to_json(artifacts.prophet_model)))
+            models.append('prophet')
+        # Metadata last: it is what marks the model files as belonging together
+        meta = dict(artifacts.meta, models=models)
+        self._replace(directory, META_FILE, lambda f: json.dump(meta, f))
+        artifacts.meta = meta
+
+    def _replace(self, directory, filename, write, binary=False):
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f'.{filename}.')
+        try:
+            with os.fdopen(fd, 'wb' if binary else 'w') as f:
+                write(f)
+            os.replace(tmp_path, os.path.join(directory, filename))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    def refit_reason(self, artifacts, series, needs_isolation_forest, needs_prophet):
+        """Why the stored artifacts can't be reused for `series`, or None if they can."""
+        if artifacts is None:
+            return 'no stored model'
+        if not artifacts.compatible():
+            return 'stored model is from another version'
+        if (needs_isolation_forest and artifacts.isolation_forest is None) or (needs_prophet and artifacts.prophet_model is None):
+            return 'stored model is missing a component'
+        reason = self._stale_reason(artifacts.meta, series)
+        if reason is None and needs_prophet and 'prophet_fit' in artifacts.meta:
+            # Prophet was kept from an earlier fit than the rest
+            reason = self._stale_reason(artifacts.meta['prophet_fit'], series)
+        return reason
+
+    def _stale_reason(self, fit, series):
+        if (pd.Timestamp.now(tz='UTC') - pd.Timestamp(fit['trained_at'])).total_seconds() > self.max_age:
+            return 'stored model is too old'
+
+        new_data = series[series.index > pd.Timestamp(fit['watermark'])]
+        if len(new_data) > self.refit_ratio * max(fit['n_points'], 1):
+            return f'{len(new_data)} new readings since the last fit'
+        if len(new_data):
+            shift = abs(new_data.mean() - fit['mean']) / max(fit['std'], 1e-9)
+            if shift > self.drift_threshold:
+                return f'new readings drifted {shift:.2f} std from the training data'
+        return None
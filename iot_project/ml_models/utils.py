@@ -0,0 +1,72 @@
+import numpy as np
+import pandas as pd
+
+
+def readings_to_frame(rows):
+    """
+    Builds a DataFrame indexed by timestamp from SensorData-style rows
+    ({'timestamp': ..., 'data': {...}}), with one column per data key.
+    """
+    records = []
+    for entry in rows:
+        row = {'timestamp': entry['timestamp']}
+        row.update(entry['data'])
+        records.append(row)
+    df = pd.DataFrame(records)
+    if df.empty:
+        return df
+    df['timestamp'] = pd.to_datetime(df['timestamp'])
+    return df.set_index('timestamp')
+
+
+def columns_to_frame(timestamps, columns, extras=None):
+    """
+    Builds the same DataFrame as readings_to_frame() from column arrays: `timestamps`
+    in microseconds since the epoch (UTC), `columns` mapping metric -> float array
+    with NaN for missing readings, and optional per-row dicts of further payload keys,
+    which win over a column of the same name like they do in a SensorData payload.
+    """
+    index = pd.DatetimeIndex(pd.to_datetime(np.asarray(timestamps, dtype=np.int64), unit='us', utc=True), name='timestamp')
+    df = pd.DataFrame({metric: values for metric, values in columns.items() if not np.isnan(values).all()}, index=index)
+    if extras is not None and any(extras):
+        df = pd.DataFrame.from_records(extras, index=index).combine_first(df)
+    return df
+
+
+def timestamp_micros(index):
+    """Microseconds since the epoch (UTC, or wall-clock if naive) of a DatetimeIndex or datetimes, as an int64 array."""
+    return pd.DatetimeIndex(index).as_unit('us').asi8
+
+
+def isoformat_micros(micros, utc_offset='+00:00'):
+    """
+    ISO-8601 strings for UTC timestamps in microseconds, formatted in one NumPy call.
+    Like datetime.isoformat(), fractional seconds are left out when they are all zero.
+    Pass utc_offset='' for naive timestamps.
+    """
+    micros = np.asarray(micros, dtype=np.int64)
+    unit = 'us' if (micros % 1_000_000).any() else 's'
+    formatted = np.datetime_as_string(micros.astype('datetime64[us]'), unit=unit)
+    return (np.char.add(formatted, utc_offset) if utc_offset else formatted).tolist()
+
+
+def metric_series(df, metric):
+    """The numeric values of one metric column, without missing or non-numeric readings. None if absent."""
+    if metric not in df.columns:
+        return None
+    series = pd.to_numeric(df[metric], errors='coerce').dropna()
+    series.name = metric
+    return series
+
+
+def has_enough_data(series, min_points):
+    """True if the series has more than `min_points` readings and they are not all the same value."""
+    return series is not None and len(series) > min_points and series.nunique() > 1
+
+
+def strip_timezone(index):
+    """Prophet rejects timezone-aware timestamps; keep the wall-clock values in UTC."""
+    index = pd.DatetimeIndex(index)
+    if index.tz is not None:
+        index = index.tz_convert('UTC').tz_localize(None)
+    return index